@@ -0,0 +1,350 @@
+"""
+A mock Kradle, for load-testing a served agent on one machine without a Kradle
+account, a tunnel or network access.
+
+It plays both parts of Kradle:
+
+- The REST API that the SDK talks to: API key checks, agent registration and
+  logs. Point the agent at it with KRADLE_API_URL, and set CREATE_PUBLIC_URL
+  to False in the agent so that it doesn't open a tunnel.
+- The orchestrator that drives the agent over HTTP: it initializes N simulated
+  participants and sends each of them synthetic initial_state, chat, idle and
+  command_executed events at a configurable rate, waiting for each answer
+  before sending the participant's next event, as Kradle does.
+
+Run it from the repository root, together with the stub LLM server:
+
+    python -m benchmarks.stub_llm --port 8001 &
+    python -m benchmarks.mock_kradle --port 8000 --participants 20 --rate 0.5 --duration 60 &
+    KRADLE_API_URL=http://localhost:8000/ KRADLE_API_KEY=local \\
+        OPENROUTER_API_URL=http://localhost:8001/chat/completions OPENROUTER_API_KEY=local-stub-key-0000000000 \\
+        python simple_llm_agent.py
+
+The run starts once the agent has registered itself, or right away with
+--agent-url, and ends with a report of the event latencies the agent achieved.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+
+import requests
+
+from helpers.metrics import LatencyHistogram
+
+BLOCKS = ["stone", "dirt", "grass_block", "oak_log", "oak_leaves", "sand", "water", "coal_ore", "iron_ore"]
+ENTITIES = ["cow", "pig", "sheep", "zombie", "skeleton", "chicken"]
+ITEMS = ["oak_log", "oak_planks", "stick", "cobblestone", "wooden_pickaxe", "coal", "bread"]
+CHAT = ["hi!", "can you get me some wood?", "follow me", "what are you doing?", "build a house", "stop"]
+OUTPUTS = ["Collected 1 oak_log.", "Reached the destination.", "Crafted 4 oak_planks.", "Could not find iron_ore nearby."]
+
+# The skill reference sent to each participant, in the shape Kradle uses.
+JS_FUNCTIONS = {
+    f"skills.{name}": {"description": description, "params": params}
+    for name, description, params in [
+        ("goToPosition", "Navigate to the given position.", "bot, x, y, z, min_distance"),
+        ("goToPlayer", "Navigate to the given player.", "bot, username, distance"),
+        ("collectBlock", "Collect blocks of the given type.", "bot, blockType, num"),
+        ("placeBlock", "Place a block at the given position.", "bot, blockType, x, y, z"),
+        ("craftRecipe", "Craft the given recipe.", "bot, itemName, num"),
+        ("attackNearest", "Attack the nearest mob of the given type.", "bot, mobType, kill"),
+        ("consume", "Eat or drink the given item.", "bot, itemName"),
+    ]
+}
+
+
+class MockKradleAPI(ThreadingHTTPServer):
+    """The parts of the Kradle REST API that the SDK uses to serve an agent.
+    Registered agents' URLs are kept in `agent_urls`; logs are counted."""
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, host: str = "localhost"):
+        super().__init__((host, port), _APIHandler)
+        self.agent_urls: dict[str, str] = {}
+        self.registered = threading.Event()
+        self.logs = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def register(self, username: str, url: str) -> None:
+        with self._lock:
+            self.agent_urls[username] = url
+        self.registered.set()
+
+    def log(self) -> None:
+        with self._lock:
+            self.logs += 1
+
+
+class _APIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MockKradleAPI
+
+    def do_GET(self) -> None:
+        self._read_body()
+        if self.path.rstrip("/") == "/human":
+            # Agents look up the OpenRouter key here if it isn't set locally.
+            self._send(200, {"id": "local", "openRouterKey": "local-stub-key-0000000000"})
+        else:
+            self._send(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_PUT(self) -> None:
+        self._register()
+
+    def do_POST(self) -> None:
+        if re.fullmatch(r"/runs/[^/]+/logs/?", self.path):
+            self._read_body()
+            self.server.log()
+            self._send(200, {})
+        else:
+            self._register()
+
+    def _register(self) -> None:
+        data = self._read_body()
+        if not re.fullmatch(r"/agents(/[^/]+)?/?", self.path):
+            self._send(404, {"error": f"Unknown path: {self.path}"})
+            return
+        url = (data.get("agentConfig") or {}).get("url")
+        if url:
+            self.server.register(data.get("username", ""), url)
+        self._send(200, data)
+
+    def _read_body(self) -> dict[str, Any]:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        return json.loads(body) if body else {}
+
+    def _send(self, status: int, data: Any) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+class SimulatedParticipant:
+    """One bot in a simulated run: keeps a little game state and turns it into
+    the event payloads Kradle sends."""
+
+    def __init__(self, run_id: str, index: int):
+        self.participant_id = f"participant-{index}"
+        self.run_id = run_id
+        self.name = f"bot{index}"
+        self._observations = 0
+        self._position = {"x": random.uniform(-100, 100), "y": 64.0, "z": random.uniform(-100, 100)}
+        self._inventory: dict[str, int] = {}
+
+    def challenge(self, task: str) -> dict[str, Any]:
+        return {
+            "participantId": self.participant_id,
+            "runId": self.run_id,
+            "task": task,
+            "agent_modes": {"mcmode": "survival", "respawn": True},
+            "js_functions": JS_FUNCTIONS,
+            "available_events": ["initial_state", "idle", "command_executed", "chat"],
+        }
+
+    def event(self, event: str) -> dict[str, Any]:
+        self._observations += 1
+        self._position["x"] += random.uniform(-3, 3)
+        self._position["z"] += random.uniform(-3, 3)
+        if event == "command_executed" and random.random() < 0.5:
+            item = random.choice(ITEMS)
+            self._inventory[item] = self._inventory.get(item, 0) + 1
+
+        return {
+            "name": self.name,
+            "participantId": self.participant_id,
+            "runId": self.run_id,
+            "observationId": str(self._observations),
+            "event": event,
+            "idle": event != "command_executed",
+            "executing": None,
+            "output": random.choice(OUTPUTS) if event == "command_executed" else None,
+            "position": dict(self._position),
+            "health": 1.0,
+            "hunger": 1.0,
+            "time": (self._observations * 100) % 24000,
+            "timeOfDay": "morning",
+            "players": ["player1"],
+            "blocks": random.sample(BLOCKS, 5),
+            "entities": random.sample(ENTITIES, 2),
+            "craftable": ["oak_planks"] if "oak_log" in self._inventory else [],
+            "inventory": dict(self._inventory),
+            "chat_messages": (
+                [{"sender": "player1", "message": random.choice(CHAT), "dm": random.random() < 0.3}]
+                if event == "chat"
+                else []
+            ),
+        }
+
+
+def next_event(weights: dict[str, float]) -> str:
+    return random.choices(list(weights), list(weights.values()))[0]
+
+
+class Orchestrator:
+    """Drives `participants` simulated participants against the agent served
+    at `agent_url` for `duration` seconds, each sending about `rate` events per
+    second, and records how long the agent took to answer."""
+
+    def __init__(
+        self,
+        agent_url: str,
+        participants: int,
+        rate: float,
+        duration: float,
+        weights: dict[str, float],
+        task: str,
+        timeout: float = 60,
+    ):
+        self._agent_url = agent_url.rstrip("/")
+        self._participants = participants
+        self._rate = rate
+        self._duration = duration
+        self._weights = weights
+        self._task = task
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self.latencies: dict[str, LatencyHistogram] = {}
+        self.errors = 0
+        self.skipped = 0
+
+    def _record(self, event: str, seconds: Optional[float]) -> None:
+        with self._lock:
+            if seconds is None:
+                self.errors += 1
+            else:
+                self.latencies.setdefault(event, LatencyHistogram()).observe(seconds)
+
+    def _post(self, session: requests.Session, path: str, data: dict[str, Any]) -> Optional[Any]:
+        try:
+            response = session.post(f"{self._agent_url}/{path}", json=data, timeout=self._timeout)
+            response.raise_for_status()
+            return response.json()
+        except (requests.RequestException, ValueError) as e:
+            print(f"Error calling {path} for {data.get('participantId')}: {e}")
+            return None
+
+    def _drive(self, participant: SimulatedParticipant, deadline: float) -> None:
+        session = requests.Session()
+        start = time.perf_counter()
+        init = self._post(session, "init", participant.challenge(self._task))
+        self._record("init", time.perf_counter() - start if init is not None else None)
+        if init is None:
+            return
+        listening = set(init.get("listenTo", []))
+
+        event = "initial_state"
+        while time.monotonic() < deadline:
+            if event not in listening:
+                with self._lock:
+                    self.skipped += 1
+            else:
+                start = time.perf_counter()
+                action = self._post(session, "event", participant.event(event))
+                self._record(event, time.perf_counter() - start if action is not None else None)
+            # Events arrive at random, `rate` per second on average.
+            time.sleep(random.expovariate(self._rate))
+            event = next_event(self._weights)
+
+    def run(self) -> float:
+        """Runs the simulation and returns how long it took."""
+        deadline = time.monotonic() + self._duration
+        start = time.perf_counter()
+        threads = []
+        for index in range(self._participants):
+            thread = threading.Thread(target=self._drive, args=(SimulatedParticipant(f"run-{uuid.uuid4()}", index), deadline))
+            thread.start()
+            threads.append(thread)
+            # Stagger the starts, as participants join a run one by one.
+            time.sleep(min(0.05, 1 / self._rate / self._participants))
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def report(self, elapsed: float, logs: int) -> dict[str, Any]:
+        with self._lock:
+            events = sum(histogram.count for name, histogram in self.latencies.items() if name != "init")
+            return {
+                "participants": self._participants,
+                "seconds": elapsed,
+                "events": events,
+                "events_per_second": events / elapsed if elapsed else None,
+                "errors": self.errors,
+                "skipped": self.skipped,
+                "logs": logs,
+                "latency": {name: histogram.summary() for name, histogram in self.latencies.items()},
+            }
+
+
+def parse_weights(spec: str) -> dict[str, float]:
+    weights = {}
+    for part in spec.split(","):
+        event, _, weight = part.partition("=")
+        weights[event.strip()] = float(weight)
+    return weights
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8000, help="The port to serve the mock Kradle API on")
+    parser.add_argument("--agent-url", help="The agent's URL, e.g. http://localhost:1500/my-agent")
+    parser.add_argument("--participants", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=0.5, help="Events per second per participant")
+    parser.add_argument("--duration", type=float, default=60, help="How long to run, in seconds")
+    parser.add_argument(
+        "--events",
+        default="idle=0.4,command_executed=0.4,chat=0.2",
+        help="The relative frequency of each event after initial_state",
+    )
+    parser.add_argument("--task", default="Collect 10 oak logs and craft a wooden pickaxe.")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    api = MockKradleAPI(args.port)
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    print(f"Serving the mock Kradle API at {api.url}")
+
+    agent_url = args.agent_url
+    if agent_url is None:
+        print("Waiting for an agent to register...")
+        api.registered.wait()
+        agent_url = next(iter(api.agent_urls.values()))
+    print(f"Driving {args.participants} participants against {agent_url} for {args.duration:.0f}s")
+
+    orchestrator = Orchestrator(
+        agent_url, args.participants, args.rate, args.duration, parse_weights(args.events), args.task
+    )
+    elapsed = orchestrator.run()
+    report = orchestrator.report(elapsed, api.logs)
+    api.shutdown()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{report['events']} events from {report['participants']} participants in {elapsed:.1f}s")
+    print(f"{report['events_per_second']:.1f} events/s, {report['errors']} errors, {report['logs']} logs")
+    print(f"{'event':<18} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, summary in report["latency"].items():
+        percentiles = (f"{(summary[p] or 0) * 1000:9.1f}" for p in ("p50", "p95", "p99"))
+        print(f"{name:<18} {summary['count']:>7} {' '.join(percentiles)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Replays a recording made with RECORD_PATH through the agent in
+simple_llm_agent.py, offline: Kradle is replaced by a fake that discards logs,
+and the LLM by a stub that answers with the recorded responses after a
+simulated latency. Reports events per second, the latency of each stage of the
+event pipeline and memory use, so performance changes can be compared
+reproducibly.
+
+Run it from the repository root, e.g.:
+
+    python -m benchmarks.replay recording.jsonl --latency lognormal:0.8,0.5 --copies 10
+
+Each copy replays every participant of the recording as a separate participant,
+concurrently, to simulate more load.
+"""
+
+import argparse
+import dataclasses
+import json
+import os
+import resource
+import threading
+import sys
+import time
+import traceback
+from contextlib import redirect_stdout
+from typing import Any, Optional
+
+from kradle import Agent, Context
+from kradle.models import ChallengeInfo, Observation
+
+import simple_llm_agent
+from helpers.metrics import metrics
+from helpers.recording import (
+    StubLLMClient,
+    challenge_from_dict,
+    latency_distribution,
+    observation_from_dict,
+    read_recording,
+    responses_by_participant,
+)
+
+
+class FakeLogAPI:
+    """Counts log entries instead of sending them. Entries are still
+    serialized, as the real client does."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def create(self, run_id: str, participant_id: str, message: Any) -> dict[str, Any]:
+        json.dumps(message, default=str)
+        with self._lock:
+            self.count += 1
+        return {}
+
+
+class FakeKradleAPI:
+    def __init__(self):
+        self.logs = FakeLogAPI()
+
+
+class FakeKradle:
+    """Stands in for `Kradle` in `setup`, without connecting to Kradle."""
+
+    def __init__(self):
+        self._api_client = FakeKradleAPI()
+
+    @property
+    def api(self) -> Any:
+        return self._api_client
+
+    def agent(
+        self,
+        name: str,
+        display_name: Optional[str] = None,
+        description: Optional[str] = None,
+        config: Optional[dict[str, Any]] = None,
+    ) -> Agent:
+        return Agent(self, name, display_name or name, description or "", config or {})  # type: ignore[arg-type]
+
+
+def max_rss_mib() -> float:
+    # ru_maxrss is in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording", help="A JSONL file recorded with RECORD_PATH")
+    parser.add_argument(
+        "--latency",
+        default="recorded",
+        help='LLM latency: "fixed:<s>", "uniform:<low>,<high>", "lognormal:<median>,<sigma>" or "recorded"',
+    )
+    parser.add_argument("--copies", type=int, default=1, help="How many times to replay each participant")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    records = list(read_recording(args.recording))
+    challenges = {record["participant_id"]: record["challenge"] for record in records if record["type"] == "init"}
+    observations: dict[str, list[dict[str, Any]]] = {participant_id: [] for participant_id in challenges}
+    for record in records:
+        if record["type"] == "observation" and record["participant_id"] in observations:
+            observations[record["participant_id"]].append(record["observation"])
+    responses = responses_by_participant(records)
+    latencies = [record["latency"] for record in records if record["type"] == "response"]
+    latency = latency_distribution(args.latency, latencies)
+
+    # The stub can't stream, and the replay itself shouldn't be recorded.
+    simple_llm_agent.STREAM_COMPLETIONS = False
+    simple_llm_agent.RECORD_PATH = None
+    simple_llm_agent.CONSOLE_OUTPUT = False
+    simple_llm_agent.STEP_BY_STEP = False
+
+    # Maps replayed participant IDs to the recorded ones.
+    originals: dict[str, str] = {}
+
+    def client_factory(context: Context) -> StubLLMClient:
+        return StubLLMClient(responses.get(originals[context.participant_id], []), latency)
+
+    kradle = FakeKradle()
+    agent = simple_llm_agent.setup(kradle, client_factory=client_factory)  # type: ignore[arg-type]
+
+    runs: list[tuple[ChallengeInfo, list[Observation]]] = []
+    for copy in range(args.copies):
+        for participant_id, challenge in challenges.items():
+            replayed_id = f"{participant_id}-{copy}"
+            run_id = f"replay-{copy}"
+            originals[replayed_id] = participant_id
+            runs.append(
+                (
+                    dataclasses.replace(challenge_from_dict(challenge), participant_id=replayed_id, run_id=run_id),
+                    [
+                        dataclasses.replace(observation_from_dict(data), participant_id=replayed_id, run_id=run_id)
+                        for data in observations[participant_id]
+                    ],
+                )
+            )
+
+    errors: list[str] = []
+
+    def replay(challenge: ChallengeInfo, participant_observations: list[Observation]) -> None:
+        participant = agent._create_participant(kradle.api, challenge.participant_id, challenge.run_id)
+        participant.init_participant(challenge)
+        for observation in participant_observations:
+            try:
+                participant.on_event(observation)
+            except Exception:
+                errors.append(traceback.format_exc())
+
+    rss_before = max_rss_mib()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        threads = [threading.Thread(target=replay, args=run) for run in runs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - start
+
+    events = sum(len(participant_observations) for _, participant_observations in runs)
+    report = {
+        "participants": len(runs),
+        "events": events,
+        "seconds": elapsed,
+        "events_per_second": events / elapsed if elapsed else None,
+        "errors": len(errors),
+        "logs": kradle.api.logs.count,
+        "max_rss_mib": max_rss_mib(),
+        "rss_growth_mib": max_rss_mib() - rss_before,
+        "stages": {name: metrics.merged(name).summary() for name in metrics.names()},
+    }
+
+    if errors:
+        print(f"{len(errors)} events failed, the first with:\n{errors[0]}", file=sys.stderr)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{report['participants']} participants, {events} events ({len(errors)} failed) in {elapsed:.2f}s")
+    print(f"{report['events_per_second']:.1f} events/s, max RSS {report['max_rss_mib']:.1f} MiB")
+    print(f"{'stage':<20} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, summary in report["stages"].items():
+        percentiles = (f"{(summary[p] or 0) * 1000:9.2f}" for p in ("p50", "p95", "p99"))
+        print(f"{name:<20} {summary['count']:>7} {' '.join(percentiles)}")
+
+
+if __name__ == "__main__":
+    main()
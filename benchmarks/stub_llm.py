@@ -0,0 +1,258 @@
+"""
+A stub OpenAI-compatible chat completions server, for load-testing the agent
+without an LLM provider or network access. Every request is answered with a
+canned action after a simulated latency; a share of requests can be failed to
+exercise the agent's retries, circuit breakers and failover.
+
+Run it from the repository root, e.g.:
+
+    python -m benchmarks.stub_llm --port 8001 --latency lognormal:0.8,0.5 --error-rate 0.05
+
+and point the agent at it with:
+
+    OPENROUTER_API_URL=http://localhost:8001/chat/completions
+
+Streaming requests ("stream": true) are answered with server-sent events, like
+OpenRouter does.
+
+Usage is reported with each response, as a rough 4 characters per token. Like a
+provider with prompt caching, the stub counts the prompt prefix as cached once
+it has seen it: the messages up to the last "cache_control" breakpoint (see
+PROMPT_CACHING). Use --cache-usage to choose between OpenAI-style
+(prompt_tokens_details.cached_tokens) cached-token counts, where the leading
+system messages are also cached without a breakpoint, and Anthropic-style
+(cache_read_input_tokens) ones, where they aren't.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Optional
+
+from helpers.recording import latency_distribution, read_recording
+
+DEFAULT_RESPONSE = json.dumps(
+    {
+        "code": 'await skills.collectBlock(bot, "oak_log", 1);',
+        "message": "Collecting some wood.",
+    }
+)
+
+# The errors that are injected, with the status code and body of each.
+ERRORS: list[tuple[int, dict[str, Any]]] = [
+    (429, {"error": {"code": 429, "message": "Rate limit exceeded"}}),
+    (500, {"error": {"code": 500, "message": "Internal server error"}}),
+    (502, {"error": {"code": 502, "message": "Provider returned an error"}}),
+]
+
+
+def _text(content: Any) -> str:
+    """Returns the text of a message's content, which is either a string or a
+    list of parts."""
+    if isinstance(content, list):
+        return "".join(str(part.get("text", "")) for part in content if isinstance(part, dict))
+    return str(content or "")
+
+
+def _cacheable_prefix(messages: list[dict[str, Any]], automatic: bool) -> list[dict[str, Any]]:
+    breakpoints = [
+        index
+        for index, message in enumerate(messages)
+        if isinstance(message.get("content"), list)
+        and any(isinstance(part, dict) and "cache_control" in part for part in message["content"])
+    ]
+    if breakpoints:
+        return messages[: breakpoints[-1] + 1]
+    if not automatic:
+        return []
+    length = 0
+    while length < len(messages) and messages[length].get("role") == "system":
+        length += 1
+    return messages[:length]
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    """Serves chat completions on `port` until `shutdown` is called.
+
+    Args:
+        port: The port to listen on; 0 picks a free one.
+        latency: Returns the simulated latency of each request, in seconds.
+        error_rate: The share of requests that fail with one of ERRORS.
+        responses: The contents to answer with, in rotation.
+        cache_usage: How to report cached prompt tokens: "openai", "anthropic"
+            or "none".
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port: int = 0,
+        latency: Callable[[], float] = lambda: 0.0,
+        error_rate: float = 0.0,
+        responses: Optional[list[str]] = None,
+        host: str = "localhost",
+        cache_usage: str = "openai",
+    ):
+        super().__init__((host, port), _Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self._responses = responses or [DEFAULT_RESPONSE]
+        self.cache_usage = cache_usage
+        self._lock = threading.Lock()
+        self._next = 0
+        self._cached_prefixes: set[str] = set()
+        self.requests = 0
+        self.errors = 0
+        self.cached_tokens = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/chat/completions"
+
+    def next_response(self) -> Optional[str]:
+        """Returns the content of the next response, or None if this request
+        should fail."""
+        with self._lock:
+            self.requests += 1
+            if random.random() < self.error_rate:
+                self.errors += 1
+                return None
+            content = self._responses[self._next % len(self._responses)]
+            self._next += 1
+            return content
+
+    def usage(self, messages: list[dict[str, Any]], content: str) -> dict[str, Any]:
+        """Returns the usage to report for a completion, counting the prompt
+        prefix as cached if an earlier request had the same one."""
+        prompt_tokens = sum(len(_text(message.get("content"))) for message in messages) // 4
+        completion_tokens = len(content) // 4
+        usage: dict[str, Any] = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+        prefix = _cacheable_prefix(messages, automatic=self.cache_usage == "openai")
+        if not prefix or self.cache_usage == "none":
+            return usage
+        key = hashlib.sha256(json.dumps(prefix, sort_keys=True).encode()).hexdigest()
+        with self._lock:
+            cached = key in self._cached_prefixes
+            self._cached_prefixes.add(key)
+        cached_tokens = sum(len(_text(message.get("content"))) for message in prefix) // 4 if cached else 0
+        with self._lock:
+            self.cached_tokens += cached_tokens
+
+        if self.cache_usage == "anthropic":
+            usage["cache_read_input_tokens"] = cached_tokens
+        else:
+            usage["prompt_tokens_details"] = {"cached_tokens": cached_tokens}
+        return usage
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections alive, as the agent's pooled transport expects.
+    protocol_version = "HTTP/1.1"
+    server: StubLLMServer
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"code": 404, "message": f"Unknown path: {self.path}"}})
+            return
+
+        request = json.loads(body or b"{}")
+        time.sleep(self.server.latency())
+        content = self.server.next_response()
+        if content is None:
+            status, error = random.choice(ERRORS)
+            self._send_json(status, error)
+            return
+
+        model = request.get("model", "stub")
+        usage = self.server.usage(request.get("messages", []), content)
+        if request.get("stream"):
+            self._send_stream(model, content, usage)
+            return
+
+        self._send_json(
+            200,
+            {
+                "id": f"stub-{time.monotonic_ns()}",
+                "object": "chat.completion",
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            },
+        )
+
+    def _send_json(self, status: int, data: Any) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, model: str, content: str, usage: dict[str, Any]) -> None:
+        # Without a Content-Length, the end of the stream is the end of the
+        # connection.
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for start in range(0, len(content), 16):
+            chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": content[start : start + 16]}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        # Like OpenRouter, report usage in a final chunk without content.
+        chunk = {"model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument(
+        "--latency",
+        default="fixed:0.5",
+        help='Response latency: "fixed:<s>", "uniform:<low>,<high>" or "lognormal:<median>,<sigma>"',
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0, help="The share of requests that fail")
+    parser.add_argument("--recording", help="Answer with the LLM responses of a recording made with RECORD_PATH")
+    parser.add_argument(
+        "--cache-usage",
+        choices=["openai", "anthropic", "none"],
+        default="openai",
+        help="How to report cached prompt tokens",
+    )
+    args = parser.parse_args()
+
+    responses = None
+    if args.recording:
+        responses = [record["content"] for record in read_recording(args.recording) if record["type"] == "response"]
+
+    server = StubLLMServer(
+        args.port, latency_distribution(args.latency), args.error_rate, responses, cache_usage=args.cache_usage
+    )
+    print(f"Serving stub completions at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"{server.requests} requests, {server.errors} injected errors, {server.cached_tokens} cached tokens")
+
+
+if __name__ == "__main__":
+    main()
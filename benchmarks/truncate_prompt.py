@@ -0,0 +1,74 @@
+"""
+A micro-benchmark of `truncate_prompt`, which runs twice per turn (for the
+console and for the logs), against the original implementation that copied
+every message on every call.
+
+Run it from the repository root:
+
+    python -m benchmarks.truncate_prompt
+"""
+
+import timeit
+import tracemalloc
+from typing import Any
+
+from simple_llm_agent import truncate_prompt
+
+Messages = list[dict[str, Any]]
+
+
+def copying_truncate_prompt(prompt: Messages, length: int = 2000) -> Messages:
+    """The original implementation, for comparison."""
+    truncated_prompt = []
+    for p in prompt:
+        truncated_p = p.copy()
+        if len(truncated_p["content"]) > length:
+            truncated_p["content"] = truncated_p["content"][:length] + "..."
+        truncated_prompt.append(truncated_p)
+    return truncated_prompt
+
+
+def make_prompt() -> Messages:
+    """A prompt shaped like the agent's: long static system messages, followed
+    by a few turns of history and the observation."""
+    system = [{"role": "system", "content": "Skill reference and instructions. " * 400} for _ in range(4)]
+    history = [
+        {"role": "user", "content": "Event received: idle\n\nVisible Blocks: stone, dirt, oak_log"},
+        {"role": "assistant", "content": '{"code": "await skills.collectBlock(bot, \'oak_log\', 1);", "message": ""}'},
+        {"role": "user", "content": "Event received: command_executed\n\nCommand Output:\n" + "x" * 3000},
+    ]
+    observation = {"role": "user", "content": "Event received: idle\n\nVisible Blocks: " + "stone, " * 500}
+    return [*system, *history, observation]
+
+
+def allocated_per_call(function: Any, system: Messages, turns: int = 200) -> float:
+    """Returns the average number of bytes allocated per turn, where each turn
+    builds a new prompt around the same system messages."""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    total = 0
+    for _ in range(turns):
+        prompt = [*system, *(dict(message) for message in make_prompt()[len(system) :])]
+        start, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        results = [function(prompt), function(prompt)]
+        _, peak = tracemalloc.get_traced_memory()
+        total += peak - start
+        del results
+    tracemalloc.stop()
+    return total / turns
+
+
+def main() -> None:
+    prompt = make_prompt()
+    system = prompt[:4]
+
+    for name, function in [("copying", copying_truncate_prompt), ("cached", truncate_prompt)]:
+        seconds = min(timeit.repeat(lambda: function(prompt), number=10000, repeat=5)) / 10000
+        allocated = allocated_per_call(function, system)
+        print(f"{name:>8}: {seconds * 1e6:7.2f} µs per call, {allocated / 1024:7.1f} KiB allocated per turn")
+
+
+if __name__ == "__main__":
+    main()
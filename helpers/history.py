@@ -0,0 +1,280 @@
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor
+from string import Template
+from typing import Optional, Protocol
+
+from helpers import prompts
+from helpers.llm_clients import LLMClient, message_with_details, parse_action_from_response
+from helpers.tokens import estimate_message_tokens, estimate_tokens, truncate_to_tokens
+
+Message = dict[str, str]
+
+# A turn is the messages recorded for one event: the observation sent to the
+# LLM, its response and any error.
+Turn = list[Message]
+
+
+class Summarizer(Protocol):
+    def __call__(self, summary: str, turns: list[Turn]) -> str:
+        """Returns `summary` updated with what happened in `turns`."""
+        ...
+
+
+def describe_turn(turn: Turn) -> str:
+    """Returns a one-line description of a turn: the event, the code the LLM
+    wrote and what it said, and whether its response was rejected."""
+    parts = []
+    for message in turn:
+        content = message["content"]
+        if message["role"] == "user":
+            # Observations start with "Event received: <event>".
+            first_line = content.split("\n", 1)[0]
+            parts.append(first_line.removeprefix("Event received: "))
+        elif message["role"] == "assistant":
+            try:
+                action = json.loads(content[content.find("{") : content.rfind("}") + 1])
+            except ValueError:
+                parts.append(f"replied {_shorten(content)!r}")
+                continue
+            if isinstance(action, dict):
+                if action.get("code"):
+                    parts.append(f"ran `{_shorten(str(action['code']))}`")
+                if action.get("message"):
+                    parts.append(f"said {_shorten(str(action['message']))!r}")
+        else:
+            parts.append(f"(rejected: {_shorten(content.removeprefix('your last response was not valid because: '))})")
+    return "- " + " ".join(parts)
+
+
+def _shorten(text: str, length: int = 120) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= length else text[: length - 3] + "..."
+
+
+class HeuristicSummarizer:
+    """Summarizes turns locally by appending a one-line description of each,
+    dropping the oldest lines once the summary grows past `max_tokens`."""
+
+    def __init__(self, max_tokens: int = 500):
+        self._max_tokens = max_tokens
+
+    def __call__(self, summary: str, turns: list[Turn]) -> str:
+        lines = summary.splitlines() if summary else []
+        lines.extend(describe_turn(turn) for turn in turns)
+
+        tokens = sum(estimate_tokens(line) + 1 for line in lines)
+        start = 0
+        while tokens > self._max_tokens and start < len(lines) - 1:
+            tokens -= estimate_tokens(lines[start]) + 1
+            start += 1
+        return "\n".join(lines[start:])
+
+
+class ModelSummarizer:
+    """Summarizes turns by asking an LLM, ideally a small and cheap one, to
+    update the previous summary with them. Falls back to `fallback` if the LLM
+    call fails."""
+
+    def __init__(self, client: LLMClient, max_tokens: int = 500, fallback: Optional[Summarizer] = None):
+        self._client = client
+        self._max_tokens = max_tokens
+        self._fallback = fallback or HeuristicSummarizer(max_tokens)
+
+    def __call__(self, summary: str, turns: list[Turn]) -> str:
+        prompt = Template(prompts.history_summary_prompt).safe_substitute(
+            SUMMARY=summary or "None yet.",
+            TURNS="\n".join(describe_turn(turn) for turn in turns),
+            # Words are about 4/3 tokens.
+            MAX_WORDS=self._max_tokens * 3 // 4,
+        )
+        try:
+            response = self._client.get_chat_completion([{"role": "user", "content": prompt}])
+            updated = parse_action_from_response(response)["message"]
+        except Exception as e:
+            print(f"Error summarizing history: {message_with_details(e)}")
+            return self._fallback(summary, turns)
+        if not updated:
+            return self._fallback(summary, turns)
+        return truncate_to_tokens(updated.strip(), self._max_tokens)
+
+
+class HistoryEntry:
+    """A message in the history. Stored with `__slots__` rather than as a dict
+    to keep long histories small."""
+
+    __slots__ = ("role", "content")
+
+    def __init__(self, role: str, content: str):
+        self.role = role
+        self.content = content
+
+    def as_message(self) -> Message:
+        return {"role": self.role, "content": self.content}
+
+
+class _TurnRecord:
+    __slots__ = ("entries", "tokens")
+
+    def __init__(self, entries: tuple[HistoryEntry, ...], tokens: int):
+        self.entries = entries
+        self.tokens = tokens
+
+    def as_turn(self) -> Turn:
+        return [entry.as_message() for entry in self.entries]
+
+
+class History:
+    """The conversation history of one participant, kept within a token budget.
+
+    `messages()` returns the most recent turns that fit in `budget` tokens,
+    preceded by a summary of the turns before them. When the history grows past
+    the budget, or past `max_turns` turns, the oldest turns are evicted until it
+    fills `low_water` of the budget again, and folded into the running summary
+    by `summarizer`.
+
+    Evicting several turns at once means the summarizer only runs every few
+    turns, and the summary is only ever updated, never regenerated from the
+    whole history, so the cost of keeping it stays the same however long the
+    challenge runs. Turns are kept in a ring buffer, so memory use is bounded
+    too. To keep a full record of the conversation, pass `spill_path`: evicted
+    turns are appended to that file as JSON lines.
+
+    Pass an `executor` to run the summarizer on it instead of in `append`, so
+    that recording a turn never waits for a slow summarizer such as a
+    `ModelSummarizer`. Evicted turns stay in `messages()` until the summary
+    that includes them is ready.
+    """
+
+    def __init__(
+        self,
+        budget: int = 3000,
+        summarizer: Optional[Summarizer] = None,
+        low_water: float = 0.75,
+        max_turns: int = 64,
+        spill_path: Optional[str] = None,
+        executor: Optional[Executor] = None,
+    ):
+        self.budget = budget
+        self._summarizer = summarizer or HeuristicSummarizer(budget // 4)
+        self._low_water = low_water
+        self._max_turns = max_turns
+        self._spill_path = spill_path
+        self._executor = executor
+        self._turns: deque[_TurnRecord] = deque()
+        # Evicted turns that haven't been folded into the summary yet.
+        self._unfolded: list[_TurnRecord] = []
+        self._folding = False
+        self._tokens = 0
+        self._summary = ""
+        self._summary_message: Optional[Message] = None
+        self._lock = threading.Lock()
+
+    def append(self, *turn: Message) -> None:
+        """Records the messages of one turn."""
+        # A single message must not be able to crowd out everything else.
+        max_message_tokens = self.budget // 2
+        entries = tuple(
+            HistoryEntry(message["role"], truncate_to_tokens(message["content"], max_message_tokens))
+            for message in turn
+        )
+        record = _TurnRecord(entries, sum(estimate_message_tokens(entry.as_message()) for entry in entries))
+
+        with self._lock:
+            self._turns.append(record)
+            self._tokens += record.tokens
+            evicted = self._evict()
+            self._unfolded.extend(evicted)
+            # A fold that is already running picks up the new turns when it's
+            # done.
+            start = bool(evicted) and not self._folding
+            if start:
+                self._folding = True
+
+        if start:
+            if self._executor:
+                self._executor.submit(self._fold)
+            else:
+                self._fold()
+
+    def _evict(self) -> list[_TurnRecord]:
+        summary_tokens = estimate_message_tokens(self._summary_message) if self._summary_message else 0
+        if self._tokens + summary_tokens <= self.budget and len(self._turns) <= self._max_turns:
+            return []
+
+        target = self.budget * self._low_water - summary_tokens
+        max_turns = max(1, int(self._max_turns * self._low_water))
+        evicted = []
+        # Always keep the newest turn.
+        while len(self._turns) > 1 and (self._tokens > target or len(self._turns) > max_turns):
+            record = self._turns.popleft()
+            self._tokens -= record.tokens
+            evicted.append(record)
+        return evicted
+
+    def _fold(self) -> None:
+        """Folds the unfolded turns into the summary until there are none
+        left."""
+        while True:
+            with self._lock:
+                records = list(self._unfolded)
+                if not records:
+                    self._folding = False
+                    return
+                summary = self._summary
+
+            turns = [record.as_turn() for record in records]
+            if self._spill_path:
+                self._spill(turns)
+            try:
+                summary = self._summarizer(summary, turns)
+            except Exception as e:
+                # Keep the previous summary rather than retrying forever.
+                print(f"Error summarizing history: {message_with_details(e)}")
+
+            with self._lock:
+                del self._unfolded[: len(records)]
+                self._summary = summary
+                # Sent as a user message so that it doesn't become part of the
+                # static system prefix, which is cached.
+                self._summary_message = {"role": "user", "content": f"Summary of earlier turns:\n{summary}"}
+
+    def _spill(self, turns: list[Turn]) -> None:
+        assert self._spill_path
+        now = time.time()
+        try:
+            with open(self._spill_path, "a", encoding="utf-8") as file:
+                for turn in turns:
+                    file.write(json.dumps({"time": now, "messages": turn}) + "\n")
+        except OSError as e:
+            print(f"Error writing history to {self._spill_path}: {e}")
+
+    @property
+    def summary(self) -> str:
+        return self._summary
+
+    def messages(self) -> list[Message]:
+        """Returns the summary message, if any, followed by the messages of the
+        turns in the window, oldest first, including evicted turns that are
+        still being summarized."""
+        with self._lock:
+            result = [self._summary_message] if self._summary_message else []
+            for record in itertools.chain(self._unfolded, self._turns):
+                result.extend(entry.as_message() for entry in record.entries)
+            return result
+
+    def contains(self, content: str) -> bool:
+        """Whether `messages()` includes a message with exactly this content,
+        i.e. one that has been neither truncated nor folded into the summary."""
+        with self._lock:
+            return any(
+                entry.content == content
+                for record in itertools.chain(self._unfolded, self._turns)
+                for entry in record.entries
+            )
+
+    def __len__(self) -> int:
+        return len(self._turns)
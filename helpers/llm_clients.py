@@ -1,12 +1,49 @@
+import ast
+import asyncio
+import contextlib
+import contextvars
+import copy
+import hashlib
+import heapq
+import itertools
 import json
 import os
-import textwrap
+import random
+import re
 import threading
-from typing import Any, Protocol, cast, Optional
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Collection, Callable, Coroutine, Iterator, Protocol, TypeVar, cast, Optional, Union
 
-import requests
 from kradle import JSON_RESPONSE_FORMAT, KradleAPI, OnEventResponse
 
+from helpers.metrics import LatencyHistogram, metrics
+from helpers.response_cache import MemoryCacheBackend, ResponseCacheBackend
+from helpers.tokens import estimate_messages_tokens
+from helpers.transport import (
+    AsyncHTTPTransport,
+    HTTPTransport,
+    TransportError,
+    shared_async_transport,
+    shared_transport,
+)
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+T = TypeVar("T")
+
+# The Minecraft event that the current completion is being made for. Event
+# handlers set this so that client wrappers can behave differently per event
+# type without changing the `LLMClient` protocol.
+current_event: ContextVar[Optional[str]] = ContextVar("current_event", default=None)
+
+# The in-game name of the participant that the current completion is being
+# made for. `SingleflightClient` uses it to recognize prompts that only differ
+# in whose name they mention.
+current_participant_name: ContextVar[Optional[str]] = ContextVar("current_participant_name", default=None)
+
 
 class LLMError(Exception):
     """An error that occurs when interacting with an LLM."""
@@ -17,6 +54,37 @@ class LLMError(Exception):
         self.content = content
 
 
+class ProviderError(LLMError):
+    """An error talking to the LLM provider's API, as opposed to a problem with
+    the content that the LLM generated.
+
+    `status_code` is the HTTP status, or None if the provider couldn't be
+    reached. `retry_after` is how long the provider asked us to wait before
+    retrying, in seconds, if it said.
+    """
+
+    def __init__(
+        self,
+        message: str,
+        details: Optional[str] = None,
+        status_code: Optional[int] = None,
+        retry_after: Optional[float] = None,
+    ):
+        super().__init__(message, details)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        """Whether the same request might succeed later: network errors, rate
+        limits, timeouts and server errors."""
+        return self.status_code is None or self.status_code in (408, 409, 425, 429) or self.status_code >= 500
+
+
+class CircuitOpenError(ProviderError):
+    """Raised instead of calling a provider whose circuit breaker is open."""
+
+
 def message_with_details(error: Exception) -> str:
     """Returns a string representation of an error, including details if available."""
     if isinstance(error, LLMError) and error.details:
@@ -25,6 +93,80 @@ def message_with_details(error: Exception) -> str:
         return str(error)
 
 
+@contextlib.contextmanager
+def _provider_errors() -> Iterator[None]:
+    """Re-raises transport failures as `ProviderError`s."""
+    try:
+        yield
+    except TransportError as e:
+        raise ProviderError(str(e), e.body, e.status_code, e.retry_after) from e
+
+
+def _translated_lines(lines: Iterator[str]) -> Iterator[str]:
+    with _provider_errors():
+        yield from lines
+
+
+async def _async_translated_lines(lines: AsyncIterator[str]) -> AsyncIterator[str]:
+    with _provider_errors():
+        async for line in lines:
+            yield line
+
+
+class TokenUsage:
+    """Token counts reported by an LLM API for one or more completions.
+
+    `cached_tokens` is the part of `prompt_tokens` that the provider served
+    from its prompt cache.
+    """
+
+    def __init__(self, prompt_tokens: int = 0, completion_tokens: int = 0, cached_tokens: int = 0):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cached_tokens = cached_tokens
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def __add__(self, other: "TokenUsage") -> "TokenUsage":
+        return TokenUsage(
+            self.prompt_tokens + other.prompt_tokens,
+            self.completion_tokens + other.completion_tokens,
+            self.cached_tokens + other.cached_tokens,
+        )
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cache_hit_ratio": round(self.cache_hit_ratio, 4),
+        }
+
+
+def parse_usage(raw_response: dict[str, Any]) -> Optional[TokenUsage]:
+    """Extracts token usage from a raw OpenRouter (OpenAI-style) or Ollama
+    response, or returns None if it doesn't report any."""
+    usage = raw_response.get("usage")
+    if isinstance(usage, dict):
+        details = usage.get("prompt_tokens_details") or {}
+        cached = details.get("cached_tokens") or usage.get("cache_read_input_tokens") or 0
+        return TokenUsage(
+            prompt_tokens=int(usage.get("prompt_tokens") or 0),
+            completion_tokens=int(usage.get("completion_tokens") or 0),
+            cached_tokens=int(cached),
+        )
+
+    if "prompt_eval_count" in raw_response or "eval_count" in raw_response:
+        return TokenUsage(
+            prompt_tokens=int(raw_response.get("prompt_eval_count") or 0),
+            completion_tokens=int(raw_response.get("eval_count") or 0),
+        )
+
+    return None
+
+
 class LLMResponse:
     """The response from an LLM.
 
@@ -36,6 +178,48 @@ class LLMResponse:
     def __init__(self, content: str, raw_response: dict[str, Any]):
         self.content = content
         self.raw_response = raw_response
+        # The repair `parse_action_from_response` had to apply to the content,
+        # if any.
+        self.repair: Optional[str] = None
+
+    @property
+    def usage(self) -> Optional[TokenUsage]:
+        """The token usage reported by the provider, if any."""
+        return parse_usage(self.raw_response)
+
+
+# The fields of raw OpenRouter and Ollama responses that report token usage.
+_USAGE_FIELDS = ("usage", "prompt_eval_count", "eval_count")
+
+
+def without_usage(raw_response: dict[str, Any]) -> dict[str, Any]:
+    """Returns a copy of a raw response without its token usage, for responses
+    that are reused rather than paid for again, so that they aren't counted
+    twice."""
+    return {key: copy.deepcopy(value) for key, value in raw_response.items() if key not in _USAGE_FIELDS}
+
+
+def with_cache_breakpoint(messages: list[dict[str, str]]) -> list[dict[str, Any]]:
+    """Marks the static prefix of a prompt as cacheable by the provider.
+
+    The prefix is the run of system messages at the start of the prompt. The
+    last of them gets an ephemeral `cache_control` breakpoint, which providers
+    that support prompt caching (e.g. Anthropic and Gemini through OpenRouter)
+    use to cache everything up to that point. The messages passed in are not
+    modified.
+    """
+    prefix_length = 0
+    while prefix_length < len(messages) and messages[prefix_length]["role"] == "system":
+        prefix_length += 1
+    if prefix_length == 0:
+        return list(messages)
+
+    last = messages[prefix_length - 1]
+    marked = {
+        **last,
+        "content": [{"type": "text", "text": last["content"], "cache_control": {"type": "ephemeral"}}],
+    }
+    return [*messages[: prefix_length - 1], marked, *messages[prefix_length:]]
 
 
 class LLMClient(Protocol):
@@ -56,39 +240,396 @@ class LLMClient(Protocol):
         ...
 
 
-class OpenRouterClient(LLMClient):
-    """An LLM client that uses the OpenRouter API."""
+class AsyncLLMClient(Protocol):
+    async def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        """The asyncio counterpart of `LLMClient.get_chat_completion`.
+
+        Awaiting the completion frees the event loop to drive other
+        participants while the LLM is thinking.
+        """
+        ...
+
+
+class IncrementalJSONParser:
+    """Parses the top-level string fields of a JSON object as its text arrives
+    in chunks, so that a field can be used as soon as its value is complete.
 
-    def __init__(self, model: str, api: KradleAPI):
-        self._model = model
+    Text before the opening brace (such as a code fence) is skipped, and values
+    that are not strings are skipped without being decoded.
+    """
 
-        # Look for OpenRouter API key in environment variables, falling back to
-        # Kradle API if not found.
-        api_key = os.getenv("OPENROUTER_API_KEY")
-        if api_key is None or len(api_key) < 20:
-            human = api.humans.get()
-            api_key = cast(Optional[str], human["openRouterKey"])
-        if api_key is None:
-            raise LLMError("OPENROUTER_API_KEY is not set")
-        self._api_key: str = api_key
+    def __init__(self):
+        # The decoded values of the string fields completed so far.
+        self.fields: dict[str, str] = {}
 
-    def get_chat_completion(
+        self._state = "start"
+        self._buffer: list[str] = []
+        self._escape = False
+        self._key = ""
+        self._depth = 0
+        self._in_nested_string = False
+
+    @property
+    def done(self) -> bool:
+        """Whether the closing brace of the object has been seen."""
+        return self._state == "done"
+
+    def feed(self, text: str) -> list[str]:
+        """Parses the next chunk of text and returns the names of the fields
+        whose values were completed by it."""
+        completed = []
+        for char in text:
+            state = self._state
+            if state == "start":
+                if char == "{":
+                    self._state = "key_or_end"
+            elif state == "key_or_end":
+                if char == '"':
+                    self._buffer = []
+                    self._state = "key"
+                elif char == "}":
+                    self._state = "done"
+            elif state in ("key", "string_value"):
+                if self._escape:
+                    self._buffer.append(char)
+                    self._escape = False
+                elif char == "\\":
+                    self._buffer.append(char)
+                    self._escape = True
+                elif char == '"':
+                    # strict=False tolerates raw newlines, which models often
+                    # leave in code.
+                    value = json.loads('"' + "".join(self._buffer) + '"', strict=False)
+                    if state == "key":
+                        self._key = value
+                        self._state = "colon"
+                    else:
+                        self.fields[self._key] = value
+                        completed.append(self._key)
+                        self._state = "comma_or_end"
+                else:
+                    self._buffer.append(char)
+            elif state == "colon":
+                if char == ":":
+                    self._state = "value"
+            elif state == "value":
+                if char == '"':
+                    self._buffer = []
+                    self._state = "string_value"
+                elif not char.isspace():
+                    self._depth = 0
+                    self._in_nested_string = False
+                    self._state = "other_value"
+                    self._skip_other_value(char)
+            elif state == "other_value":
+                self._skip_other_value(char)
+            elif state == "comma_or_end":
+                if char == ",":
+                    self._state = "key_or_end"
+                elif char == "}":
+                    self._state = "done"
+        return completed
+
+    def _skip_other_value(self, char: str) -> None:
+        if self._in_nested_string:
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_nested_string = False
+        elif char == '"':
+            self._in_nested_string = True
+        elif char in "[{":
+            self._depth += 1
+        elif char in "]}":
+            if self._depth == 0:
+                self._state = "done"
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._state = "comma_or_end"
+        elif char == "," and self._depth == 0:
+            self._state = "key_or_end"
+
+
+class _StreamState:
+    """Accumulates the chunks of a streamed completion."""
+
+    def __init__(self):
+        self._parser = IncrementalJSONParser()
+        self._content: list[str] = []
+        self._raw_response: dict[str, Any] = {}
+
+    def _consume(self, chunk: tuple[str, dict[str, Any]]) -> None:
+        text, raw_response = chunk
+        self._content.append(text)
+        self._raw_response = raw_response
+        self._parser.feed(text)
+
+    def _early_action(self) -> Optional[OnEventResponse]:
+        fields = self._parser.fields
+        if "code" not in fields:
+            return None
+        # Only include the message if it is already complete; a half-written
+        # chat message is worse than none.
+        return OnEventResponse(code=fields["code"], message=fields.get("message", ""))
+
+    def _response(self) -> LLMResponse:
+        return LLMResponse(content="".join(self._content), raw_response=self._raw_response)
+
+
+class CompletionStream(_StreamState):
+    """A streaming completion.
+
+    Call `early_action` to get the action as soon as its `code` field has been
+    generated, then `response` to wait for the rest of the completion. The raw
+    response of the result is the last chunk received from the provider.
+
+    Client wrappers can pass `on_done` to be called with the full response once
+    the stream has been read to the end, or with None if reading it failed or
+    it was closed. A wrapper can pass its delegate's stream as `chunks` to
+    return a new stream over the chunks it has left; closing the new stream
+    closes the delegate's.
+    """
+
+    def __init__(
+        self,
+        chunks: Union[Iterator[tuple[str, dict[str, Any]]], "CompletionStream"],
+        on_done: Optional[Callable[[Optional[LLMResponse]], None]] = None,
+    ):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._source = chunks
+        self._opened = False
+        self._on_done = on_done
+
+    def __iter__(self) -> Iterator[tuple[str, dict[str, Any]]]:
+        return self._read()
+
+    def _read(self) -> Iterator[tuple[str, dict[str, Any]]]:
+        try:
+            for chunk in self._chunks:
+                self._consume(chunk)
+                yield chunk
+        except GeneratorExit:
+            # The reader stopped early, e.g. at the early action; the rest of
+            # the stream is read later.
+            raise
+        except BaseException:
+            self._finish(None)
+            raise
+        self._finish(self._response())
+
+    def _finish(self, response: Optional[LLMResponse]) -> None:
+        on_done, self._on_done = self._on_done, None
+        if on_done is not None:
+            on_done(response)
+
+    def close(self) -> None:
+        """Stops reading the stream, releasing its connection."""
+        close = getattr(self._source, "close", None)
+        if close is not None:
+            close()
+        self._finish(None)
+
+    def open(self) -> "CompletionStream":
+        """Waits for the first chunk, so that a failure to make the request is
+        raised here rather than while reading the stream. Returns the stream."""
+        if not self._opened:
+            self._opened = True
+            first = next(self._chunks, None)
+            if first is not None:
+                self._chunks = itertools.chain([first], self._chunks)
+        return self
+
+    def early_action(self) -> Optional[OnEventResponse]:
+        """Reads the stream until the `code` field is complete and returns the
+        action generated so far, or None if the stream ended without one."""
+        for _ in self._read():
+            action = self._early_action()
+            if action is not None:
+                return action
+        return self._early_action()
+
+    def response(self) -> LLMResponse:
+        """Reads the rest of the stream and returns the full response."""
+        for _ in self._read():
+            pass
+        return self._response()
+
+
+def completed_stream(response: LLMResponse) -> CompletionStream:
+    """Returns a stream of a response that is already complete, e.g. one from
+    a cache, as a single chunk."""
+    return CompletionStream(iter([(response.content, response.raw_response)]))
+
+
+async def _prepended(first: T, rest: AsyncIterator[T]) -> AsyncIterator[T]:
+    yield first
+    async for item in rest:
+        yield item
+
+
+class AsyncCompletionStream(_StreamState):
+    """The asyncio version of `CompletionStream`."""
+
+    def __init__(self, chunks: AsyncIterator[tuple[str, dict[str, Any]]]):
+        super().__init__()
+        self._chunks = chunks
+        self._opened = False
+
+    def __aiter__(self) -> AsyncIterator[tuple[str, dict[str, Any]]]:
+        """Iterates over the chunks that haven't been read yet."""
+        return self._chunks
+
+    async def open(self) -> "AsyncCompletionStream":
+        """The asyncio version of `CompletionStream.open`."""
+        if not self._opened:
+            self._opened = True
+            first = await anext(self._chunks, None)
+            if first is not None:
+                self._chunks = _prepended(first, self._chunks)
+        return self
+
+    async def early_action(self) -> Optional[OnEventResponse]:
+        async for chunk in self._chunks:
+            self._consume(chunk)
+            action = self._early_action()
+            if action is not None:
+                return action
+        return self._early_action()
+
+    async def response(self) -> LLMResponse:
+        async for chunk in self._chunks:
+            self._consume(chunk)
+        return self._response()
+
+
+class StreamingLLMClient(LLMClient, Protocol):
+    def stream_chat_completion(
         self,
         messages: list[dict[str, str]],
-    ) -> LLMResponse:
-        request = {
+    ) -> CompletionStream:
+        """Starts a streaming completion for the given messages."""
+        ...
+
+
+class AsyncStreamingLLMClient(AsyncLLMClient, Protocol):
+    def stream_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> AsyncCompletionStream:
+        """Starts a streaming completion for the given messages."""
+        ...
+
+
+# How long an OpenRouter key fetched from Kradle is used before it's fetched
+# again, in seconds.
+OPENROUTER_KEY_TTL = 3600.0
+
+# OpenRouter keys fetched from Kradle and when they were fetched, by Kradle API
+# key.
+_openrouter_keys: dict[Optional[str], tuple[str, float]] = {}
+_openrouter_keys_lock = threading.Lock()
+
+
+def openrouter_api_key(api: KradleAPI, ttl: float = OPENROUTER_KEY_TTL) -> str:
+    """Returns the OpenRouter API key to use: OPENROUTER_API_KEY if it is set,
+    or else the key of the Kradle account.
+
+    The Kradle account's key is fetched at most once every `ttl` seconds per
+    process; callers that need it while it's being fetched wait for that fetch
+    instead of making their own.
+    """
+    api_key = os.getenv("OPENROUTER_API_KEY")
+    if api_key is not None and len(api_key) >= 20:
+        return api_key
+
+    cached = _openrouter_keys.get(api.api_key)
+    if cached is not None and time.monotonic() - cached[1] < ttl:
+        return cached[0]
+    with _openrouter_keys_lock:
+        cached = _openrouter_keys.get(api.api_key)
+        if cached is not None and time.monotonic() - cached[1] < ttl:
+            return cached[0]
+        human = api.humans.get()
+        api_key = cast(Optional[str], human["openRouterKey"])
+        if api_key is None:
+            raise LLMError("OPENROUTER_API_KEY is not set")
+        _openrouter_keys[api.api_key] = (api_key, time.monotonic())
+        return api_key
+
+
+def openrouter_url() -> str:
+    """Returns the chat completions endpoint that OpenRouter clients use by
+    default: the OPENROUTER_API_URL environment variable, if it's set, or
+    OpenRouter's."""
+    return os.getenv("OPENROUTER_API_URL") or OPENROUTER_URL
+
+
+class _OpenRouterBase:
+    """Request building and response parsing shared by the sync and async
+    OpenRouter clients.
+
+    Args:
+        model: The OpenRouter model ID.
+        api: The Kradle API, used to look up the OpenRouter key if it isn't
+            set in the environment.
+        prompt_caching: Whether to mark the static system prefix of each
+            prompt as cacheable (see `with_cache_breakpoint`) and ask
+            OpenRouter to report cached token counts.
+        url: The chat completions endpoint, e.g. to point at a local server.
+            Defaults to the OPENROUTER_API_URL environment variable, or
+            OpenRouter's endpoint if it isn't set.
+    """
+
+    def __init__(self, model: str, api: KradleAPI, prompt_caching: bool = False, url: Optional[str] = None):
+        self._model = model
+        self._prompt_caching = prompt_caching
+        self._url = url or openrouter_url()
+
+        # Resolve the key now, so that a missing key is reported when the
+        # client is created. It's looked up again for each request, which is
+        # cheap, so that a key fetched from Kradle is refreshed once it expires.
+        self._api = api
+        openrouter_api_key(api)
+
+    @property
+    def model(self) -> str:
+        return self._model
+
+    def _make_request(self, messages: list[dict[str, str]], stream: bool = False) -> dict[str, Any]:
+        request: dict[str, Any] = {
             "model": self._model,
             "messages": messages,
             "require_parameters": True,
             "response_format": JSON_RESPONSE_FORMAT,
         }
+        if self._prompt_caching:
+            request["messages"] = with_cache_breakpoint(messages)
+            request["usage"] = {"include": True}
+        if stream:
+            request["stream"] = True
+        return request
 
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={"Authorization": f"Bearer {self._api_key}"},
-            json=request,
-            timeout=30,
-        ).json()
+    def _make_headers(self) -> dict[str, str]:
+        return {"Authorization": f"Bearer {openrouter_api_key(self._api)}"}
+
+    def _parse_response(self, response: Any) -> LLMResponse:
+        # OpenRouter reports some provider failures, like rate limits from the
+        # upstream provider, in the body of a successful response.
+        error = response.get("error") if isinstance(response, dict) else None
+        if isinstance(error, dict):
+            code = error.get("code")
+            raise ProviderError(
+                "OpenRouter returned an error",
+                f"Full response: {response}",
+                status_code=code if isinstance(code, int) else None,
+            )
 
         if "choices" not in response or not response["choices"]:
             raise LLMError(
@@ -101,9 +642,117 @@ class OpenRouterClient(LLMClient):
             raw_response=response,
         )
 
+    def _parse_stream_line(self, line: str) -> Optional[tuple[str, dict[str, Any]]]:
+        # OpenRouter streams server-sent events. Lines starting with ":" are
+        # keep-alive comments.
+        if not line.startswith("data:"):
+            return None
+        data = line[len("data:") :].strip()
+        if data == "[DONE]":
+            return None
+
+        chunk = json.loads(data)
+        if "error" in chunk:
+            raise LLMError("Error while streaming response from LLM", f"Chunk: {chunk}")
+        if not chunk.get("choices"):
+            return "", chunk
+        return chunk["choices"][0].get("delta", {}).get("content") or "", chunk
+
+
+class OpenRouterClient(_OpenRouterBase, LLMClient):
+    """An LLM client that uses the OpenRouter API.
+
+    Requests go through a pooled `HTTPTransport` that is shared by every client
+    talking to OpenRouter in this process, unless a `transport` is given.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        api: KradleAPI,
+        transport: Optional[HTTPTransport] = None,
+        prompt_caching: bool = False,
+        url: Optional[str] = None,
+    ):
+        super().__init__(model, api, prompt_caching, url)
+        self._transport = transport or shared_transport(self._url)
+
+    def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        with _provider_errors():
+            response = self._transport.post_json(
+                self._url,
+                headers=self._make_headers(),
+                json=self._make_request(messages),
+                timeout=30,
+            )
+        return self._parse_response(response)
+
+    def stream_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> CompletionStream:
+        lines = self._transport.stream_lines(
+            self._url,
+            headers=self._make_headers(),
+            json=self._make_request(messages, stream=True),
+            timeout=30,
+        )
+        return CompletionStream(chunk for line in _translated_lines(lines) if (chunk := self._parse_stream_line(line)))
+
+
+class AsyncOpenRouterClient(_OpenRouterBase, AsyncLLMClient):
+    """The asyncio version of `OpenRouterClient`.
+
+    All instances share one `AsyncHTTPTransport` for OpenRouter unless a
+    `transport` is given, so they should be used from a single event loop (see
+    `background_loop`).
+    """
+
+    def __init__(
+        self,
+        model: str,
+        api: KradleAPI,
+        transport: Optional[AsyncHTTPTransport] = None,
+        prompt_caching: bool = False,
+        url: Optional[str] = None,
+    ):
+        super().__init__(model, api, prompt_caching, url)
+        self._transport = transport or shared_async_transport(self._url)
+
+    async def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        with _provider_errors():
+            response = await self._transport.post_json(
+                self._url,
+                headers=self._make_headers(),
+                json=self._make_request(messages),
+                timeout=30,
+            )
+        return self._parse_response(response)
+
+    def stream_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> AsyncCompletionStream:
+        lines = self._transport.stream_lines(
+            self._url,
+            headers=self._make_headers(),
+            json=self._make_request(messages, stream=True),
+            timeout=30,
+        )
+        return AsyncCompletionStream(
+            chunk async for line in _async_translated_lines(lines) if (chunk := self._parse_stream_line(line))
+        )
+
 
-class OllamaClient:
-    """An LLM client that uses the Ollama API."""
+class _OllamaBase:
+    """Request building and response parsing shared by the sync and async
+    Ollama clients."""
 
     def __init__(self, model: str):
         self._model = model
@@ -113,25 +762,21 @@ class OllamaClient:
             raise LLMError("OLLAMA_API_URL is not set")
         self._url = url
 
-    def get_chat_completion(
-        self,
-        messages: list[dict[str, str]],
-    ) -> LLMResponse:
+    @property
+    def model(self) -> str:
+        return self._model
+
+    def _make_request(self, messages: list[dict[str, str]], stream: bool = False) -> dict[str, Any]:
         schema = cast(Any, JSON_RESPONSE_FORMAT)["json_schema"]["schema"]
-        request = {
+        return {
             "model": self._model,
             "messages": messages,
             "format": schema,
-            "stream": False,
+            "stream": stream,
             "keep_alive": -1,  # prevent model from timing out of cache,
         }
 
-        response = requests.post(
-            self._url,
-            json=request,
-            timeout=30,
-        ).json()
-
+    def _parse_response(self, response: Any) -> LLMResponse:
         if "message" not in response:
             raise LLMError(
                 "Cannot parse response from Ollama",
@@ -143,47 +788,1373 @@ class OllamaClient:
             raw_response=response,
         )
 
+    def _parse_stream_line(self, line: str) -> Optional[tuple[str, dict[str, Any]]]:
+        # Ollama streams one JSON object per line.
+        if not line.strip():
+            return None
 
-class WaitingClient:
+        chunk = json.loads(line)
+        if "error" in chunk:
+            raise LLMError("Error while streaming response from Ollama", f"Chunk: {chunk}")
+        return chunk.get("message", {}).get("content") or "", chunk
+
+
+class OllamaClient(_OllamaBase):
+    """An LLM client that uses the Ollama API.
+
+    Like `OpenRouterClient`, requests share a pooled `HTTPTransport` per Ollama
+    host unless a `transport` is given.
+    """
+
+    def __init__(self, model: str, transport: Optional[HTTPTransport] = None):
+        super().__init__(model)
+        self._transport = transport or shared_transport(self._url)
+
+    def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        with _provider_errors():
+            response = self._transport.post_json(
+                self._url,
+                json=self._make_request(messages),
+                timeout=30,
+            )
+        return self._parse_response(response)
+
+    def stream_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> CompletionStream:
+        lines = self._transport.stream_lines(
+            self._url,
+            json=self._make_request(messages, stream=True),
+            timeout=30,
+        )
+        return CompletionStream(chunk for line in _translated_lines(lines) if (chunk := self._parse_stream_line(line)))
+
+
+class AsyncOllamaClient(_OllamaBase):
+    """The asyncio version of `OllamaClient`."""
+
+    def __init__(self, model: str, transport: Optional[AsyncHTTPTransport] = None):
+        super().__init__(model)
+        self._transport = transport or shared_async_transport(self._url)
+
+    async def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        with _provider_errors():
+            response = await self._transport.post_json(
+                self._url,
+                json=self._make_request(messages),
+                timeout=30,
+            )
+        return self._parse_response(response)
+
+    def stream_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> AsyncCompletionStream:
+        lines = self._transport.stream_lines(
+            self._url,
+            json=self._make_request(messages, stream=True),
+            timeout=30,
+        )
+        return AsyncCompletionStream(
+            chunk async for line in _async_translated_lines(lines) if (chunk := self._parse_stream_line(line))
+        )
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def background_loop() -> asyncio.AbstractEventLoop:
+    """Returns a process-wide event loop running in a daemon thread.
+
+    Synchronous code, such as Kradle event handlers, can submit coroutines to
+    this loop with `run_sync`, so that a single loop drives the LLM requests of
+    every participant in the process.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="llm-event-loop", daemon=True).start()
+            _loop = loop
+        return _loop
+
+
+def run_sync(coroutine: Coroutine[Any, Any, T]) -> T:
+    """Runs a coroutine on the `background_loop` and blocks until it is done."""
+    return asyncio.run_coroutine_threadsafe(coroutine, background_loop()).result()
+
+
+class SyncClientAdapter:
+    """Adapts an `AsyncLLMClient` to the synchronous `LLMClient` protocol, so
+    async clients can be used with existing agents and wrappers unchanged.
+
+    Completions run on the shared `background_loop`.
+    """
+
+    def __init__(self, delegate: AsyncLLMClient):
+        self._delegate = delegate
+
+    def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        return run_sync(self._delegate.get_chat_completion(messages))
+
+
+class AsyncClientAdapter:
+    """Adapts a synchronous `LLMClient` to the `AsyncLLMClient` protocol by
+    running each completion in a worker thread.
+
+    This lets async event handlers use any existing client or wrapper, at the
+    cost of the thread that the sync client blocks.
+    """
+
+    def __init__(self, delegate: LLMClient):
+        self._delegate = delegate
+
+    async def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        return await asyncio.to_thread(self._delegate.get_chat_completion, messages)
+
+
+def superseded_response() -> LLMResponse:
+    """Returns the placeholder response that `CoalescingClient` gives to callers
+    whose request was replaced by a newer one. See `is_superseded`."""
+    return LLMResponse('{"code": "", "message": ""}', {"superseded": True})
+
+
+def is_superseded(response: LLMResponse) -> bool:
+    """Whether a response is a placeholder for a request that was dropped in
+    favor of a newer one, and so should not be acted on or recorded."""
+    return response.raw_response.get("superseded") is True
+
+
+class CoalescingClient:
     """An LLM client that you can overlay on top of another `LLMClient` to
-    prevent interruptions while waiting for a response.
+    make sure there's only one request in flight at a time, always answering
+    the latest game state.
 
     This is useful if you want to use a slow LLM that might take a while to
     respond, and you don't want to overwhelm the LLM with requests while it's
-    thinking.
+    thinking. While a request is in flight, only the most recent new request
+    is kept waiting; it runs as soon as the current one finishes. Any older
+    waiting request is dropped and gets a `superseded_response()`.
+
+    Use one instance per participant.
     """
 
     def __init__(self, delegate: LLMClient):
         self._delegate = delegate
+        self._condition = threading.Condition()
+        self._busy = False
+        # The ticket of the request waiting for its turn, if any.
+        self._waiting: Optional[int] = None
+        self._next_ticket = 0
+
+        self._calls = 0
+        self._followups = 0
+        self._dropped = 0
+
+    def _take_turn(self) -> bool:
+        """Waits until no request is in flight and marks this one as in flight.
+        Returns False if a newer request replaced this one while it waited."""
+        with self._condition:
+            if self._waiting is not None:
+                # A newer request replaces the one that's waiting.
+                self._dropped += 1
+                self._waiting = None
+                self._condition.notify_all()
+
+            if self._busy:
+                self._next_ticket += 1
+                ticket = self._next_ticket
+                self._waiting = ticket
+                while self._busy and self._waiting == ticket:
+                    self._condition.wait()
+                if self._waiting != ticket:
+                    return False
+                self._waiting = None
+                self._followups += 1
+
+            self._busy = True
+            self._calls += 1
+            return True
+
+    def _release(self, response: Optional[LLMResponse] = None) -> None:
+        with self._condition:
+            self._busy = False
+            self._condition.notify_all()
+
+    def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        if not self._take_turn():
+            return superseded_response()
+        try:
+            return self._delegate.get_chat_completion(messages)
+        finally:
+            self._release()
+
+    def stream_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> CompletionStream:
+        """Like `get_chat_completion`, but the request stays in flight until
+        its stream has been read to the end or closed."""
+        if not self._take_turn():
+            return completed_stream(superseded_response())
+        try:
+            stream = self._delegate.stream_chat_completion(messages).open()
+        except BaseException:
+            self._release()
+            raise
+        return CompletionStream(stream, on_done=self._release)
+
+    def stats(self) -> dict[str, Any]:
+        with self._condition:
+            return {
+                "in_flight": int(self._busy),
+                "queue_depth": int(self._waiting is not None),
+                "calls": self._calls,
+                "followups": self._followups,
+                "dropped": self._dropped,
+            }
+
+
+def client_label(client: Any) -> str:
+    """Returns a name for a client to use in stats: its model, if it has one."""
+    return getattr(client, "model", None) or type(client).__name__
+
+
+_hedge_latencies: dict[str, LatencyHistogram] = {}
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+_hedge_lock = threading.Lock()
+
+
+def hedge_latencies(label: str) -> LatencyHistogram:
+    """Returns the process-wide latency histogram that hedged clients keep for
+    the model with the given label, so that every participant's hedge delay
+    learns from the requests of all of them."""
+    with _hedge_lock:
+        histogram = _hedge_latencies.get(label)
+        if histogram is None:
+            histogram = LatencyHistogram()
+            _hedge_latencies[label] = histogram
+        return histogram
+
+
+def hedge_executor() -> ThreadPoolExecutor:
+    """Returns the thread pool that hedged clients send requests from, shared
+    by every participant. Threads are only started as they're needed."""
+    global _hedge_executor
+    with _hedge_lock:
+        if _hedge_executor is None:
+            # Losing requests keep running until they finish, so leave room for
+            # many overlapping rounds.
+            _hedge_executor = ThreadPoolExecutor(max_workers=256, thread_name_prefix="hedged-llm")
+        return _hedge_executor
+
+
+class HedgedClient:
+    """An LLM client that sends a request to several clients, one after the
+    other, to cut tail latency.
+
+    The request goes to the first client. If no usable response arrives within
+    the hedge delay, a backup request goes to the next client, and so on. The
+    first response that `parse_action_from_response` accepts wins; the others
+    are ignored. A failed request triggers the next backup right away.
+
+    The hedge delay is the `hedge_percentile` of the first client's observed
+    latency, clamped to `[min_delay, max_delay]`. Until `min_samples`
+    latencies have been observed, `initial_delay` is used instead. Latencies
+    are shared by every hedged client in the process (see `hedge_latencies`).
+
+    Args:
+        clients: The clients to try, in order of preference, e.g. the same
+            model through different providers, or a faster fallback model.
+    """
+
+    def __init__(
+        self,
+        clients: list[LLMClient],
+        hedge_percentile: float = 95,
+        initial_delay: float = 2.0,
+        min_delay: float = 0.25,
+        max_delay: float = 10.0,
+        min_samples: int = 20,
+    ):
+        if not clients:
+            raise ValueError("HedgedClient needs at least one client")
+
+        self._clients = clients
+        self._hedge_percentile = hedge_percentile
+        self._initial_delay = initial_delay
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._min_samples = min_samples
+
+        # Label each client by its model, disambiguating duplicates.
+        self._labels = []
+        for index, client in enumerate(clients):
+            label = client_label(client)
+            self._labels.append(label if label not in self._labels else f"{label}#{index}")
+
+        self._latencies = {label: hedge_latencies(label) for label in self._labels}
+        self._first_chunk_latencies = {label: hedge_latencies(f"{label} (first chunk)") for label in self._labels}
+        self._wins = {label: 0 for label in self._labels}
+        self._hedges = 0
         self._lock = threading.Lock()
+        self._executor = hedge_executor()
+
+    def hedge_delay(self, latencies: Optional[dict[str, LatencyHistogram]] = None) -> float:
+        """Returns how long to wait for a response before sending a backup."""
+        histogram = (latencies or self._latencies)[self._labels[0]]
+        delay = histogram.percentile(self._hedge_percentile)
+        if histogram.count < self._min_samples or delay is None:
+            delay = self._initial_delay
+        return min(max(delay, self._min_delay), self._max_delay)
+
+    def _timed(self, index: int, request: Callable[[Any], T], latencies: dict[str, LatencyHistogram]) -> T:
+        start = time.monotonic()
+        result = request(self._clients[index])
+        latencies[self._labels[index]].observe(time.monotonic() - start)
+        return result
+
+    def _submit(self, index: int, request: Callable[[Any], T], latencies: dict[str, LatencyHistogram]) -> Future:
+        # Run in a copy of the caller's context so wrapped clients still see
+        # the current event.
+        context = contextvars.copy_context()
+        return self._executor.submit(context.run, self._timed, index, request, latencies)
+
+    def _race(
+        self,
+        request: Callable[[Any], T],
+        latencies: dict[str, LatencyHistogram],
+        validate: Optional[Callable[[T], Any]] = None,
+        discard: Optional[Callable[[T], None]] = None,
+    ) -> T:
+        delay = self.hedge_delay(latencies)
+        pending = {self._submit(0, request, latencies): 0}
+        next_index = 1
+        last_error: Optional[Exception] = None
+
+        while pending:
+            can_hedge = next_index < len(self._clients)
+            done, _ = wait(pending, timeout=delay if can_hedge else None, return_when=FIRST_COMPLETED)
+
+            if not done:
+                with self._lock:
+                    self._hedges += 1
+                pending[self._submit(next_index, request, latencies)] = next_index
+                next_index += 1
+                continue
+
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    result = future.result()
+                    if validate is not None:
+                        validate(result)
+                except Exception as e:
+                    last_error = e
+                    continue
+
+                for other in [*pending, *(other for other in done if other is not future)]:
+                    if not other.cancel() and discard is not None:
+                        other.add_done_callback(lambda f: discard(f.result()) if f.exception() is None else None)
+                with self._lock:
+                    self._wins[self._labels[index]] += 1
+                return result
+
+            # Every finished request failed; don't wait to try the next client.
+            if not pending and next_index < len(self._clients):
+                pending[self._submit(next_index, request, latencies)] = next_index
+                next_index += 1
+
+        assert last_error is not None
+        raise last_error
 
     def get_chat_completion(
         self,
         messages: list[dict[str, str]],
     ) -> LLMResponse:
-        if not self._lock.acquire(blocking=False):
-            print("Already waiting for LLM response, skipping new request")
-            return LLMResponse(
-                textwrap.dedent("""
-                {
-                    "code": "",
-                    "message": "Ignoring event, I'm already busy thinking",
-                }"""),
-                {},
-            )
+        return self._race(
+            lambda client: client.get_chat_completion(messages),
+            self._latencies,
+            validate=parse_action_from_response,
+        )
+
+    def stream_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> CompletionStream:
+        """Like `get_chat_completion`, but races to open a stream: the first
+        stream whose first chunk arrives wins, and the others are closed. The
+        hedge delay is based on the time to the first chunk, which is tracked
+        separately, and the winning stream is not validated."""
+        return self._race(
+            lambda client: cast(StreamingLLMClient, client).stream_chat_completion(messages).open(),
+            self._first_chunk_latencies,
+            discard=lambda stream: stream.close(),
+        )
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "hedge_delay": self.hedge_delay(),
+                "hedges": self._hedges,
+                "wins": dict(self._wins),
+                "latency": {label: histogram.summary() for label, histogram in self._latencies.items()},
+                "first_chunk_latency": {
+                    label: histogram.summary() for label, histogram in self._first_chunk_latencies.items()
+                },
+            }
+
+
+class Backoff:
+    """Computes how long to wait before retrying a failed request: exponential
+    backoff with full jitter, unless the provider said how long to wait.
+
+    Args:
+        base: The maximum delay before the first retry, in seconds.
+        factor: How much the maximum delay grows with each retry.
+        max_delay: The cap on the computed delay, in seconds.
+        max_retry_after: The cap on delays requested by the provider.
+    """
+
+    def __init__(self, base: float = 0.5, factor: float = 2.0, max_delay: float = 8.0, max_retry_after: float = 30.0):
+        self.base = base
+        self.factor = factor
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Returns the delay before retry number `attempt` (counting from 0)."""
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        return random.uniform(0, min(self.max_delay, self.base * self.factor**attempt))
+
+
+class CircuitBreaker:
+    """Stops sending requests to a provider that keeps failing.
+
+    After `failure_threshold` consecutive failures the breaker opens and
+    `allow()` returns False. After `reset_timeout` seconds it lets a single
+    trial request through (half-open); if that succeeds the breaker closes
+    again, otherwise it stays open for another `reset_timeout`.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """Whether a request may be sent now."""
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+_circuit_breakers: dict[str, CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
 
+
+def circuit_breaker(client: Any) -> CircuitBreaker:
+    """Returns the process-wide circuit breaker for a client's provider and
+    model, so that every participant sees the same provider health."""
+    key = f"{type(client).__name__}:{client_label(client)}"
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker()
+            _circuit_breakers[key] = breaker
+        return breaker
+
+
+class _ResilientBase:
+    """The retry, circuit breaker and failover bookkeeping shared by the sync
+    and async resilient clients."""
+
+    def __init__(
+        self,
+        delegate: Any,
+        fallback: Any = None,
+        max_attempts: int = 4,
+        max_elapsed: float = 20.0,
+        backoff: Optional[Backoff] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self._delegate = delegate
+        self._fallback = fallback
+        self._max_attempts = max_attempts
+        self._max_elapsed = max_elapsed
+        self._backoff = backoff or Backoff()
+        self._breaker = breaker or circuit_breaker(delegate)
+        self._lock = threading.Lock()
+        self._retries = 0
+        self._failovers = 0
+        self._rejected = 0
+
+    @property
+    def model(self) -> str:
+        return client_label(self._delegate)
+
+    def _allow(self) -> bool:
+        if self._breaker.allow():
+            return True
+        with self._lock:
+            self._rejected += 1
+        return False
+
+    @contextlib.contextmanager
+    def _attempt(self) -> Iterator[None]:
+        """Reports the outcome of a request to the circuit breaker."""
         try:
+            yield
+        except ProviderError as e:
+            if e.retryable:
+                self._breaker.record_failure()
+            else:
+                # The provider is up; the request itself was bad.
+                self._breaker.record_success()
+            raise
+        except Exception:
+            # The provider answered, even if the answer was unusable.
+            self._breaker.record_success()
+            raise
+        self._breaker.record_success()
+
+    def _retry_delay(self, attempt: int, error: ProviderError, deadline: float) -> Optional[float]:
+        """Returns how long to wait before retrying a failed attempt, or None
+        if there are no retries left."""
+        delay = self._backoff.delay(attempt, error.retry_after)
+        if attempt + 1 == self._max_attempts or time.monotonic() + delay > deadline:
+            return None
+        with self._lock:
+            self._retries += 1
+        return delay
+
+    def _fail_over(self) -> bool:
+        """Whether there is a fallback to send the request to instead."""
+        if self._fallback is None:
+            return False
+        with self._lock:
+            self._failovers += 1
+        return True
+
+    def _give_up(self, error: Optional[ProviderError]) -> ProviderError:
+        if error is not None:
+            return error
+        return CircuitOpenError(f"Circuit breaker for {client_label(self._delegate)} is open")
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "breaker": self._breaker.state,
+                "retries": self._retries,
+                "failovers": self._failovers,
+                "rejected": self._rejected,
+            }
+
+
+class ResilientClient(_ResilientBase):
+    """An LLM client that you can overlay on top of another `LLMClient` to ride
+    out provider incidents.
+
+    Retryable `ProviderError`s (network errors, 429s and 5xx) are retried with
+    `Backoff`, honoring Retry-After, until `max_attempts` or `max_elapsed`
+    seconds are used up. Failures are reported to a circuit breaker shared by
+    every client for the same provider and model. While the breaker is open,
+    requests go straight to `fallback`, e.g. a local `OllamaClient`, or fail
+    with `CircuitOpenError` if there is none.
+
+    Errors in the generated content are not retried here; they are raised as
+    usual.
+    """
+
+    def __init__(
+        self,
+        delegate: LLMClient,
+        fallback: Optional[LLMClient] = None,
+        max_attempts: int = 4,
+        max_elapsed: float = 20.0,
+        backoff: Optional[Backoff] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        super().__init__(delegate, fallback, max_attempts, max_elapsed, backoff, breaker)
+
+    def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        return self._call(lambda client: client.get_chat_completion(messages))
+
+    def stream_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> CompletionStream:
+        """Starts a streaming completion. Only opening the stream, until its
+        first chunk arrives, is retried and failed over; errors after that are
+        raised while reading it."""
+        return self._call(lambda client: cast(StreamingLLMClient, client).stream_chat_completion(messages).open())
+
+    def _call(self, request: Callable[[LLMClient], T]) -> T:
+        deadline = time.monotonic() + self._max_elapsed
+        error: Optional[ProviderError] = None
+
+        for attempt in range(self._max_attempts):
+            if not self._allow():
+                break
+            try:
+                with self._attempt():
+                    return request(self._delegate)
+            except ProviderError as e:
+                if not e.retryable:
+                    raise
+                error = e
+
+            delay = self._retry_delay(attempt, error, deadline)
+            if delay is None:
+                break
+            time.sleep(delay)
+
+        if self._fail_over():
+            return request(self._fallback)
+        raise self._give_up(error)
+
+
+class AsyncResilientClient(_ResilientBase):
+    """The asyncio version of `ResilientClient`, for `AsyncLLMClient`s. Takes
+    the same arguments, and shares circuit breakers the same way."""
+
+    def __init__(
+        self,
+        delegate: AsyncLLMClient,
+        fallback: Optional[AsyncLLMClient] = None,
+        max_attempts: int = 4,
+        max_elapsed: float = 20.0,
+        backoff: Optional[Backoff] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        super().__init__(delegate, fallback, max_attempts, max_elapsed, backoff, breaker)
+
+    async def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        return await self._call(lambda client: client.get_chat_completion(messages))
+
+    def stream_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> AsyncCompletionStream:
+        """Starts a streaming completion. Like with `ResilientClient`, only
+        opening the stream is retried, when it is first read."""
+        return AsyncCompletionStream(self._stream_chunks(messages))
+
+    async def _stream_chunks(self, messages: list[dict[str, str]]) -> AsyncIterator[tuple[str, dict[str, Any]]]:
+        stream = await self._call(
+            lambda client: cast(AsyncStreamingLLMClient, client).stream_chat_completion(messages).open()
+        )
+        async for chunk in stream:
+            yield chunk
+
+    async def _call(self, request: Callable[[AsyncLLMClient], Awaitable[T]]) -> T:
+        deadline = time.monotonic() + self._max_elapsed
+        error: Optional[ProviderError] = None
+
+        for attempt in range(self._max_attempts):
+            if not self._allow():
+                break
+            try:
+                with self._attempt():
+                    return await request(self._delegate)
+            except ProviderError as e:
+                if not e.retryable:
+                    raise
+                error = e
+
+            delay = self._retry_delay(attempt, error, deadline)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+
+        if self._fail_over():
+            return await request(self._fallback)
+        raise self._give_up(error)
+
+
+class RateLimiter:
+    """Spaces out requests to one provider and model so that they stay within
+    its rate limits, instead of bursting into 429s that retries then multiply.
+
+    Two token buckets are enforced: `requests_per_second` requests, allowing
+    bursts of up to `burst_seconds` worth of requests, and `tokens_per_minute`
+    prompt and completion tokens, which holds a minute's worth like the
+    provider's own limit. Either may be None for no limit.
+    Requests that have to wait are admitted in priority order (lower first),
+    then in order of arrival. When the provider rate-limits anyway, `pause`
+    holds every request for as long as it asked.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        burst_seconds: float = 1.0,
+    ):
+        self._request_rate = requests_per_second
+        self._token_rate = tokens_per_minute / 60 if tokens_per_minute else None
+        self._request_capacity = max(1.0, requests_per_second * burst_seconds) if requests_per_second else 0.0
+        self._token_capacity = float(tokens_per_minute or 0)
+        self._requests = self._request_capacity
+        self._tokens = self._token_capacity
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+        # Waiting requests, as (priority, arrival) pairs.
+        self._queue: list[tuple[int, int]] = []
+        self._arrivals = 0
+        self._admitted = 0
+        self._waited = 0
+        self._pauses = 0
+        self._wait_times = LatencyHistogram()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        if self._request_rate:
+            self._requests = min(self._request_capacity, self._requests + elapsed * self._request_rate)
+        if self._token_rate:
+            self._tokens = min(self._token_capacity, self._tokens + elapsed * self._token_rate)
+
+    def _time_until_available(self, tokens: int, now: float) -> float:
+        """How long until a request for `tokens` tokens fits in the budget."""
+        wait = max(0.0, self._paused_until - now)
+        if self._request_rate and self._requests < 1:
+            wait = max(wait, (1 - self._requests) / self._request_rate)
+        if self._token_rate:
+            # A request larger than the whole bucket goes once the bucket is
+            # full, rather than never.
+            needed = min(tokens, self._token_capacity)
+            if self._tokens < needed:
+                wait = max(wait, (needed - self._tokens) / self._token_rate)
+        return wait
+
+    def acquire(self, tokens: int = 0, priority: int = 1) -> float:
+        """Blocks until a request expected to use `tokens` tokens may be sent,
+        and returns how long it waited, in seconds."""
+        start = time.monotonic()
+        with self._condition:
+            entry = (priority, self._arrivals)
+            self._arrivals += 1
+            heapq.heappush(self._queue, entry)
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self._queue[0] == entry:
+                    wait = self._time_until_available(tokens, now)
+                    if wait <= 0:
+                        break
+                    self._condition.wait(wait)
+                else:
+                    self._condition.wait()
+
+            heapq.heappop(self._queue)
+            if self._request_rate:
+                self._requests -= 1
+            if self._token_rate:
+                self._tokens -= tokens
+            waited = time.monotonic() - start
+            self._admitted += 1
+            if waited > 0.001:
+                self._waited += 1
+            self._wait_times.observe(waited)
+            # Let the next request in line check whether it can go too.
+            self._condition.notify_all()
+        return waited
+
+    def settle(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Corrects the token budget once a request's actual token usage is
+        known."""
+        if not self._token_rate:
+            return
+        with self._condition:
+            self._tokens -= actual_tokens - estimated_tokens
+            self._condition.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        """Holds all requests for `seconds`, e.g. after the provider returned
+        a 429 with a Retry-After."""
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._pauses += 1
+
+    def stats(self) -> dict[str, Any]:
+        with self._condition:
+            return {
+                "admitted": self._admitted,
+                "waited": self._waited,
+                "queued": len(self._queue),
+                "pauses": self._pauses,
+                "wait": self._wait_times.summary(),
+            }
+
+
+_rate_limiters: dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def rate_limiter(
+    client: Any,
+    requests_per_second: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+) -> RateLimiter:
+    """Returns the process-wide rate limiter for a client's provider and model,
+    so that every participant draws from the same budget. The limits are only
+    used when the limiter is first created."""
+    key = f"{type(client).__name__}:{client_label(client)}"
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(requests_per_second, tokens_per_minute)
+            _rate_limiters[key] = limiter
+        return limiter
+
+
+# How urgently each Minecraft event needs an answer, for `RateLimitedClient`:
+# chat gets ahead of everything, idle polls wait for everything else. Events
+# that aren't listed get DEFAULT_EVENT_PRIORITY.
+EVENT_PRIORITIES = {"chat": 0, "message": 0, "damage": 0, "idle": 2, "interval": 2}
+DEFAULT_EVENT_PRIORITY = 1
+
+
+class RateLimitedClient:
+    """An LLM client that you can overlay on top of another `LLMClient` to
+    make its requests wait for a shared `RateLimiter`.
+
+    Each request is counted as its estimated prompt tokens plus
+    `completion_tokens`, corrected from the usage the provider reports. The
+    priority of a request is that of the event being answered (see
+    `current_event`), looked up in `priorities`. When the provider answers with
+    a 429, the limiter is paused for its Retry-After so that other participants
+    don't pile on. Place it under `ResilientClient` so that retries are limited
+    too.
+    """
+
+    def __init__(
+        self,
+        delegate: LLMClient,
+        limiter: RateLimiter,
+        priorities: Optional[dict[str, int]] = None,
+        completion_tokens: int = 300,
+    ):
+        self._delegate = delegate
+        self._limiter = limiter
+        self._priorities = EVENT_PRIORITIES if priorities is None else priorities
+        self._completion_tokens = completion_tokens
+
+    @property
+    def model(self) -> str:
+        return client_label(self._delegate)
+
+    def _acquire(self, messages: list[dict[str, str]]) -> int:
+        """Waits for the request's turn and returns its estimated tokens."""
+        estimated = estimate_messages_tokens(messages) + self._completion_tokens
+        event = current_event.get()
+        priority = self._priorities.get(event, DEFAULT_EVENT_PRIORITY) if event else DEFAULT_EVENT_PRIORITY
+        metrics.observe("rate_limit_wait", self._limiter.acquire(estimated, priority))
+        return estimated
+
+    @contextlib.contextmanager
+    def _pausing_on_429(self) -> Iterator[None]:
+        try:
+            yield
+        except ProviderError as e:
+            if e.status_code == 429:
+                self._limiter.pause(e.retry_after or 1.0)
+            raise
+
+    def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        estimated = self._acquire(messages)
+        with self._pausing_on_429():
+            response = self._delegate.get_chat_completion(messages)
+
+        usage = response.usage
+        if usage is not None:
+            self._limiter.settle(estimated, usage.prompt_tokens + usage.completion_tokens)
+        return response
+
+    def stream_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> CompletionStream:
+        """Starts a streaming completion once it's the request's turn. Streams
+        are counted at their estimated size."""
+        self._acquire(messages)
+        with self._pausing_on_429():
+            return cast(StreamingLLMClient, self._delegate).stream_chat_completion(messages).open()
+
+    def stats(self) -> dict[str, Any]:
+        return self._limiter.stats()
+
+
+class ClientRegistry:
+    """LLM clients shared by every participant in the process, by provider,
+    model and options.
+
+    Provider clients such as `OpenRouterClient`, and `ResilientClient` on top of
+    them, keep no per-participant state, so creating one per participant only
+    repeats work on the challenge-start critical path. Get them from a registry
+    instead, and layer per-participant wrappers such as `CoalescingClient` on
+    top. Clients can be created ahead of time with `prewarm`.
+    """
+
+    def __init__(self):
+        self._clients: dict[Any, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, factory: Callable[[], T]) -> T:
+        """Returns the client for `key`, creating it with `factory` if there
+        isn't one yet. `key` must be hashable, e.g. ("openrouter", model)."""
+        client = self._clients.get(key)
+        if client is not None:
+            return cast(T, client)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = factory()
+            return cast(T, client)
+
+    def prewarm(self, factories: dict[Any, Callable[[], Any]]) -> None:
+        """Creates the clients for the given keys that don't exist yet."""
+        for key, factory in factories.items():
+            self.get(key, factory)
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+
+# The previous name of `CoalescingClient`, which used to drop new requests
+# instead of the waiting ones.
+WaitingClient = CoalescingClient
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+def messages_key(messages: list[dict[str, str]]) -> str:
+    """Returns a hash of the prompt messages that ignores differences in
+    whitespace."""
+    normalized = [(m["role"], _normalize(str(m["content"]))) for m in messages]
+    return hashlib.sha256(json.dumps(normalized).encode()).hexdigest()
+
+
+def observation_key(messages: list[dict[str, str]]) -> str:
+    """Returns a hash of the system prompt and the latest message, which holds
+    the current observation, ignoring the conversation history in between.
+
+    Because the history changes after every event, this is the key to use to
+    recognize repeats of the same game state.
+    """
+    system_end = 0
+    while system_end < len(messages) - 1 and messages[system_end]["role"] == "system":
+        system_end += 1
+    return messages_key([*messages[:system_end], *messages[-1:]])
+
+
+class CachingClient:
+    """An LLM client that you can overlay on top of another `LLMClient` to
+    reuse responses for prompts it has already seen.
+
+    Idle and repeated command events often produce the same observation as
+    the previous event, and there's no need to pay for another round trip to
+    the LLM to decide what to do about it.
+
+    Args:
+        delegate: The client to call on a cache miss.
+        ttl: How long, in seconds, a response stays cached.
+        max_entries: The size of the default in-memory cache.
+        backend: Where to store responses, e.g. a `SQLiteCacheBackend` to keep
+            them across runs. Defaults to an in-memory LRU cache.
+        key: Computes the cache key from the prompt messages. Defaults to
+            `messages_key`; use `observation_key` to ignore the history.
+        events: The event types (see `current_event`) whose completions may be
+            cached. Defaults to all of them.
+
+    Cached responses are returned without their token usage, since they cost
+    nothing. Streamed completions are cached too, once they have been read to
+    the end; a cached response is streamed as a single chunk.
+    """
+
+    def __init__(
+        self,
+        delegate: LLMClient,
+        ttl: float = 60,
+        max_entries: int = 1024,
+        backend: Optional[ResponseCacheBackend] = None,
+        key: Callable[[list[dict[str, str]]], str] = messages_key,
+        events: Optional[Collection[str]] = None,
+    ):
+        self._delegate = delegate
+        self._ttl = ttl
+        self._backend = backend or MemoryCacheBackend(max_entries)
+        self._key = key
+        self._events = events
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._bypassed = 0
+
+    def _lookup(self, messages: list[dict[str, str]]) -> tuple[Optional[str], Optional[LLMResponse]]:
+        """Returns the cache key of a prompt, or None if its event isn't
+        cached, and the cached response, if there is one."""
+        if self._events is not None and current_event.get() not in self._events:
+            with self._lock:
+                self._bypassed += 1
+            return None, None
+
+        key = self._key(messages)
+        cached = self._backend.get(key)
+        with self._lock:
+            if cached is None:
+                self._misses += 1
+                return key, None
+            self._hits += 1
+        content, raw_response = cached
+        return key, LLMResponse(content, without_usage(raw_response))
+
+    def _store(self, key: str, response: Optional[LLMResponse]) -> None:
+        if response is None:
+            return
+        # Don't cache responses that can't be parsed, or retries would keep
+        # getting the same broken response back.
+        try:
+            parse_action_from_response(response)
+        except LLMError:
+            return
+        self._backend.set(key, (response.content, response.raw_response), self._ttl)
+
+    def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        key, cached = self._lookup(messages)
+        if cached is not None:
+            return cached
+
+        response = self._delegate.get_chat_completion(messages)
+        if key is not None:
+            self._store(key, response)
+        return response
+
+    def stream_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> CompletionStream:
+        key, cached = self._lookup(messages)
+        if cached is not None:
+            return completed_stream(cached)
+
+        stream = cast(StreamingLLMClient, self._delegate).stream_chat_completion(messages)
+        if key is None:
+            return stream
+        return CompletionStream(stream, on_done=lambda response: self._store(key, response))
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "bypassed": self._bypassed,
+                "hit_ratio": self._hits / lookups if lookups else 0.0,
+            }
+
+
+def _name_pattern(name: str) -> "re.Pattern[str]":
+    return re.compile(rf"(?<!\w){re.escape(name)}(?!\w)")
+
+
+def _without_name(messages: list[dict[str, str]], name: Optional[str]) -> list[dict[str, str]]:
+    """Returns the messages with every mention of `name` as a whole word
+    replaced by a placeholder."""
+    if not name:
+        return messages
+    pattern = _name_pattern(name)
+    return [{**message, "content": pattern.sub("$NAME", str(message["content"]))} for message in messages]
+
+
+class SingleflightClient:
+    """An LLM client that you can overlay on top of another `LLMClient` to
+    share one request between callers that send the same prompt at the same
+    time.
+
+    In runs with several participants playing the same agent, their prompts
+    are often identical, e.g. for the first event of a challenge. Share a
+    single `SingleflightClient` between them: the first caller makes the
+    request, and the others wait for its response and get their own copy of it
+    (or its error), without its usage, which the leader already reports.
+    Unlike `CachingClient`, nothing is kept once the request completes.
+
+    Prompts usually mention the participant's own name, e.g. in the system
+    prompt. If `current_participant_name` is set, it is left out of the key,
+    and followers get the leader's response with the leader's name replaced by
+    theirs. Anything else that differs between participants still keeps their
+    prompts apart: their conversation histories, and the other players each of
+    them can see. In practice, that means requests are mostly shared for the
+    first events of a challenge.
+
+    Args:
+        delegate: The client that makes the requests.
+        key: Computes the key of a prompt; calls with the same key are shared.
+            Defaults to `messages_key`, which ignores whitespace.
+        events: The event types (see `current_event`) whose requests may be
+            shared. Leave out events where participants should answer
+            independently. Defaults to all of them.
+    """
+
+    def __init__(
+        self,
+        delegate: LLMClient,
+        key: Callable[[list[dict[str, str]]], str] = messages_key,
+        events: Optional[Collection[str]] = None,
+    ):
+        self._delegate = delegate
+        self._key = key
+        self._events = events
+        self._lock = threading.Lock()
+        # The requests in flight, by key. Each resolves to the leader's name and
+        # the content and raw response that followers copy.
+        self._in_flight: dict[str, Future[tuple[Optional[str], str, dict[str, Any]]]] = {}
+        self._requests = 0
+        self._shared = 0
+        self._bypassed = 0
+
+    @property
+    def model(self) -> str:
+        return client_label(self._delegate)
+
+    def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        if self._events is not None and current_event.get() not in self._events:
+            with self._lock:
+                self._bypassed += 1
             return self._delegate.get_chat_completion(messages)
+
+        name = current_participant_name.get()
+        key = self._key(_without_name(messages, name))
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                leader = True
+                future = self._in_flight[key] = Future()
+                self._requests += 1
+            else:
+                leader = False
+                self._shared += 1
+
+        if not leader:
+            leader_name, content, raw_response = future.result()
+            if leader_name and name:
+                content = _name_pattern(leader_name).sub(lambda _: name, content)
+            return LLMResponse(content, without_usage(raw_response))
+
+        try:
+            response = self._delegate.get_chat_completion(messages)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            # Followers copy this snapshot rather than the response the leader
+            # returns, which its caller may change.
+            future.set_result((name, response.content, copy.deepcopy(response.raw_response)))
+            return response
         finally:
-            self._lock.release()
+            with self._lock:
+                del self._in_flight[key]
+
+    def stream_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> CompletionStream:
+        """Starts a streaming completion. Streams are never shared."""
+        with self._lock:
+            self._bypassed += 1
+        return cast(StreamingLLMClient, self._delegate).stream_chat_completion(messages)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            calls = self._requests + self._shared
+            return {
+                "requests": self._requests,
+                "shared": self._shared,
+                "bypassed": self._bypassed,
+                "shared_ratio": self._shared / calls if calls else 0.0,
+            }
+
+
+def client_stats(client: Any) -> dict[str, dict[str, Any]]:
+    """Collects the `stats()` of a client and of every client it wraps, keyed
+    by class name."""
+    result = {}
+    while client is not None:
+        if hasattr(client, "stats"):
+            result[type(client).__name__] = client.stats()
+        client = getattr(client, "_delegate", None)
+    return result
+
+
+_CODE_FENCE = re.compile(r"^\s*```[\w-]*\n?(.*?)\n?```\s*$", re.DOTALL)
+
+
+def _outside_strings(text: str) -> Iterator[tuple[int, str]]:
+    """Yields the index and character of everything in `text` that is not
+    inside a JSON string, including the quotes that open and close strings."""
+    in_string = False
+    escaped = False
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+                yield index, char
+        else:
+            if char == '"':
+                in_string = True
+            yield index, char
+
+
+def _strip_trailing_commas(text: str) -> str:
+    """Removes the commas directly before a closing brace or bracket, leaving
+    the contents of strings, such as the code, alone."""
+    tokens = [(index, char) for index, char in _outside_strings(text) if not char.isspace()]
+    commas = {index for (index, char), (_, following) in zip(tokens, tokens[1:]) if char == "," and following in "}]"}
+    return "".join(char for index, char in enumerate(text) if index not in commas)
+
+
+def _close_truncated(text: str) -> str:
+    """Closes the strings, arrays and objects left open at the end of `text`,
+    e.g. because the response was cut off. Raises `ValueError` if it was cut
+    off in the middle of the code, which must not be run incomplete."""
+    closers = []
+    in_string = False
+    string_start = 0
+    for index, char in _outside_strings(text):
+        if char == '"':
+            in_string = not in_string
+            if in_string:
+                string_start = index
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+        elif char in "}]" and closers:
+            closers.pop()
+    if in_string and re.search(r'"code"\s*:\s*$', text[:string_start]):
+        raise ValueError("Response was cut off in the middle of the code")
+    # Drop a dangling backslash, which would escape the closing quote.
+    if in_string and (len(text) - len(text.rstrip("\\"))) % 2:
+        text = text[:-1]
+    return text + ('"' if in_string else "") + "".join(reversed(closers))
+
+
+# Deterministic fixes for common ways LLMs break the JSON format, tried in order
+# on the text from the first "{" to the end of the response. Each takes that
+# text and returns the parsed value or raises.
+_JSON_REPAIRS: list[tuple[str, Callable[[str], Any]]] = [
+    # Literal newlines and tabs inside strings, usually in the code.
+    ("control_characters", lambda text: json.loads(text[: text.rfind("}") + 1], strict=False)),
+    (
+        "trailing_commas",
+        lambda text: json.loads(_strip_trailing_commas(text[: text.rfind("}") + 1]), strict=False),
+    ),
+    # Python-style dicts with single-quoted strings.
+    ("single_quotes", lambda text: ast.literal_eval(text[: text.rfind("}") + 1])),
+    ("truncated", lambda text: json.loads(_strip_trailing_commas(_close_truncated(text)), strict=False)),
+]
+
+# How often each repair was needed, across all participants.
+json_repairs: Counter[str] = Counter()
+_json_repairs_lock = threading.Lock()
+
+
+def count_json_repair(repair: str) -> None:
+    """Counts a response that needed `repair`. `parse_action_from_response`
+    only records the repair on the response, since the same response may be
+    parsed more than once, e.g. by client wrappers validating it; call this
+    once per response that is used."""
+    with _json_repairs_lock:
+        json_repairs[repair] += 1
+
+
+def json_repair_stats() -> dict[str, int]:
+    """Returns how many responses needed each repair, across all participants.
+    Every one of them is an LLM request that didn't have to be retried."""
+    with _json_repairs_lock:
+        return dict(json_repairs)
 
 
 def parse_action_from_response(response: LLMResponse) -> OnEventResponse:
     """Parses the content from an LLM response into an `OnEventResponse` object.
 
     This is a helper function that attempts to extract the `code` and `message`
-    from the LLM response. If the content is not valid JSON, it raises an
-    `LLMError`.
+    from the LLM response. If the content is not valid JSON, a series of
+    repairs for common mistakes is tried (see `_JSON_REPAIRS`), and the one
+    that worked is recorded in `response.repair`. If none of them work, it
+    raises an `LLMError`.
     """
     content = response.content
     if not content:
@@ -196,22 +2167,44 @@ def parse_action_from_response(response: LLMResponse) -> OnEventResponse:
     # Find the JSON part in the content
     start = content.find("{")
     end = content.rfind("}") + 1
-    content_to_parse = content[start:end]
-    if not content_to_parse:
+    if start < 0:
         raise LLMError("Unable to parse JSON from LLM response", f"Received: {content}", content)
+    content_to_parse = content[start:end]
 
-    # Parse the content string as JSON and extract the code and message
+    # Parse the content string as JSON, falling back to the repairs in order.
+    json_content: Any = None
+    error: Optional[Exception] = None
     try:
         json_content = json.loads(content_to_parse)
-        action = OnEventResponse(
-            code=json_content.get("code", ""),
-            message=json_content.get("message", ""),
-        )
-        return action
-
     except Exception as e:
+        error = e
+        for repair, parse in _JSON_REPAIRS:
+            try:
+                json_content = parse(content[start:])
+            except Exception:
+                continue
+            if isinstance(json_content, dict):
+                response.repair = repair
+                break
+        else:
+            json_content = None
+
+    if not isinstance(json_content, dict):
         raise LLMError(
             "Unable to parse JSON from LLM response",
-            f"Unable to parse JSON from LLM response for content: {content_to_parse} with error: {e}",
+            f"Unable to parse JSON from LLM response for content: {content_to_parse} with error: {error}",
             content,
-        ) from e
+        ) from error
+
+    # Extract the code and message
+    code = json_content.get("code", "")
+    if isinstance(code, str):
+        match = _CODE_FENCE.match(code)
+        if match:
+            code = match.group(1)
+            response.repair = "code_fence"
+
+    return OnEventResponse(
+        code=code,
+        message=json_content.get("message", ""),
+    )
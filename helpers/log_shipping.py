@@ -0,0 +1,183 @@
+import atexit
+import gzip
+import json
+import queue
+import threading
+import time
+from typing import Any, NamedTuple, Optional, Protocol
+
+import requests
+from kradle import KradleAPI
+
+from helpers.metrics import metrics
+
+
+class LogEntry(NamedTuple):
+    run_id: str
+    participant_id: str
+    message: Any
+
+
+class LogSink(Protocol):
+    def send(self, batch: list[LogEntry]) -> None:
+        """Delivers a batch of log entries, raising if that failed."""
+        ...
+
+
+class KradleLogSink:
+    """Sends log entries to the Kradle API, one request per entry, over the
+    API client's connection. This is what `Context.log` does.
+
+    The Kradle API has no endpoint for several entries at once, so batches are
+    not combined into fewer requests; use `GzipBatchLogSink` for that."""
+
+    def __init__(self, api: KradleAPI):
+        self._api = api
+
+    def send(self, batch: list[LogEntry]) -> None:
+        for entry in batch:
+            self._api.logs.create(run_id=entry.run_id, participant_id=entry.participant_id, message=entry.message)
+
+
+class GzipBatchLogSink:
+    """Posts each batch as a single gzip-compressed JSON array to `url`, for
+    log collectors that accept batches. Each element has the same fields as a
+    Kradle log entry, plus the run ID."""
+
+    def __init__(self, url: str, headers: Optional[dict[str, str]] = None, timeout: float = 10):
+        self._url = url
+        self._headers = {**(headers or {}), "Content-Type": "application/json", "Content-Encoding": "gzip"}
+        self._timeout = timeout
+        self._session = requests.Session()
+
+    def send(self, batch: list[LogEntry]) -> None:
+        payload = [
+            {
+                "runId": entry.run_id,
+                "participantId": entry.participant_id,
+                "message": entry.message if isinstance(entry.message, str) else json.dumps(entry.message),
+            }
+            for entry in batch
+        ]
+        body = gzip.compress(json.dumps(payload).encode())
+        response = self._session.post(self._url, data=body, headers=self._headers, timeout=self._timeout)
+        response.raise_for_status()
+
+
+class LogShipper:
+    """Ships log entries from a background thread, so that event handlers don't
+    wait for logging round trips.
+
+    Entries are queued by `submit` and sent in batches of up to `batch_size`,
+    or whatever has arrived within `flush_interval` seconds of the first entry
+    of a batch. How many requests a batch takes is up to the sink. If the
+    queue is full because the sink can't keep up, new entries are dropped and
+    counted rather than blocking the caller. Entries still queued when the
+    process exits are flushed.
+
+    Args:
+        sink: Where to send batches.
+        max_queue: The maximum number of entries waiting to be sent.
+        batch_size: The maximum number of entries per batch.
+        flush_interval: The longest an entry waits for a batch to fill up.
+    """
+
+    def __init__(self, sink: LogSink, max_queue: int = 1000, batch_size: int = 50, flush_interval: float = 1.0):
+        self._sink = sink
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue: queue.Queue[Optional[LogEntry]] = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._sent = 0
+        self._dropped = 0
+        self._failed = 0
+        self._batches = 0
+        self._max_depth = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="log-shipper", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, run_id: str, participant_id: str, message: Any) -> bool:
+        """Queues a log entry. Returns False if it was dropped because the
+        queue is full or the shipper is closed."""
+        try:
+            if self._closed:
+                raise queue.Full
+            self._queue.put_nowait(LogEntry(run_id, participant_id, message))
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+            return False
+        with self._lock:
+            self._submitted += 1
+            self._max_depth = max(self._max_depth, self._queue.qsize())
+        return True
+
+    def _run(self) -> None:
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                self._queue.task_done()
+                return
+
+            batch = [entry]
+            deadline = time.monotonic() + self._flush_interval
+            stopping = False
+            while len(batch) < self._batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+
+            self._send(batch)
+            for _ in range(len(batch) + stopping):
+                self._queue.task_done()
+            if stopping:
+                return
+
+    def _send(self, batch: list[LogEntry]) -> None:
+        start = time.perf_counter()
+        try:
+            self._sink.send(batch)
+        except Exception as e:
+            print(f"Error shipping {len(batch)} log entries: {e}")
+            with self._lock:
+                self._failed += len(batch)
+        else:
+            with self._lock:
+                self._sent += len(batch)
+        finally:
+            metrics.observe("log_batch", time.perf_counter() - start)
+            with self._lock:
+                self._batches += 1
+
+    def flush(self) -> None:
+        """Blocks until every entry queued so far has been sent or failed."""
+        self._queue.join()
+
+    def close(self) -> None:
+        """Flushes the queue and stops the background thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "submitted": self._submitted,
+                "sent": self._sent,
+                "dropped": self._dropped,
+                "failed": self._failed,
+                "batches": self._batches,
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self._max_depth,
+            }
@@ -0,0 +1,230 @@
+import bisect
+import contextlib
+import functools
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Any, Callable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Labels added to every observation recorded in this context, e.g. the
+# participant and model. Event handlers set these so that code further down,
+# like the HTTP transport, doesn't need to know about them.
+metric_labels: ContextVar[dict[str, str]] = ContextVar("metric_labels", default={})
+
+
+class LatencyHistogram:
+    """A thread-safe histogram of durations, in seconds.
+
+    Observations are counted in log-spaced buckets, so memory stays constant
+    no matter how many are recorded, and percentiles are accurate to within
+    the bucket growth factor.
+
+    Args:
+        min_seconds: The upper bound of the smallest bucket, small enough to
+            resolve CPU-bound stages that take microseconds.
+        max_seconds: The largest bucket bound; slower observations go into an
+            overflow bucket.
+        growth: The ratio between consecutive bucket bounds.
+    """
+
+    def __init__(self, min_seconds: float = 1e-6, max_seconds: float = 300, growth: float = 1.25):
+        bucket_count = math.ceil(math.log(max_seconds / min_seconds, growth)) + 1
+        self.bounds = [min_seconds * growth**i for i in range(bucket_count)]
+        self._counts = [0] * (bucket_count + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        index = bisect.bisect_left(self.bounds, seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += seconds
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        """Adds the observations of `other`, which must have the same bucket
+        bounds, to this histogram."""
+        if other.bounds != self.bounds:
+            raise ValueError("Can only merge histograms with the same buckets")
+        with other._lock:
+            counts, count, total = list(other._counts), other._count, other._sum
+        with self._lock:
+            self._counts = [a + b for a, b in zip(self._counts, counts)]
+            self._count += count
+            self._sum += total
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def sum(self) -> float:
+        return self._sum
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """Returns the estimated duration below which `percent` (0-100) of the
+        observations fall, or None if nothing has been observed."""
+        with self._lock:
+            if self._count == 0:
+                return None
+            rank = percent / 100 * self._count
+            seen = 0
+            for index, count in enumerate(self._counts):
+                if count and seen + count >= rank:
+                    # Interpolate linearly within the bucket.
+                    lower = self.bounds[index - 1] if index > 0 else 0.0
+                    upper = self.bounds[index] if index < len(self.bounds) else self.bounds[-1]
+                    return lower + (upper - lower) * (rank - seen) / count
+                seen += count
+            return self.bounds[-1]
+
+    def buckets(self) -> list[tuple[float, int]]:
+        """Returns the cumulative count of observations at or below each
+        bucket bound, followed by the total count at `math.inf`."""
+        with self._lock:
+            counts = list(self._counts)
+        result = []
+        total = 0
+        for bound, count in zip([*self.bounds, math.inf], counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def summary(self) -> dict[str, Any]:
+        """Returns the count, mean and common percentiles, in seconds."""
+        count = self._count
+        return {
+            "count": count,
+            "mean": self._sum / count if count else None,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+LabelSet = tuple[tuple[str, str], ...]
+
+
+class MetricsRegistry:
+    """A set of named latency histograms, each split by labels such as the
+    participant or model.
+
+    Record durations with `observe`, or time a block with `span`. The current
+    `metric_labels` are added to every observation.
+
+    Labels such as the participant make the number of histograms grow with
+    every participant served. Call `remove` to drop the ones of a participant
+    that has finished; past `max_series` histograms, the least recently used
+    one is dropped.
+    """
+
+    def __init__(self, max_series: int = 10000):
+        self._max_series = max_series
+        self._histograms: OrderedDict[tuple[str, LabelSet], LatencyHistogram] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, **labels: str) -> LatencyHistogram:
+        key = (name, tuple(sorted({**metric_labels.get(), **labels}.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = LatencyHistogram()
+                while len(self._histograms) > self._max_series:
+                    self._histograms.popitem(last=False)
+            else:
+                self._histograms.move_to_end(key)
+        return histogram
+
+    def remove(self, **labels: str) -> int:
+        """Drops every histogram whose labels include `labels`, e.g. those of
+        one participant. Returns how many were dropped."""
+        wanted = set(labels.items())
+        with self._lock:
+            keys = [key for key in self._histograms if wanted <= set(key[1])]
+            for key in keys:
+                del self._histograms[key]
+        return len(keys)
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        self.histogram(name, **labels).observe(seconds)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **labels: str) -> Iterator[None]:
+        """Times the enclosed block, whether or not it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name: str) -> Callable[[Callable[..., T]], Callable[..., T]]:
+        """A decorator that times every call of the decorated function."""
+
+        def decorator(function: Callable[..., T]) -> Callable[..., T]:
+            @functools.wraps(function)
+            def wrapper(*args: Any, **kwargs: Any) -> T:
+                with self.span(name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def _items(self) -> list[tuple[str, LabelSet, LatencyHistogram]]:
+        with self._lock:
+            return sorted((name, labels, histogram) for (name, labels), histogram in self._histograms.items())
+
+    def merged(self, name: str) -> LatencyHistogram:
+        """Returns the observations of `name` across all labels."""
+        result = LatencyHistogram()
+        for histogram_name, _, histogram in self._items():
+            if histogram_name == name:
+                result.merge(histogram)
+        return result
+
+    def names(self) -> list[str]:
+        return sorted({name for name, _, _ in self._items()})
+
+    def to_json(self) -> list[dict[str, Any]]:
+        """Returns a summary (count, mean, p50, p95, p99) of every histogram."""
+        return [
+            {"name": name, "labels": dict(labels), **histogram.summary()}
+            for name, labels, histogram in self._items()
+        ]
+
+    def to_prometheus(self, prefix: str = "kradle_agent") -> str:
+        """Returns every histogram in the Prometheus text exposition format."""
+        lines = []
+        last_name = None
+        for name, labels, histogram in self._items():
+            metric = f"{prefix}_{name}_seconds"
+            if name != last_name:
+                lines.append(f"# TYPE {metric} histogram")
+                last_name = name
+            for bound, count in histogram.buckets():
+                le = "+Inf" if bound == math.inf else f"{bound:.6g}"
+                lines.append(f"{metric}_bucket{_format_labels(labels, le=le)} {count}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: LabelSet, **extra: str) -> str:
+    items = [*labels, *extra.items()]
+    if not items:
+        return ""
+    escaped = (f'{key}="{_escape(value)}"' for key, value in items)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# The registry that the agent and the HTTP transports record into.
+metrics = MetricsRegistry()
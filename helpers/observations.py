@@ -0,0 +1,118 @@
+import threading
+from collections import Counter, OrderedDict
+from typing import Callable, Mapping, Optional
+
+from kradle.models import Observation
+
+
+class ObservationState:
+    """The parts of an observation that are diffed: what the bot can see, what
+    it carries and its health. Lists are kept as counts, since the same entity
+    type can appear more than once."""
+
+    __slots__ = ("players", "blocks", "entities", "inventory", "health")
+
+    def __init__(self, observation: Observation):
+        self.players = Counter(observation.players)
+        self.blocks = Counter(observation.blocks)
+        self.entities = Counter(observation.entities)
+        self.inventory = dict(observation.inventory)
+        self.health = observation.health
+
+
+class CountChanges:
+    """The difference between two sets of counts: the names that were added
+    and how many, the names that were removed, and the names whose count went
+    from one value to another."""
+
+    __slots__ = ("added", "removed", "changed")
+
+    def __init__(self, old: Mapping[str, int], new: Mapping[str, int]):
+        self.added = {name: count for name, count in new.items() if name not in old}
+        self.removed = [name for name in old if name not in new]
+        self.changed = {
+            name: (old[name], count) for name, count in new.items() if name in old and old[name] != count
+        }
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+
+class ObservationDelta:
+    """What changed between the last observation the LLM saw and a new one."""
+
+    __slots__ = ("players", "blocks", "entities", "inventory", "health_changed")
+
+    def __init__(self, old: ObservationState, new: ObservationState):
+        self.players = CountChanges(old.players, new.players)
+        self.blocks = CountChanges(old.blocks, new.blocks)
+        self.entities = CountChanges(old.entities, new.entities)
+        self.inventory = CountChanges(old.inventory, new.inventory)
+        self.health_changed = old.health != new.health
+
+
+class ObservationDiffer:
+    """Renders a participant's observations either in full or as the changes
+    since the last observation the LLM saw.
+
+    The first observation, and every `keyframe_interval`-th one after it, is
+    rendered in full so that the LLM never has to reconstruct the state from a
+    long chain of changes. Once the LLM has actually been sent a rendered
+    observation, pass its text to `commit` so that later observations are diffed
+    against it; observations that are rendered but never sent, e.g. because a
+    request was superseded, don't affect later diffs.
+
+    Deltas only make sense while the LLM can still see the last keyframe. Pass
+    `in_context` to `render` to check that it does, e.g. that it hasn't been
+    evicted from the history; if not, the observation is rendered in full.
+    """
+
+    def __init__(self, keyframe_interval: int = 10):
+        self._keyframe_interval = keyframe_interval
+        self._state: Optional[ObservationState] = None
+        self._since_keyframe = 0
+        # The text of the last committed keyframe.
+        self._keyframe_text: Optional[str] = None
+        # Rendered observations that haven't been committed yet, by text.
+        self._pending: OrderedDict[str, tuple[ObservationState, bool]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(
+        self,
+        observation: Observation,
+        render_full: Callable[[Observation], str],
+        render_delta: Callable[[Observation, ObservationDelta], str],
+        in_context: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        state = ObservationState(observation)
+        with self._lock:
+            keyframe = self._state is None or self._since_keyframe + 1 >= self._keyframe_interval
+            previous = self._state
+            keyframe_text = self._keyframe_text
+
+        # Turns leave the history oldest first, so the deltas since the
+        # keyframe are still there as long as the keyframe is.
+        if not keyframe and in_context is not None and (keyframe_text is None or not in_context(keyframe_text)):
+            keyframe = True
+
+        if keyframe or previous is None:
+            text = render_full(observation)
+        else:
+            text = render_delta(observation, ObservationDelta(previous, state))
+
+        with self._lock:
+            self._pending[text] = (state, keyframe)
+            while len(self._pending) > 8:
+                self._pending.popitem(last=False)
+        return text
+
+    def commit(self, text: str) -> None:
+        """Records that the LLM has seen the observation rendered as `text`."""
+        with self._lock:
+            pending = self._pending.pop(text, None)
+            if pending is None:
+                return
+            self._state, keyframe = pending
+            self._since_keyframe = 0 if keyframe else self._since_keyframe + 1
+            if keyframe:
+                self._keyframe_text = text
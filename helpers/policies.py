@@ -0,0 +1,89 @@
+import threading
+import time
+from typing import Any, Optional, Protocol, Sequence
+
+from kradle import Context, OnEventResponse
+from kradle.models import MinecraftEvent, Observation
+
+
+def skip_response() -> OnEventResponse:
+    """An action that does nothing, for events that don't need an answer."""
+    return {"code": "", "message": "", "delay": 0}
+
+
+class Policy(Protocol):
+    """A rule that can answer an event without asking the LLM.
+
+    Policies run before the prompt is built. They return an action to send
+    back to Kradle, which may be `skip_response()`, or None to leave the event
+    to the next policy and ultimately the LLM. They must be cheap: they run on
+    every event.
+    """
+
+    def decide(self, observation: Observation, context: Context) -> Optional[OnEventResponse]: ...
+
+
+class SkipWhileExecuting:
+    """Skips idle and command events that arrive while the bot is still
+    running earlier code, as long as they bring no command output or chat to
+    react to. Answering them would interrupt the code that is running."""
+
+    def decide(self, observation: Observation, context: Context) -> Optional[OnEventResponse]:
+        if observation.event not in (MinecraftEvent.IDLE, MinecraftEvent.COMMAND_EXECUTED):
+            return None
+        if observation.executing and not observation.output and not observation.chat_messages:
+            return skip_response()
+        return None
+
+
+class IdleDebounce:
+    """Skips idle events that arrive within `interval` seconds of the last
+    event this policy let through, since the LLM can't keep up with them and
+    nothing has happened in between."""
+
+    def __init__(self, interval: float = 2.0):
+        self._interval = interval
+
+    def decide(self, observation: Observation, context: Context) -> Optional[OnEventResponse]:
+        now = time.monotonic()
+        last = context.get("idle_debounce_at")
+        if observation.event == MinecraftEvent.IDLE and last is not None and now - last < self._interval:
+            return skip_response()
+        context["idle_debounce_at"] = now
+        return None
+
+
+class PolicyChain:
+    """Runs policies in order until one of them answers the event, and counts
+    how many events were answered without the LLM."""
+
+    def __init__(self, policies: Sequence[Policy]):
+        self._policies = list(policies)
+        self._lock = threading.Lock()
+        self._events = 0
+        self._handled: dict[str, int] = {}
+
+    def decide(self, observation: Observation, context: Context) -> Optional[OnEventResponse]:
+        decision = None
+        name = None
+        for policy in self._policies:
+            decision = policy.decide(observation, context)
+            if decision is not None:
+                name = type(policy).__name__
+                break
+
+        with self._lock:
+            self._events += 1
+            if name:
+                self._handled[name] = self._handled.get(name, 0) + 1
+        return decision
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            handled = sum(self._handled.values())
+            return {
+                "events": self._events,
+                "handled": handled,
+                "handled_ratio": handled / self._events if self._events else None,
+                "by_policy": dict(self._handled),
+            }
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable
+
+from kradle.models import ChallengeInfo
+
+
+def challenge_fingerprint(challenge: ChallengeInfo) -> str:
+    """Returns a short digest of the parts of a challenge that prompts are built
+    from. Participants in the same challenge get the same fingerprint, so they
+    can share cached prompts.
+
+    This serializes the whole skill reference, so compute it once per
+    participant (e.g. in `@agent.init`) rather than on every event.
+    """
+    data = json.dumps(
+        [challenge.task, challenge.agent_modes, challenge.js_functions],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+class PromptCache:
+    """A thread-safe, least-recently-used cache of rendered prompt messages.
+
+    Cached messages are shared by every caller that uses the same key, so they
+    must be treated as immutable: build new lists around them rather than
+    editing them in place.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self._max_entries = max_entries
+        self._entries: OrderedDict[Hashable, tuple[dict[str, Any], ...]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(
+        self,
+        key: Hashable,
+        build: Callable[[], Iterable[dict[str, Any]]],
+    ) -> tuple[dict[str, Any], ...]:
+        """Returns the messages cached under `key`, calling `build` to render
+        them on a miss."""
+        with self._lock:
+            messages = self._entries.get(key)
+            if messages is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return messages
+
+        # Render outside the lock; if two threads race, both results are
+        # equivalent and the first one stored wins.
+        built = tuple(build())
+
+        with self._lock:
+            self.misses += 1
+            messages = self._entries.setdefault(key, built)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            return messages
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class TruncationCache:
+    """Truncates prompt messages for logs and display without copying them on
+    every call.
+
+    Messages that are already short enough are returned as they are. Truncated
+    copies of system messages, which are the same objects every turn (see
+    `PromptCache`), are cached by identity; other long messages are copied.
+    Either way the results are shared, so treat them as immutable.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self._max_entries = max_entries
+        # Keyed by id(); the original message is kept alongside its truncated
+        # copy so the id can't be reused while the entry exists.
+        self._entries: dict[tuple[int, int], tuple[dict[str, Any], dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def truncate(self, messages: Iterable[dict[str, Any]], length: int) -> list[dict[str, Any]]:
+        entries = self._entries
+        result = []
+        for message in messages:
+            content = message["content"]
+            if len(content) <= length:
+                result.append(message)
+                continue
+
+            # Hits don't need the lock: dict lookups are atomic.
+            key = (id(message), length)
+            entry = entries.get(key)
+            if entry is not None and entry[0] is message:
+                result.append(entry[1])
+                continue
+
+            truncated = {**message, "content": content[:length] + "..."}
+            if message["role"] == "system":
+                self._store(key, message, truncated)
+            result.append(truncated)
+        return result
+
+    def _store(self, key: tuple[int, int], message: dict[str, Any], truncated: dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = (message, truncated)
+            # Evict in insertion order, which is fine for the handful of system
+            # prompts in use at a time.
+            while len(self._entries) > self._max_entries:
+                del self._entries[next(iter(self._entries))]
@@ -58,10 +58,33 @@ code. here is the reference of the javascript code syntax that you can use:
 $CODE_DOCS
 """
 
+# Used instead of $CODE_DOCS in the skills prompt when only the skills relevant
+# to each turn are sent.
+skills_reference_note = "It is included with each observation, limited to the skills most relevant at that point."
+
+relevant_skills_prompt = "Reference for the skills most relevant to your next step: $CODE_DOCS"
+
 examples_prompt = "Here are examples of Conversations: $EXAMPLES. "
 
 agent_prompt = "Your bot has the following configuration: $AGENT_MODE. "
 
+history_summary_prompt = """
+You are keeping notes for a mineflayer bot that plays minecraft. Here are your
+notes so far about what happened earlier in the game:
+
+$SUMMARY
+
+Here are the turns that happened since, each one with the event the bot
+received, the code it ran and any error:
+
+$TURNS
+
+Update the notes with anything from these turns that will matter later: what
+was achieved, what failed and why, where useful things are. Keep the existing
+notes unless they are out of date, and keep everything under $MAX_WORDS words.
+Return a json with an empty "code" and the updated notes as the "message".
+"""
+
 coding_examples = [
     [
         {"role": "user", "content": "greg: Collect 10 wood"},
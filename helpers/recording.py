@@ -0,0 +1,193 @@
+import dataclasses
+import json
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Callable, Iterator, Optional
+
+from kradle.models import ChallengeInfo, ChatMessage, GameMode, Observation, TimeOfDay, Weather
+
+from helpers.llm_clients import CompletionStream, LLMClient, LLMResponse
+
+
+def challenge_to_dict(challenge: ChallengeInfo) -> dict[str, Any]:
+    return dataclasses.asdict(challenge)
+
+
+def challenge_from_dict(data: dict[str, Any]) -> ChallengeInfo:
+    return ChallengeInfo(**data)
+
+
+def observation_to_dict(observation: Observation) -> dict[str, Any]:
+    return dataclasses.asdict(observation)
+
+
+def observation_from_dict(data: dict[str, Any]) -> Observation:
+    return Observation(
+        **{
+            **data,
+            "gamemode": GameMode(data["gamemode"]),
+            "weather": Weather(data["weather"]),
+            "time_of_day": TimeOfDay(data["time_of_day"]),
+            "chat_messages": [ChatMessage(**message) for message in data["chat_messages"]],
+        }
+    )
+
+
+class Recorder:
+    """Records what an agent saw to a JSONL file, so that it can be replayed
+    offline (see benchmarks/replay.py): the challenge each participant joined,
+    every observation it received and every LLM response it got, with its
+    latency.
+
+    Each line is a JSON object with a "type" of "init", "observation" or
+    "response" and the participant ID.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def _write(self, record: dict[str, Any]) -> None:
+        line = json.dumps({**record, "time": time.monotonic() - self._start}, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def record_init(self, challenge: ChallengeInfo) -> None:
+        self._write(
+            {"type": "init", "participant_id": challenge.participant_id, "challenge": challenge_to_dict(challenge)}
+        )
+
+    def record_observation(self, observation: Observation) -> None:
+        self._write(
+            {
+                "type": "observation",
+                "participant_id": observation.participant_id,
+                "observation": observation_to_dict(observation),
+            }
+        )
+
+    def record_response(self, participant_id: str, response: LLMResponse, latency: float) -> None:
+        self._write(
+            {
+                "type": "response",
+                "participant_id": participant_id,
+                "content": response.content,
+                "raw_response": response.raw_response,
+                "latency": latency,
+            }
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class RecordingClient:
+    """An LLM client that you can overlay on top of another `LLMClient` to
+    record each response it returns for one participant."""
+
+    def __init__(self, delegate: LLMClient, recorder: Recorder, participant_id: str):
+        self._delegate = delegate
+        self._recorder = recorder
+        self._participant_id = participant_id
+
+    def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        start = time.perf_counter()
+        response = self._delegate.get_chat_completion(messages)
+        self._recorder.record_response(self._participant_id, response, time.perf_counter() - start)
+        return response
+
+    def stream_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> CompletionStream:
+        """Streams the delegate's completion, recording the full response once
+        the stream has been read to the end."""
+        start = time.perf_counter()
+
+        def record(response: Optional[LLMResponse]) -> None:
+            if response is not None:
+                self._recorder.record_response(self._participant_id, response, time.perf_counter() - start)
+
+        return CompletionStream(self._delegate.stream_chat_completion(messages), on_done=record)
+
+
+def read_recording(path: str) -> Iterator[dict[str, Any]]:
+    """Yields the records of a recording, in order."""
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def latency_distribution(spec: str, recorded: Optional[list[float]] = None) -> Callable[[], float]:
+    """Returns a function that samples latencies, in seconds, described by
+    `spec`:
+
+    - "fixed:<seconds>"
+    - "uniform:<low>,<high>"
+    - "lognormal:<median>,<sigma>"
+    - "recorded", which samples from the `recorded` latencies
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(value) for value in args.split(",")] if args else []
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda: median * random.lognormvariate(0, sigma)
+    if kind == "recorded":
+        if not recorded:
+            raise ValueError("The recording has no response latencies")
+        return lambda: random.choice(recorded)
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class StubLLMClient:
+    """An LLM client that answers with canned responses after a simulated
+    latency, for offline benchmarks.
+
+    Responses are returned in order; once they run out, or if there are none,
+    `default` is returned.
+    """
+
+    def __init__(
+        self,
+        responses: Optional[list[str]] = None,
+        latency: Callable[[], float] = lambda: 0.0,
+        default: str = '{"code": "", "message": ""}',
+        model: str = "stub",
+    ):
+        self._responses = deque(responses or [])
+        self._latency = latency
+        self._default = default
+        self._lock = threading.Lock()
+        self.model = model
+
+    def get_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+    ) -> LLMResponse:
+        time.sleep(self._latency())
+        with self._lock:
+            content = self._responses.popleft() if self._responses else self._default
+        return LLMResponse(content=content, raw_response={"choices": [{"message": {"content": content}}]})
+
+
+def responses_by_participant(records: list[dict[str, Any]]) -> dict[str, list[str]]:
+    """Returns the recorded LLM response contents of each participant, in
+    order."""
+    responses: dict[str, list[str]] = defaultdict(list)
+    for record in records:
+        if record["type"] == "response":
+            responses[record["participant_id"]].append(record["content"])
+    return responses
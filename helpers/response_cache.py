@@ -0,0 +1,111 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Protocol
+
+# A cached completion: the message content and the raw provider response.
+CachedResponse = tuple[str, dict[str, Any]]
+
+
+class ResponseCacheBackend(Protocol):
+    """Storage for `CachingClient`. Entries expire after their TTL and the
+    least recently used entries are evicted once the backend is full."""
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """Returns the unexpired entry stored under `key`, if any."""
+        ...
+
+    def set(self, key: str, value: CachedResponse, ttl: float) -> None:
+        """Stores `value` under `key` for `ttl` seconds."""
+        ...
+
+
+class MemoryCacheBackend:
+    """An in-process LRU cache backend."""
+
+    def __init__(self, max_entries: int = 1024):
+        self._max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, CachedResponse]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: CachedResponse, ttl: float) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteCacheBackend:
+    """A cache backend stored in a SQLite database, so cached responses survive
+    across runs. Expiry uses wall-clock time for the same reason."""
+
+    def __init__(self, path: str, max_entries: int = 10000):
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    content TEXT NOT NULL,
+                    raw_response TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                """
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT content, raw_response, expires_at FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            content, raw_response, expires_at = row
+            if expires_at < now:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        return content, json.loads(raw_response)
+
+    def set(self, key: str, value: CachedResponse, ttl: float) -> None:
+        now = time.time()
+        content, raw_response = value
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, content, json.dumps(raw_response, default=str), now + ttl, now),
+            )
+            self._db.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+            self._db.execute(
+                """
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self._max_entries,),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,140 @@
+import json
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Any, Iterable, Mapping
+
+from helpers.tokens import estimate_tokens
+
+_WORD = re.compile(r"[A-Za-z]+|\d+")
+_CAMEL_CASE = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Splits text into lowercase terms, also splitting identifiers like
+    `goToPlayer` or `oak_log` into their words."""
+    terms = []
+    for word in _WORD.findall(text):
+        parts = _CAMEL_CASE.findall(word)
+        terms.extend(part.lower() for part in parts)
+        if len(parts) > 1:
+            terms.append(word.lower())
+    return terms
+
+
+class BM25Index:
+    """A small in-memory full-text index that ranks documents with Okapi BM25.
+
+    Built once from a fixed list of documents; searching only touches the
+    postings of the query's terms, so it stays fast with hundreds of documents.
+    """
+
+    def __init__(self, documents: Iterable[str], k1: float = 1.5, b: float = 0.75):
+        self._k1 = k1
+        self._postings: dict[str, list[tuple[int, int]]] = defaultdict(list)
+        lengths = []
+        for index, document in enumerate(documents):
+            terms = Counter(tokenize(document))
+            for term, count in terms.items():
+                self._postings[term].append((index, count))
+            lengths.append(sum(terms.values()))
+
+        self.size = len(lengths)
+        average_length = sum(lengths) / self.size if self.size else 0.0
+        # Precompute the length normalization of each document.
+        self._norms = [k1 * (1 - b + b * length / average_length) if average_length else k1 for length in lengths]
+        self._idf = {
+            term: math.log((self.size - len(postings) + 0.5) / (len(postings) + 0.5) + 1)
+            for term, postings in self._postings.items()
+        }
+
+    def search(self, query: str, limit: int = 10) -> list[tuple[int, float]]:
+        """Returns the indexes and scores of the documents that best match
+        `query`, best first. Documents that share no terms with it are left
+        out."""
+        scores: dict[int, float] = defaultdict(float)
+        for term, query_count in Counter(tokenize(query)).items():
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for index, count in self._postings[term]:
+                scores[index] += query_count * idf * count * (self._k1 + 1) / (count + self._norms[index])
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+class SkillIndex:
+    """An index over a challenge's skill reference (`ChallengeInfo.js_functions`)
+    for picking the skills relevant to the current situation.
+
+    Args:
+        skills: The skill reference, mapping skill names to their docs.
+        pinned: Skills that are always selected, by name. A name also matches
+            skills in a namespace, e.g. "goToPosition" matches
+            "skills.goToPosition".
+    """
+
+    def __init__(self, skills: Mapping[str, Any], pinned: Iterable[str] = ()):
+        self._skills = dict(skills)
+        self._names = list(self._skills)
+        self._index = BM25Index(f"{name} {_describe(docs)}" for name, docs in self._skills.items())
+        pinned = set(pinned)
+        self._pinned = [name for name in self._names if name in pinned or name.rsplit(".", 1)[-1] in pinned]
+
+    def select(self, query: str, limit: int = 8) -> dict[str, Any]:
+        """Returns the pinned skills and the `limit` skills that best match
+        `query`, in the order they appear in the reference."""
+        selected = set(self._pinned)
+        selected.update(self._names[index] for index, _ in self._index.search(query, limit))
+        return {name: self._skills[name] for name in self._names if name in selected}
+
+    def __len__(self) -> int:
+        return len(self._skills)
+
+
+class ExampleStore:
+    """A library of example conversations for few-shot prompting, from which
+    the examples most similar to the current situation are picked.
+
+    Each example is serialized to compact JSON once, when the store is created,
+    so selecting examples only concatenates strings.
+    """
+
+    def __init__(self, examples: Iterable[Any]):
+        examples = list(examples)
+        self._serialized = [json.dumps(example, separators=(",", ":")) for example in examples]
+        self._tokens = [estimate_tokens(serialized) for serialized in self._serialized]
+        self._index = BM25Index(_describe(example) for example in examples)
+
+    def select(self, query: str, limit: int = 3, budget: int = 800) -> str:
+        """Returns a JSON array of up to `limit` examples that best match
+        `query` and fit in `budget` tokens, best first. If none match, the first
+        examples in the library are used instead."""
+        ranked = [index for index, _ in self._index.search(query, len(self._serialized))]
+        if not ranked:
+            ranked = list(range(len(self._serialized)))
+
+        selected = []
+        used = 0
+        for index in ranked:
+            if len(selected) == limit:
+                break
+            if used + self._tokens[index] > budget:
+                continue
+            selected.append(self._serialized[index])
+            used += self._tokens[index]
+        return "[" + ",".join(selected) + "]"
+
+    def all(self) -> str:
+        """Returns every example as a JSON array."""
+        return "[" + ",".join(self._serialized) + "]"
+
+    def __len__(self) -> int:
+        return len(self._serialized)
+
+
+def _describe(docs: Any) -> str:
+    if isinstance(docs, Mapping):
+        return " ".join(f"{key} {_describe(value)}" for key, value in docs.items())
+    if isinstance(docs, (list, tuple)):
+        return " ".join(_describe(value) for value in docs)
+    return str(docs)
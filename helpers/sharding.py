@@ -0,0 +1,480 @@
+import json
+import multiprocessing
+import signal
+import socket
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Optional
+
+import requests
+from kradle import Agent, Kradle
+from kradle.agent_manager import AgentManager
+from kradle.api.http import KradleAPIError
+from kradle.ssh_tunnel import create_tunnel
+from typing_extensions import TypeAlias
+
+# The status, body and headers of a response.
+Response: TypeAlias = tuple[int, bytes, dict[str, str]]
+
+_JSON = {"Content-Type": "application/json"}
+
+# Creates the agent in a worker process. It must be a module-level function,
+# like `setup` in the example scripts, so that it can be sent to the worker.
+AgentSetup = Callable[[Kradle], Agent]
+
+
+def _error(status: int, message: str) -> Response:
+    return status, json.dumps({"error": message}).encode(), _JSON
+
+
+def _is_forwarded_header(name: str) -> bool:
+    # The content type, and the CORS headers the Kradle web UI relies on.
+    name = name.lower()
+    return name in ("content-type", "origin") or name.startswith("access-control-")
+
+
+def _free_port(host: str) -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def _run_worker(setup: AgentSetup, host: str, port: int) -> None:
+    """The entry point of a worker process: serves the agent on localhost."""
+    # Exit normally on SIGTERM, so that atexit handlers like the log shipper's
+    # flush run.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    agent = setup(Kradle(create_public_url=False, host=host, port=port))
+    # Serve the agent's routes without registering this worker's URL with
+    # Kradle; the supervisor registers its own.
+    (app,) = AgentManager.create_cloud_agent(agent)
+    app.run(host=host, port=port, threaded=True, use_reloader=False)
+
+
+class _Worker:
+    """A worker process and the bookkeeping the supervisor needs to route to it
+    and restart it without dropping requests."""
+
+    def __init__(self, index: int, host: str):
+        self.index = index
+        self.host = host
+        self.port = 0
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        # Incremented every time the process is replaced; participants
+        # initialized on an earlier generation must be initialized again.
+        self.generation = 0
+        self.restarts = 0
+        self.requests = 0
+        self.failed_checks = 0
+        self.restarting = False
+        self._ready = False
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def acquire(self, timeout: float) -> bool:
+        """Waits up to `timeout` seconds for the worker to be ready, and counts
+        a request in flight on it. Returns False if it didn't become ready."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while not self._ready:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self._in_flight += 1
+            self.requests += 1
+            return True
+
+    def release(self) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def drain(self, timeout: float) -> None:
+        """Holds new requests, and waits up to `timeout` seconds for the ones
+        in flight to finish."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._ready = False
+            while self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+    def open(self) -> None:
+        with self._condition:
+            self._ready = True
+            self._condition.notify_all()
+
+    def stats(self) -> dict[str, Any]:
+        with self._condition:
+            return {
+                "port": self.port,
+                "pid": self.process.pid if self.process else None,
+                "ready": self._ready,
+                "in_flight": self._in_flight,
+                "requests": self.requests,
+                "restarts": self.restarts,
+                "generation": self.generation,
+            }
+
+
+class ShardedServer:
+    """Serves an agent from `workers` processes, so that prompt building,
+    response parsing and logging for different participants run on different
+    cores instead of contending for one interpreter.
+
+    The supervisor (the process that calls `serve`) registers a single URL with
+    Kradle and proxies each request to a worker. A participant is always routed
+    to the same worker, by a hash of its run and participant IDs, because its
+    `Context` lives in that worker.
+
+    Workers are checked every `health_interval` seconds and restarted if they
+    die or fail `max_failed_checks` checks in a row. Sending the supervisor
+    SIGHUP restarts the workers one at a time. A restart is graceful: requests
+    for the worker are held while the ones in flight finish, and the
+    participants it was serving are initialized again on the new process before
+    their next event, so they lose their history but keep playing.
+
+    Args:
+        setup: Creates the agent, given a `Kradle`. It runs in every worker.
+        workers: The number of worker processes.
+        health_interval: Seconds between health checks.
+        max_failed_checks: Consecutive failed health checks before a worker is
+            restarted.
+        drain_timeout: How long a restart waits for requests in flight.
+        startup_timeout: How long to wait for a worker to start serving, and
+            how long requests are held while it does.
+        max_participants: How many participants' init requests to remember for
+            re-initializing them after a restart.
+    """
+
+    def __init__(
+        self,
+        setup: AgentSetup,
+        workers: int = 4,
+        health_interval: float = 5.0,
+        max_failed_checks: int = 3,
+        drain_timeout: float = 60.0,
+        startup_timeout: float = 60.0,
+        max_participants: int = 10000,
+        host: str = "localhost",
+    ):
+        if workers < 1:
+            raise ValueError("At least one worker is required")
+        self._setup = setup
+        self._health_interval = health_interval
+        self._max_failed_checks = max_failed_checks
+        self._drain_timeout = drain_timeout
+        self._startup_timeout = startup_timeout
+        self._max_participants = max_participants
+        self._multiprocessing = multiprocessing.get_context("spawn")
+        self._workers = [_Worker(index, host) for index in range(workers)]
+        self._lock = threading.Lock()
+        # The path and body of each participant's init request, and the worker
+        # generation it was delivered to, by run and participant ID.
+        self._inits: OrderedDict[str, tuple[str, bytes, int]] = OrderedDict()
+        self._sessions = threading.local()
+        self._stopping = threading.Event()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def shard(self, run_id: str, participant_id: str) -> int:
+        """Returns the index of the worker that serves a participant."""
+        return zlib.crc32(f"{run_id}:{participant_id}".encode()) % len(self._workers)
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._sessions, "session", None)
+        if session is None:
+            session = self._sessions.session = requests.Session()
+        return session
+
+    def _start(self, worker: _Worker) -> None:
+        worker.port = _free_port(worker.host)
+        worker.process = self._multiprocessing.Process(
+            target=_run_worker,
+            args=(self._setup, worker.host, worker.port),
+            name=f"agent-worker-{worker.index}",
+            daemon=True,
+        )
+        worker.process.start()
+
+        deadline = time.monotonic() + self._startup_timeout
+        while time.monotonic() < deadline and worker.process.is_alive():
+            if self._check(worker):
+                worker.failed_checks = 0
+                worker.open()
+                return
+            time.sleep(0.2)
+        print(f"Worker {worker.index} didn't start serving within {self._startup_timeout:.0f}s")
+
+    def _stop(self, worker: _Worker) -> None:
+        if worker.process is None:
+            return
+        worker.process.terminate()
+        worker.process.join(10)
+        if worker.process.is_alive():
+            worker.process.kill()
+            worker.process.join()
+
+    def restart(self, index: int, graceful: bool = True) -> None:
+        """Replaces a worker process with a new one."""
+        worker = self._workers[index]
+        with self._lock:
+            if worker.restarting:
+                return
+            worker.restarting = True
+        self._replace(worker, graceful)
+
+    def _crashed(self, worker: _Worker, generation: Optional[int] = None) -> None:
+        """Holds requests for a worker whose process has exited right away, and
+        replaces it in the background. Pass the `generation` of the process
+        that a request couldn't reach to replace it even if it's still
+        running, e.g. because it no longer accepts connections."""
+        with self._lock:
+            if worker.restarting or worker.process is None:
+                return
+            alive = worker.process.is_alive()
+            if alive and (generation is None or generation != worker.generation):
+                return
+            worker.restarting = True
+        print(f"Worker {worker.index} {'is unreachable' if alive else 'exited'}")
+        worker.drain(0)
+        threading.Thread(target=self._replace, args=(worker, False), daemon=True).start()
+
+    def _replace(self, worker: _Worker, graceful: bool) -> None:
+        try:
+            print(f"Restarting worker {worker.index}")
+            worker.drain(self._drain_timeout if graceful else 0)
+            self._stop(worker)
+            with self._lock:
+                worker.generation += 1
+                worker.restarts += 1
+            if not self._stopping.is_set():
+                self._start(worker)
+        finally:
+            worker.restarting = False
+
+    def restart_all(self) -> None:
+        """Restarts the workers one at a time, so that the others keep
+        serving."""
+        for worker in self._workers:
+            self.restart(worker.index)
+
+    def _check(self, worker: _Worker) -> bool:
+        try:
+            return requests.get(f"{worker.url}/ping", timeout=5).ok
+        except requests.RequestException:
+            return False
+
+    def _monitor(self) -> None:
+        while not self._stopping.wait(self._health_interval):
+            for worker in self._workers:
+                if worker.restarting:
+                    continue
+                if worker.process is None or not worker.process.is_alive():
+                    self._crashed(worker)
+                elif self._check(worker):
+                    worker.failed_checks = 0
+                else:
+                    worker.failed_checks += 1
+                    if worker.failed_checks >= self._max_failed_checks:
+                        print(f"Worker {worker.index} failed {worker.failed_checks} health checks")
+                        threading.Thread(target=self.restart, args=(worker.index,), daemon=True).start()
+
+    def forward(self, method: str, path: str, body: bytes, headers: dict[str, str]) -> Response:
+        """Forwards a request from Kradle to the worker that serves its
+        participant, and returns the status, body and headers of the
+        response."""
+        endpoint = path.rstrip("/").rsplit("/", 1)[-1]
+        if method != "POST" or endpoint not in ("init", "event"):
+            # Pings and agent info are the same on every worker.
+            return self._send(self._workers[0], method, path, body, headers)
+
+        try:
+            data = json.loads(body)
+            key = f"{data['runId']}:{data['participantId']}"
+        except (ValueError, KeyError, TypeError):
+            return _error(400, "participantId and runId are required")
+
+        worker = self._workers[self.shard(data["runId"], data["participantId"])]
+        for attempt in range(2):
+            if not worker.acquire(self._startup_timeout):
+                return _error(503, "worker unavailable")
+            generation, process = worker.generation, worker.process
+            try:
+                if endpoint == "init":
+                    with self._lock:
+                        self._inits[key] = (path, body, worker.generation)
+                        self._inits.move_to_end(key)
+                        while len(self._inits) > self._max_participants:
+                            self._inits.popitem(last=False)
+                else:
+                    self._reinitialize(worker, key)
+                return self._request(worker, method, path, body, headers)
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                # The worker crashed, or is crashing, so the request never got
+                # an answer. Send it again once the worker has been replaced.
+                if attempt:
+                    return _error(502, str(e))
+            except requests.RequestException as e:
+                return _error(502, str(e))
+            finally:
+                worker.release()
+
+            # Give a dying process a moment to exit, then replace it even if
+            # it hasn't: it can't be reached either way.
+            if process is not None:
+                process.join(1)
+            self._crashed(worker, generation)
+        return _error(502, "worker unavailable")
+
+    def _reinitialize(self, worker: _Worker, key: str) -> None:
+        """Initializes a participant again if its worker has been restarted
+        since it was initialized."""
+        with self._lock:
+            init = self._inits.get(key)
+            if init is None or init[2] == worker.generation:
+                return
+            self._inits[key] = (init[0], init[1], worker.generation)
+        status, _, _ = self._send(worker, "POST", init[0], init[1], {})
+        if status != 200:
+            print(f"Error re-initializing participant {key} on worker {worker.index}: {status}")
+
+    def _send(self, worker: _Worker, method: str, path: str, body: bytes, headers: dict[str, str]) -> Response:
+        try:
+            return self._request(worker, method, path, body, headers)
+        except requests.RequestException as e:
+            return _error(502, str(e))
+
+    def _request(self, worker: _Worker, method: str, path: str, body: bytes, headers: dict[str, str]) -> Response:
+        response = self._session().request(
+            method,
+            f"{worker.url}{path}",
+            data=body or None,
+            headers={"Content-Type": "application/json", **headers},
+            timeout=300,
+        )
+        return (
+            response.status_code,
+            response.content,
+            {name: value for name, value in response.headers.items() if _is_forwarded_header(name)},
+        )
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            participants = [0] * len(self._workers)
+            for key in self._inits:
+                run_id, participant_id = key.split(":", 1)
+                participants[self.shard(run_id, participant_id)] += 1
+        return {
+            "workers": [
+                {**worker.stats(), "participants": count} for worker, count in zip(self._workers, participants)
+            ],
+        }
+
+    def serve(self, agent: Agent) -> str:
+        """Starts the workers, registers the agent with Kradle and serves it
+        until the process is interrupted. `agent` only provides the name,
+        description and serving options (`Kradle`'s host, port and public URL
+        settings); its handlers run in the workers, created by `setup`.
+
+        Returns the agent's URL once serving stops.
+        """
+        kradle = agent.kradle
+        host = kradle.host
+        port = kradle.port or _free_port(host)
+
+        threads = [threading.Thread(target=self._start, args=(worker,)) for worker in self._workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        threading.Thread(target=self._monitor, name="worker-monitor", daemon=True).start()
+
+        self._server = ThreadingHTTPServer((host, port), _ProxyHandler)
+        self._server.daemon_threads = True
+        self._server.sharded = self  # type: ignore[attr-defined]
+
+        if kradle.create_public_url:
+            _, base_url = create_tunnel(port)
+            if base_url is None:
+                raise RuntimeError("Failed to create a public URL (tunnel)")
+        else:
+            base_url = kradle.public_url or f"http://{host}:{port}"
+        agent_url = f"{base_url}/{agent.name}"
+        self._register(agent, agent_url)
+        print(f"Serving {agent.name} from {len(self._workers)} workers at {agent_url}")
+
+        if threading.current_thread() is threading.main_thread():
+            # `shutdown` waits for `serve_forever`, which runs on this thread.
+            signal.signal(
+                signal.SIGTERM,
+                lambda signum, frame: threading.Thread(target=self._server.shutdown).start(),  # type: ignore[union-attr]
+            )
+            if hasattr(signal, "SIGHUP"):
+                signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=self.restart_all).start())
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+        return agent_url
+
+    def close(self) -> None:
+        """Stops the workers, letting requests in flight finish first."""
+        self._stopping.set()
+        for worker in self._workers:
+            worker.drain(self._drain_timeout)
+            self._stop(worker)
+        if self._server:
+            self._server.server_close()
+
+    def _register(self, agent: Agent, url: str) -> None:
+        # The same as `agent.serve()` does: update the agent's URL, creating
+        # the agent if it doesn't exist yet.
+        api = agent.kradle.api
+        description = agent.description or "Created by the Kradle Python SDK"
+        try:
+            api.agents.update(agent.name, name=agent.display_name or agent.name, url=url, description=description)
+        except KradleAPIError as e:
+            if e.status_code != 404:
+                raise
+            api.agents.create(agent.name, name=agent.display_name or agent.name, url=url, description=description)
+
+
+class _ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self) -> None:
+        sharded: ShardedServer = self.server.sharded  # type: ignore[attr-defined]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.rstrip("/") == "/supervisor":
+            status, content, headers = 200, json.dumps(sharded.stats()).encode(), _JSON
+        else:
+            request_headers = {name: value for name, value in self.headers.items() if _is_forwarded_header(name)}
+            status, content, headers = sharded.forward(self.command, self.path, body, request_headers)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = _handle
+    do_POST = _handle
+    do_OPTIONS = _handle
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
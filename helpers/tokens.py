@@ -0,0 +1,34 @@
+from typing import Any, Iterable
+
+# Rough number of characters per token for English text and code. Exact counts
+# depend on the model's tokenizer, but budgets only need to be about right.
+CHARS_PER_TOKEN = 4
+
+# Tokens that chat APIs add around each message for the role and separators.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Returns an estimate of the number of tokens in `text`."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def estimate_message_tokens(message: dict[str, Any]) -> int:
+    """Returns an estimate of the number of prompt tokens a chat message uses."""
+    return estimate_tokens(str(message["content"])) + MESSAGE_OVERHEAD_TOKENS
+
+
+def estimate_messages_tokens(messages: Iterable[dict[str, Any]]) -> int:
+    return sum(estimate_message_tokens(message) for message in messages)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Shortens `text` to about `max_tokens` tokens, keeping its beginning and
+    end, which is where command output usually has the interesting parts."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    marker = "\n...\n"
+    head = (max_chars - len(marker)) * 2 // 3
+    tail = max_chars - len(marker) - head
+    return text[:head] + marker + (text[-tail:] if tail > 0 else "")
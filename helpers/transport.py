@@ -0,0 +1,529 @@
+import codecs
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Iterator, Mapping, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from helpers.metrics import metrics
+
+try:
+    import httpx
+except ImportError:  # HTTP/2 support is optional
+    httpx = None  # type: ignore[assignment]
+
+
+# Status codes that are safe to retry for idempotent requests. Completion
+# requests are POSTs, so they are only retried when the connection could not be
+# established in the first place.
+RETRY_STATUSES = (502, 503, 504)
+
+
+class TransportError(Exception):
+    """A request failed, either because the host could not be reached or
+    because it responded with an error status.
+
+    `status_code` is None for network errors. `retry_after` is the number of
+    seconds the host asked us to wait before retrying, if it said.
+    """
+
+    def __init__(
+        self,
+        message: str,
+        status_code: Optional[int] = None,
+        retry_after: Optional[float] = None,
+        body: Optional[str] = None,
+    ):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.body = body
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses a Retry-After header, which is either a number of seconds or an
+    HTTP date, into a number of seconds from now."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _raise_for_status(url: str, status_code: int, headers: Mapping[str, str], body: str) -> None:
+    if status_code >= 400:
+        raise TransportError(
+            f"Request to {url} failed with HTTP {status_code}",
+            status_code=status_code,
+            retry_after=parse_retry_after(headers.get("Retry-After")),
+            body=body,
+        )
+
+
+# Exceptions raised by the HTTP libraries when a host can't be reached or a
+# request times out.
+_NETWORK_ERRORS: tuple[type[Exception], ...] = (requests.RequestException,)
+if httpx is not None:
+    _NETWORK_ERRORS += (httpx.HTTPError,)
+
+
+# Time spent establishing connections by `requests` on the current thread, as
+# measured by the timed connection classes.
+_connect_time = threading.local()
+
+
+class _RequestTimer:
+    """Measures the phases of one request and records them in `metrics` as
+    `http_connect` (only for new connections), `http_ttfb` (until the response
+    headers arrived) and `http_total`."""
+
+    __slots__ = ("host", "start", "connect", "ttfb", "_connect_start")
+
+    def __init__(self, url: str):
+        self.host = urlsplit(url).netloc
+        self.start = time.perf_counter()
+        self.connect: Optional[float] = None
+        self.ttfb: Optional[float] = None
+        self._connect_start = 0.0
+
+    def trace(self, event_name: str, info: dict[str, Any]) -> None:
+        """An httpx trace callback."""
+        now = time.perf_counter()
+        if event_name == "connection.connect_tcp.started":
+            self._connect_start = now
+        elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            self.connect = now - self._connect_start
+        elif event_name.endswith(".receive_response_headers.complete"):
+            self.ttfb = now - self.start
+
+    async def async_trace(self, event_name: str, info: dict[str, Any]) -> None:
+        self.trace(event_name, info)
+
+    @property
+    def reused(self) -> bool:
+        return self.connect is None
+
+    def headers_received(self) -> None:
+        if self.ttfb is None:
+            self.ttfb = time.perf_counter() - self.start
+
+    def finish(self) -> None:
+        if self.connect is not None:
+            metrics.observe("http_connect", self.connect, host=self.host)
+        if self.ttfb is not None:
+            metrics.observe("http_ttfb", self.ttfb, host=self.host)
+        metrics.observe("http_total", time.perf_counter() - self.start, host=self.host)
+
+
+def _timed_connection_class(base: type) -> type:
+    """Returns a subclass of the given urllib3 connection class that adds the
+    time it takes to connect to `_connect_time`."""
+
+    class TimedConnection(base):  # type: ignore[valid-type, misc]
+        def connect(self) -> None:
+            start = time.perf_counter()
+            try:
+                super().connect()
+            finally:
+                _connect_time.seconds = (getattr(_connect_time, "seconds", None) or 0.0) + time.perf_counter() - start
+
+    return TimedConnection
+
+
+class PoolStats:
+    """Counts how often a request was served by an already-open connection
+    (a hit) versus one that had to be established first (a miss)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, reused: bool) -> None:
+        with self._lock:
+            if reused:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def as_dict(self) -> dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
+
+
+def _counting_pool_class(base: type[HTTPConnectionPool], stats: PoolStats) -> type[HTTPConnectionPool]:
+    """Returns a subclass of the given urllib3 pool that records every
+    connection checkout in `stats` and times new connections."""
+
+    class CountingPool(base):  # type: ignore[valid-type, misc]
+        ConnectionCls = _timed_connection_class(base.ConnectionCls)
+
+        def _get_conn(self, timeout: Optional[float] = None) -> Any:
+            conn = super()._get_conn(timeout)
+            # Fresh and dropped connections have no socket until they connect.
+            stats.record(reused=getattr(conn, "sock", None) is not None)
+            return conn
+
+    return CountingPool
+
+
+class _PoolingAdapter(HTTPAdapter):
+    """A requests adapter whose connection pools report hits and misses."""
+
+    def __init__(self, stats: PoolStats, **kwargs: Any):
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool_class(HTTPConnectionPool, self._stats),
+            "https": _counting_pool_class(HTTPSConnectionPool, self._stats),
+        }
+
+
+def _limits(pool_size: int, keep_alive: bool) -> "httpx.Limits":
+    return httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size if keep_alive else 0)
+
+
+def _read_available(raw: Any, size: int = 8192) -> Iterator[bytes]:
+    """Yields the data of a urllib3 response as soon as it arrives. Unlike
+    `requests`' `iter_content`, this doesn't wait for the end of responses that
+    are neither chunked nor of known length."""
+    while True:
+        data = raw.read1(size, decode_content=True)
+        if not data:
+            return
+        yield data
+
+
+def _split_lines(chunks: Iterator[bytes], encoding: str) -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    pending = ""
+    for chunk in chunks:
+        *lines, pending = (pending + decoder.decode(chunk)).split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+class HTTPTransport:
+    """A pooled, keep-alive HTTP transport for talking to a single provider host.
+
+    Reusing connections avoids paying for a TCP and TLS handshake on every
+    request. Requests are sent with `requests` by default; pass `http2=True` to
+    use `httpx` instead, which must be installed with its `http2` extra.
+
+    Args:
+        pool_size: The maximum number of connections kept open to the host.
+        keep_alive: Whether connections are kept open between requests.
+        retries: How many times to retry requests that failed in a way that is
+            safe to retry (connection errors, or 5xx for idempotent methods).
+        http2: Whether to negotiate HTTP/2 with the host.
+    """
+
+    def __init__(self, pool_size: int = 10, keep_alive: bool = True, retries: int = 2, http2: bool = False):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.http2 = http2
+        self.stats = PoolStats()
+
+        self._headers = {} if keep_alive else {"Connection": "close"}
+        self._session: Optional[requests.Session] = None
+        self._client: Any = None
+
+        if http2:
+            if httpx is None:
+                raise ValueError("HTTP/2 requires the httpx package: pip install 'httpx[http2]'")
+            # httpx ignores the client's limits when it is given a transport,
+            # so they go on the transport.
+            self._client = httpx.Client(
+                http2=True,
+                transport=httpx.HTTPTransport(http2=True, retries=retries, limits=_limits(pool_size, keep_alive)),
+            )
+        else:
+            adapter = _PoolingAdapter(
+                self.stats,
+                pool_connections=1,
+                pool_maxsize=pool_size,
+                max_retries=Retry(
+                    total=retries,
+                    connect=retries,
+                    read=retries,
+                    status=retries,
+                    status_forcelist=RETRY_STATUSES,
+                    allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                    backoff_factor=0.2,
+                    raise_on_status=False,
+                ),
+            )
+            self._session = requests.Session()
+            self._session.mount("http://", adapter)
+            self._session.mount("https://", adapter)
+
+    def post_json(
+        self,
+        url: str,
+        json: Any,
+        headers: Optional[dict[str, str]] = None,
+        timeout: float = 30,
+    ) -> Any:
+        """Posts `json` to `url` and returns the decoded JSON response body.
+
+        Raises:
+            TransportError: If the request failed or returned an error status.
+        """
+        headers = {**self._headers, **(headers or {})}
+        timer = _RequestTimer(url)
+
+        try:
+            if self._client is not None:
+                response = self._client.post(
+                    url,
+                    json=json,
+                    headers=headers,
+                    timeout=timeout,
+                    extensions={"trace": timer.trace},
+                )
+                self.stats.record(reused=timer.reused)
+            else:
+                assert self._session is not None
+                _connect_time.seconds = None
+                response = self._session.post(url, json=json, headers=headers, timeout=timeout)
+                # requests measures the time until the headers were parsed.
+                timer.connect = _connect_time.seconds
+                timer.ttfb = response.elapsed.total_seconds()
+        except _NETWORK_ERRORS as e:
+            raise TransportError(f"Request to {url} failed: {e}") from e
+
+        try:
+            _raise_for_status(url, response.status_code, response.headers, response.text)
+            return response.json()
+        finally:
+            timer.finish()
+
+    def stream_lines(
+        self,
+        url: str,
+        json: Any,
+        headers: Optional[dict[str, str]] = None,
+        timeout: float = 30,
+    ) -> Iterator[str]:
+        """Posts `json` to `url` and yields the lines of the response body as
+        they arrive. The connection returns to the pool once the iterator is
+        exhausted or closed.
+
+        Raises:
+            TransportError: If the request failed or returned an error status.
+        """
+        headers = {**self._headers, **(headers or {})}
+        timer = _RequestTimer(url)
+
+        try:
+            if self._client is not None:
+                with self._client.stream(
+                    "POST",
+                    url,
+                    json=json,
+                    headers=headers,
+                    timeout=timeout,
+                    extensions={"trace": timer.trace},
+                ) as response:
+                    self.stats.record(reused=timer.reused)
+                    if response.status_code >= 400:
+                        _raise_for_status(url, response.status_code, response.headers, response.read().decode())
+                    yield from response.iter_lines()
+                return
+
+            assert self._session is not None
+            _connect_time.seconds = None
+            with self._session.post(url, json=json, headers=headers, timeout=timeout, stream=True) as response:
+                timer.connect = _connect_time.seconds
+                timer.headers_received()
+                # Only read the body of errors; reading that of a successful
+                # response would wait for the whole stream.
+                if response.status_code >= 400:
+                    _raise_for_status(url, response.status_code, response.headers, response.text)
+                # Streaming APIs send UTF-8 but rarely declare a charset.
+                yield from _split_lines(_read_available(response.raw), response.encoding or "utf-8")
+        except _NETWORK_ERRORS as e:
+            raise TransportError(f"Request to {url} failed: {e}") from e
+        finally:
+            timer.finish()
+
+    def close(self) -> None:
+        """Closes all pooled connections."""
+        if self._client is not None:
+            self._client.close()
+        if self._session is not None:
+            self._session.close()
+
+
+class AsyncHTTPTransport:
+    """The asyncio counterpart of `HTTPTransport`, built on `httpx.AsyncClient`.
+
+    Connections belong to the event loop that opened them, so a transport must
+    only be used from a single event loop. Takes the same arguments as
+    `HTTPTransport`.
+    """
+
+    def __init__(self, pool_size: int = 10, keep_alive: bool = True, retries: int = 2, http2: bool = False):
+        if httpx is None:
+            raise ValueError("Async clients require the httpx package: pip install httpx")
+
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.http2 = http2
+        self.stats = PoolStats()
+
+        self._headers = {} if keep_alive else {"Connection": "close"}
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            transport=httpx.AsyncHTTPTransport(http2=http2, retries=retries, limits=_limits(pool_size, keep_alive)),
+        )
+
+    async def post_json(
+        self,
+        url: str,
+        json: Any,
+        headers: Optional[dict[str, str]] = None,
+        timeout: float = 30,
+    ) -> Any:
+        """Posts `json` to `url` and returns the decoded JSON response body.
+
+        Raises:
+            TransportError: If the request failed or returned an error status.
+        """
+        timer = _RequestTimer(url)
+
+        try:
+            response = await self._client.post(
+                url,
+                json=json,
+                headers={**self._headers, **(headers or {})},
+                timeout=timeout,
+                extensions={"trace": timer.async_trace},
+            )
+        except _NETWORK_ERRORS as e:
+            raise TransportError(f"Request to {url} failed: {e}") from e
+
+        self.stats.record(reused=timer.reused)
+        try:
+            _raise_for_status(url, response.status_code, response.headers, response.text)
+            return response.json()
+        finally:
+            timer.finish()
+
+    async def stream_lines(
+        self,
+        url: str,
+        json: Any,
+        headers: Optional[dict[str, str]] = None,
+        timeout: float = 30,
+    ) -> AsyncIterator[str]:
+        """Posts `json` to `url` and yields the lines of the response body as
+        they arrive.
+
+        Raises:
+            TransportError: If the request failed or returned an error status.
+        """
+        timer = _RequestTimer(url)
+
+        try:
+            async with self._client.stream(
+                "POST",
+                url,
+                json=json,
+                headers={**self._headers, **(headers or {})},
+                timeout=timeout,
+                extensions={"trace": timer.async_trace},
+            ) as response:
+                self.stats.record(reused=timer.reused)
+                if response.status_code >= 400:
+                    _raise_for_status(url, response.status_code, response.headers, (await response.aread()).decode())
+                async for line in response.aiter_lines():
+                    yield line
+        except _NETWORK_ERRORS as e:
+            raise TransportError(f"Request to {url} failed: {e}") from e
+        finally:
+            timer.finish()
+
+    async def close(self) -> None:
+        """Closes all pooled connections."""
+        await self._client.aclose()
+
+
+_transports: dict[str, HTTPTransport] = {}
+_async_transports: dict[str, AsyncHTTPTransport] = {}
+_transports_lock = threading.Lock()
+
+
+def _host_key(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def shared_transport(url: str, **options: Any) -> HTTPTransport:
+    """Returns the process-wide transport for the host that `url` points to.
+
+    The transport is created on first use with the given `options` (see
+    `HTTPTransport`); later calls for the same host return the existing
+    transport and ignore `options`. Use `configure_transport` to change the
+    settings for a host.
+    """
+    key = _host_key(url)
+    with _transports_lock:
+        transport = _transports.get(key)
+        if transport is None:
+            transport = HTTPTransport(**options)
+            _transports[key] = transport
+        return transport
+
+
+def shared_async_transport(url: str, **options: Any) -> AsyncHTTPTransport:
+    """Like `shared_transport`, but returns the process-wide
+    `AsyncHTTPTransport` for the host."""
+    key = _host_key(url)
+    with _transports_lock:
+        transport = _async_transports.get(key)
+        if transport is None:
+            transport = AsyncHTTPTransport(**options)
+            _async_transports[key] = transport
+        return transport
+
+
+def configure_transport(url: str, **options: Any) -> HTTPTransport:
+    """Replaces the shared transport for the host that `url` points to with a
+    new one created from `options`. Clients created afterwards will use it;
+    existing clients keep the transport they were created with."""
+    key = _host_key(url)
+    transport = HTTPTransport(**options)
+    with _transports_lock:
+        _transports[key] = transport
+    return transport
+
+
+def transport_stats() -> dict[str, dict[str, Any]]:
+    """Returns connection pool hit/miss counters for every shared transport,
+    keyed by host. Async transports are listed with an " (async)" suffix."""
+    with _transports_lock:
+        stats = {host: transport.stats for host, transport in _transports.items()}
+        stats.update({f"{host} (async)": transport.stats for host, transport in _async_transports.items()})
+    return {host: host_stats.as_dict() for host, host_stats in stats.items()}
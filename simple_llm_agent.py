@@ -1,20 +1,67 @@
+import asyncio
+import json
+import os
+import signal
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from string import Template
-from typing import Any, Optional
+from typing import Any, Callable, Optional
 
 from dotenv import load_dotenv
-from kradle import Agent, Context, Kradle, OnEventResponse
+from kradle import Agent, Context, Kradle, KradleAPI, OnEventResponse
 from kradle.models import ChallengeInfo, MinecraftEvent, Observation
 from typing_extensions import TypeAlias
 
 from helpers.llm_clients import (
+    AsyncClientAdapter,
+    AsyncCompletionStream,
+    AsyncLLMClient,
+    AsyncOllamaClient,
+    AsyncOpenRouterClient,
+    AsyncResilientClient,
+    AsyncStreamingLLMClient,
+    CompletionStream,
     LLMClient,
     LLMError,
     LLMResponse,
+    OllamaClient,
     OpenRouterClient,
+    ProviderError,
+    ResilientClient,
+    CachingClient,
+    ClientRegistry,
+    CoalescingClient,
+    HedgedClient,
+    RateLimitedClient,
+    SingleflightClient,
+    StreamingLLMClient,
+    TokenUsage,
+    client_stats,
+    count_json_repair,
+    current_event,
+    current_participant_name,
+    is_superseded,
+    json_repair_stats,
     message_with_details,
+    observation_key,
+    openrouter_url,
     parse_action_from_response,
+    rate_limiter,
+    run_sync,
 )
 from helpers import prompts
+from helpers.history import History, ModelSummarizer
+from helpers.log_shipping import GzipBatchLogSink, KradleLogSink, LogShipper
+from helpers.metrics import metric_labels, metrics
+from helpers.observations import CountChanges, ObservationDelta, ObservationDiffer
+from helpers.policies import IdleDebounce, PolicyChain, SkipWhileExecuting
+from helpers.prompt_cache import PromptCache, TruncationCache, challenge_fingerprint
+from helpers.recording import Recorder, RecordingClient
+from helpers.retrieval import ExampleStore, SkillIndex
+from helpers.sharding import ShardedServer
+from helpers.transport import configure_transport, shared_async_transport, transport_stats
+from helpers.response_cache import SQLiteCacheBackend
 
 """
 An example of a Minecraft-playing agent based on communication with an LLM.
@@ -61,6 +108,10 @@ PERSONALITY_PROMPT = "you are a cool resourceful agent. you really want to achie
 # Whether you want step-by-step execution to see what the agent is doing
 STEP_BY_STEP = False
 
+# Whether to print each prompt to the console. Turn this off when running many
+# participants to save the work of formatting them.
+CONSOLE_OUTPUT = True
+
 # This adds a delay (in milliseconds) after an action is performed. Increase
 # this if the agent is too fast or if you want more time to see the agent's
 # actions
@@ -69,9 +120,165 @@ DELAY_AFTER_ACTION = 100
 # Number of times the LLM will retry to generate a valid response
 MAX_RETRIES = 3
 
-
-def setup(kradle: Kradle) -> Agent:
-    agent = kradle.agent(
+# Whether to talk to the LLM with asyncio. When enabled, the LLM requests of all
+# participants are driven by a single event loop instead of each one holding a
+# thread for the whole round trip.
+USE_ASYNC_CLIENT = False
+
+# Whether to stream completions from the LLM. When enabled, the action is sent
+# back to Kradle as soon as the model has finished writing its "code", without
+# waiting for the rest of the response. The chat message is only included if
+# the model wrote it before the code.
+STREAM_COMPLETIONS = False
+
+# Whether to ask the LLM provider to cache the static part of the prompt (the
+# instructions, skill docs and examples) between requests. This lowers the cost
+# and latency of models that support it; cache hit ratios are included in the
+# logs.
+PROMPT_CACHING = False
+
+# The connection pool for requests to OpenRouter, shared by every participant in
+# a process: how many connections to keep open, whether to reuse them between
+# requests, and whether to use HTTP/2 (which needs `pip install 'httpx[http2]'`).
+# Raise HTTP_POOL_SIZE if many participants share a process. Pool hits and new
+# connections are included in the logs.
+HTTP_POOL_SIZE = 10
+HTTP_KEEP_ALIVE = True
+HTTP2 = False
+
+# Whether to reuse the LLM's previous response when an idle or command event
+# shows exactly the same game state as an earlier one, instead of asking the
+# LLM again. Cached responses expire after RESPONSE_CACHE_TTL seconds. Set
+# RESPONSE_CACHE_PATH to a file name to keep the cache across runs.
+CACHE_RESPONSES = False
+RESPONSE_CACHE_TTL = 60
+RESPONSE_CACHE_PATH: Optional[str] = None
+
+# Whether to keep at most one LLM request in flight per participant. Events that
+# arrive while the LLM is thinking are coalesced: only the latest one is
+# answered once the current request finishes, and the others are skipped.
+COALESCE_REQUESTS = False
+
+# Backup OpenRouter models to hedge slow requests with. If MODEL hasn't answered
+# within its usual (95th percentile) latency, the same prompt is also sent to the
+# next model in this list, and the first valid response wins.
+HEDGE_MODELS: list[str] = []
+
+# A local Ollama model to fail over to while OpenRouter is unavailable. Requests
+# that fail because of rate limits, server errors or network problems are
+# retried with backoff first; if OpenRouter keeps failing, its circuit breaker
+# opens and requests go to this model instead. Requires OLLAMA_API_URL to be
+# set. Leave as None to disable failover.
+FALLBACK_OLLAMA_MODEL: Optional[str] = None
+
+# How many tokens of recent conversation history to include in each prompt.
+# Older turns are folded into a running summary, so the agent keeps a memory of
+# the whole challenge while prompts stay the same size. By default the summary
+# is built locally from the events and code of each turn; set
+# HISTORY_SUMMARY_MODEL to an OpenRouter model ID to have a (preferably small
+# and cheap) model write it instead, in the background.
+HISTORY_TOKEN_BUDGET = 3000
+HISTORY_SUMMARY_MODEL: Optional[str] = None
+
+# Set this to a directory to keep a complete record of each participant's
+# conversation. Turns that are folded into the history summary are appended to
+# <run id>-<participant id>.jsonl in that directory instead of being discarded.
+HISTORY_SPILL_DIR: Optional[str] = None
+
+# Whether to describe observations by what changed since the previous one the
+# LLM saw, instead of repeating every visible block, entity and inventory item
+# each turn. This makes prompts much shorter in block-rich challenges. Every
+# OBSERVATION_KEYFRAME_INTERVAL-th observation is still sent in full.
+OBSERVATION_DELTAS = False
+OBSERVATION_KEYFRAME_INTERVAL = 10
+
+# Whether to send only the skill docs relevant to the current situation instead
+# of the whole skill reference, which is the largest part of the prompt. The
+# SKILL_RETRIEVAL_TOP_K skills that best match the task, the latest command
+# output and any error are included each turn, along with the PINNED_SKILLS.
+SKILL_RETRIEVAL = False
+SKILL_RETRIEVAL_TOP_K = 8
+PINNED_SKILLS = ["goToPosition", "goToPlayer", "collectBlock", "placeBlock", "craftRecipe"]
+
+# Whether to include only the EXAMPLES_TOP_N example conversations from
+# prompts.coding_examples that are most similar to the task and the latest
+# command output, using at most EXAMPLES_TOKEN_BUDGET tokens, instead of all of
+# them. This lets the example library grow without growing the prompt.
+EXAMPLE_RETRIEVAL = False
+EXAMPLES_TOP_N = 3
+EXAMPLES_TOKEN_BUDGET = 800
+
+# Whether to answer trivial events with simple rules instead of the LLM: idle
+# and command events that arrive while the bot is still running code and bring
+# nothing new are skipped, as are idle events that arrive within
+# IDLE_DEBOUNCE_SECONDS of the last one. The share of events answered this way
+# is included in the logs. See helpers/policies.py to add your own rules.
+USE_FAST_PATH = False
+IDLE_DEBOUNCE_SECONDS = 2.0
+
+# The agent times each stage of every event (building the prompt, the LLM call
+# and its HTTP connect, time-to-first-byte and total, parsing the response,
+# recording and logging the result) per participant and model. Send the process
+# a SIGUSR1 signal to write the timings to METRICS_DUMP_DIR as metrics.json
+# (p50/p95/p99 summaries) and metrics.prom (Prometheus text format), or to print
+# the summaries if it is None. A participant's timings are dropped when its game
+# is over.
+METRICS_DUMP_DIR: Optional[str] = None
+
+# Whether to send logs to Kradle from a background thread instead of waiting
+# for each one before answering the event. Logs that are still queued when the
+# agent exits are flushed. The Kradle API takes one log entry per request, so
+# this still makes a request per entry, just off the event path. Set
+# LOG_BATCH_URL to post the queued logs in batches, each as a single
+# gzip-compressed request, to a log collector that accepts them instead.
+BACKGROUND_LOGGING = False
+LOG_BATCH_URL: Optional[str] = None
+
+# The rate limits of your OpenRouter provider, per model: requests per second
+# and tokens per minute. When set, requests from all participants wait their turn
+# to stay under them instead of triggering a burst of 429 errors, e.g. when
+# every participant answers its first event at once. Chat events go first and
+# idle events last. Leave as None for no limit.
+RATE_LIMIT_REQUESTS_PER_SECOND: Optional[float] = None
+RATE_LIMIT_TOKENS_PER_MINUTE: Optional[float] = None
+
+# Whether participants that send the same prompt (ignoring whitespace and their
+# own names) while an identical request is still in flight share that request
+# and its answer, e.g. when every participant starts the same challenge at once.
+# Prompts that differ in anything else, such as the conversation history or the
+# other players in sight, are not shared, so this mostly helps with the first
+# events of a challenge. Only events in DEDUPLICATE_EVENTS are shared; leave out
+# the ones where you want each participant to answer in its own way.
+DEDUPLICATE_REQUESTS = False
+DEDUPLICATE_EVENTS = [MinecraftEvent.INITIAL_STATE.value, MinecraftEvent.IDLE.value]
+
+# Set this to a file name to record every participant's challenge, observations
+# and LLM responses as JSON lines. Recordings can be replayed offline, without
+# Kradle or an LLM, with benchmarks/replay.py. LLM responses are only recorded
+# when USE_ASYNC_CLIENT is off.
+RECORD_PATH: Optional[str] = None
+
+# Whether to make the agent reachable by Kradle through a public tunnel. Set
+# this to False to serve it on localhost only, e.g. for load tests against the
+# mock Kradle in benchmarks/mock_kradle.py.
+CREATE_PUBLIC_URL = True
+
+# How many processes to serve participants from. With more than one, this
+# process becomes a supervisor that proxies each participant to one of
+# WORKER_PROCESSES worker processes, always the same one, so that the CPU work
+# of many participants runs on several cores. Crashed or unresponsive workers
+# are restarted; send the supervisor SIGHUP to restart them all one at a time,
+# e.g. after changing the code. SIGUSR1 metrics dumps aren't available then.
+WORKER_PROCESSES = 1
+
+
+def create_agent(kradle: Kradle) -> Agent:
+    """
+    Creates the agent without any handlers or shared state. This is all that the
+    supervisor needs to register the agent when serving from WORKER_PROCESSES
+    workers, which each run `setup`.
+    """
+    return kradle.agent(
         name=AGENT_NAME,
         # The name that will show up in the Kradle web UI.
         display_name=f"{AGENT_NAME} (llm)",
@@ -88,6 +295,27 @@ def setup(kradle: Kradle) -> Agent:
         },
     )
 
+
+def setup(kradle: Kradle, client_factory: Optional[Callable[[Context], LLMClient]] = None) -> Agent:
+    """
+    Creates the agent and registers its handlers. By default each participant
+    talks to MODEL on OpenRouter; pass `client_factory` to create each
+    participant's LLM client yourself, e.g. a stub for offline benchmarks.
+    """
+    global log_shipper, recorder, summary_executor
+    if BACKGROUND_LOGGING:
+        sink = GzipBatchLogSink(LOG_BATCH_URL) if LOG_BATCH_URL else KradleLogSink(kradle.api)
+        log_shipper = LogShipper(sink)
+    if RECORD_PATH:
+        recorder = Recorder(RECORD_PATH)
+    if HISTORY_SUMMARY_MODEL:
+        summary_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="history-summary")
+    if client_factory is None:
+        configure_http()
+        prewarm_clients(kradle.api)
+
+    agent = create_agent(kradle)
+
     # You register handlers for certain events using decorators like this. The
     # Kradle SDK will call any function decorated with @agent.init when a
     # challenge run starts. You can use this to do any setup you need.
@@ -100,10 +328,61 @@ def setup(kradle: Kradle) -> Agent:
     def init(challenge: ChallengeInfo, context: Context):
         # Use the OpenRouter client to make API calls to the LLM. There are
         # other clients available, see llm_clients.py for more.
-        context["client"] = OpenRouterClient(context["model"], kradle.api)
+        #
+        # Client wrappers such as CachingClient work with the synchronous
+        # client, so they are not applied when USE_ASYNC_CLIENT is set.
+        if recorder:
+            recorder.record_init(challenge)
+
+        if USE_ASYNC_CLIENT:
+            if client_factory:
+                context["client"] = AsyncClientAdapter(client_factory(context))
+            else:
+                context["client"] = create_async_client(context["model"], kradle.api)
+        else:
+            client = client_factory(context) if client_factory else create_client(context["model"], kradle.api)
+            if recorder:
+                client = RecordingClient(client, recorder, context.participant_id)
+            if HEDGE_MODELS:
+                client = HedgedClient([client, *(create_client(model, kradle.api) for model in HEDGE_MODELS)])
+            if CACHE_RESPONSES:
+                client = CachingClient(
+                    client,
+                    ttl=RESPONSE_CACHE_TTL,
+                    backend=response_cache_backend(),
+                    key=observation_key,
+                    events={MinecraftEvent.IDLE.value, MinecraftEvent.COMMAND_EXECUTED.value},
+                )
+            if COALESCE_REQUESTS:
+                client = CoalescingClient(client)
+            context["client"] = client
 
         # Keep track of the conversation history with the LLM.
-        context["history"] = []
+        summarizer = None
+        if HISTORY_SUMMARY_MODEL:
+            summarizer = ModelSummarizer(create_summary_client(HISTORY_SUMMARY_MODEL, kradle.api))
+        spill_path = None
+        if HISTORY_SPILL_DIR:
+            os.makedirs(HISTORY_SPILL_DIR, exist_ok=True)
+            spill_path = os.path.join(HISTORY_SPILL_DIR, f"{context.run_id}-{context.participant_id}.jsonl")
+        context["history"] = History(
+            HISTORY_TOKEN_BUDGET, summarizer, spill_path=spill_path, executor=summary_executor
+        )
+
+        if USE_FAST_PATH:
+            context["policies"] = PolicyChain([SkipWhileExecuting(), IdleDebounce(IDLE_DEBOUNCE_SECONDS)])
+
+        if OBSERVATION_DELTAS:
+            context["observations"] = ObservationDiffer(OBSERVATION_KEYFRAME_INTERVAL)
+
+        # Identifies this challenge's prompts in the shared system prompt cache.
+        context["challenge_key"] = challenge_fingerprint(challenge)
+
+        if SKILL_RETRIEVAL:
+            context["skills"] = skill_index(context["challenge_key"], challenge)
+
+        # Running total of the tokens used by this participant.
+        context["token_usage"] = TokenUsage()
 
         print_highlighted(f"We just got added as a participant to this challenge:\n{challenge.task}")
 
@@ -123,6 +402,28 @@ def setup(kradle: Kradle) -> Agent:
         MinecraftEvent.IDLE,
     )
     def event(observation: Observation, context: Context) -> OnEventResponse:
+        # Let client wrappers know which event they're answering and for whom,
+        # and label the timings recorded while answering it.
+        current_event.set(observation.event)
+        current_participant_name.set(observation.name)
+        metric_labels.set({"participant": context.participant_id, "model": context["model"]})
+
+        if recorder:
+            recorder.record_observation(observation)
+
+        # Answer trivial events right away, without asking the LLM.
+        policies: Optional[PolicyChain] = context.get("policies")
+        if policies:
+            decision = policies.decide(observation, context)
+            if decision is not None:
+                print_highlighted(f"Answered {observation.event} event without the LLM")
+                return decision
+
+        # The async pipeline runs on a shared event loop; this thread just
+        # waits for its result.
+        if USE_ASYNC_CLIENT:
+            return run_sync(event_async(observation, context))
+
         # Context values are untyped. If you're using type annotations, you can
         # declare locals like this to impose a type on these values.
         client: LLMClient = context["client"]
@@ -135,9 +436,37 @@ def setup(kradle: Kradle) -> Agent:
             llm_prompt = format_llm_prompt(observation, context)
             show_heading(llm_prompt, attempt)
 
+            response: Optional[LLMResponse] = None
             try:
-                response = client.get_chat_completion(llm_prompt)
-                action = parse_action_from_response(response)
+                if STREAM_COMPLETIONS:
+                    streaming_client: StreamingLLMClient = context["client"]
+                    stream = streaming_client.stream_chat_completion(llm_prompt)
+                    with metrics.span("llm_early_action"):
+                        early_action = stream.early_action()
+                    if early_action is not None and early_action["code"]:
+                        # Forward the action right away and read the rest of
+                        # the completion in the background.
+                        threading.Thread(target=finish_stream, args=(stream, llm_prompt, context), daemon=True).start()
+
+                        print_highlighted("Step 3: the LLM finished writing code, forwarding it to Kradle early")
+                        print(f"\n{early_action}")
+
+                        return {
+                            "code": early_action["code"],
+                            "message": early_action["message"],
+                            "delay": context["delay_after_action"],
+                        }
+                    with metrics.span("llm_completion"):
+                        response = stream.response()
+                else:
+                    with metrics.span("llm_completion"):
+                        response = client.get_chat_completion(llm_prompt)
+                if is_superseded(response):
+                    # A newer event took this one's place; it will answer with
+                    # fresher state.
+                    return {"code": "", "message": "", "delay": 0}
+                with metrics.span("parse_action"):
+                    action = parse_action_from_response(response)
                 record_result(llm_prompt, response, None, context)
 
                 print_highlighted("Step 3: we got this back from LLM, forwarding to Kradle")
@@ -156,6 +485,12 @@ def setup(kradle: Kradle) -> Agent:
                 wait_for_input()
 
                 record_result(llm_prompt, response, e, context)
+
+                # Provider failures have already been retried with backoff by
+                # ResilientClient, so asking again right away would only add
+                # load to a struggling provider.
+                if isinstance(e, ProviderError):
+                    break
                 continue
 
         # If we fall out of the loop, we've failed.
@@ -165,13 +500,270 @@ def setup(kradle: Kradle) -> Agent:
             "delay": context["delay_after_action"],
         }
 
+    @agent.event(MinecraftEvent.GAMEOVER)
+    def game_over(observation: Observation, context: Context) -> OnEventResponse:
+        # The participant is done, so drop its timings; otherwise an agent that
+        # serves many challenges keeps a set of histograms for every participant
+        # it has ever had.
+        metrics.remove(participant=context.participant_id)
+        return {"code": "", "message": "", "delay": 0}
+
     return agent
 
 
+def create_client(model: str, api: KradleAPI) -> LLMClient:
+    """
+    Returns the synchronous OpenRouter client for the given model, shared by
+    every participant, that retries provider failures with backoff and fails
+    over to FALLBACK_OLLAMA_MODEL. With DEDUPLICATE_REQUESTS, identical
+    requests in flight at the same time are shared.
+    """
+
+    def create() -> LLMClient:
+        fallback = OllamaClient(FALLBACK_OLLAMA_MODEL) if FALLBACK_OLLAMA_MODEL else None
+        client: LLMClient = ResilientClient(
+            rate_limited(OpenRouterClient(model, api, prompt_caching=PROMPT_CACHING)), fallback=fallback
+        )
+        if DEDUPLICATE_REQUESTS:
+            client = SingleflightClient(client, events=set(DEDUPLICATE_EVENTS))
+        return client
+
+    return clients.get(("openrouter-resilient", model, PROMPT_CACHING, FALLBACK_OLLAMA_MODEL), create)
+
+
+def create_async_client(model: str, api: KradleAPI) -> AsyncLLMClient:
+    """
+    Returns the asyncio OpenRouter client for the given model, shared by every
+    participant, that retries and fails over like the one from `create_client`.
+    """
+
+    def create() -> AsyncLLMClient:
+        fallback = AsyncOllamaClient(FALLBACK_OLLAMA_MODEL) if FALLBACK_OLLAMA_MODEL else None
+        return AsyncResilientClient(AsyncOpenRouterClient(model, api, prompt_caching=PROMPT_CACHING), fallback=fallback)
+
+    return clients.get(("openrouter-async-resilient", model, PROMPT_CACHING, FALLBACK_OLLAMA_MODEL), create)
+
+
+def create_summary_client(model: str, api: KradleAPI) -> LLMClient:
+    """
+    Returns the client that writes history summaries with the given model,
+    shared by every participant.
+    """
+    return clients.get(("openrouter", model), lambda: rate_limited(OpenRouterClient(model, api)))
+
+
+def rate_limited(client: LLMClient) -> LLMClient:
+    """
+    Makes the client wait for its model's share of the rate limits, if
+    RATE_LIMIT_REQUESTS_PER_SECOND or RATE_LIMIT_TOKENS_PER_MINUTE is set.
+    """
+    if not RATE_LIMIT_REQUESTS_PER_SECOND and not RATE_LIMIT_TOKENS_PER_MINUTE:
+        return client
+    limiter = rate_limiter(client, RATE_LIMIT_REQUESTS_PER_SECOND, RATE_LIMIT_TOKENS_PER_MINUTE)
+    return RateLimitedClient(client, limiter)
+
+
+def configure_http() -> None:
+    """
+    Sets up the connection pool for OpenRouter with HTTP_POOL_SIZE,
+    HTTP_KEEP_ALIVE and HTTP2, before any client is created.
+    """
+    options = {"pool_size": HTTP_POOL_SIZE, "keep_alive": HTTP_KEEP_ALIVE, "http2": HTTP2}
+    configure_transport(openrouter_url(), **options)
+    if USE_ASYNC_CLIENT:
+        shared_async_transport(openrouter_url(), **options)
+
+
+def prewarm_clients(api: KradleAPI) -> None:
+    """
+    Creates the shared clients for MODEL, HEDGE_MODELS and
+    HISTORY_SUMMARY_MODEL before any participant joins, so that their
+    credentials are resolved once, ahead of time. Participants configured with
+    other models get theirs when they join.
+    """
+    try:
+        if USE_ASYNC_CLIENT:
+            create_async_client(MODEL, api)
+        else:
+            for model in [MODEL, *HEDGE_MODELS]:
+                create_client(model, api)
+        if HISTORY_SUMMARY_MODEL:
+            create_summary_client(HISTORY_SUMMARY_MODEL, api)
+    except Exception as e:
+        # Participants will try again when they join.
+        print(f"Could not create LLM clients ahead of time: {message_with_details(e)}")
+
+
+async def event_async(observation: Observation, context: Context) -> OnEventResponse:
+    """
+    The asyncio version of the `event` handler: formats the prompt, awaits the
+    completion, parses the action and records the result, retrying up to
+    MAX_RETRIES times.
+    """
+    client: AsyncLLMClient = context["client"]
+    current_event.set(observation.event)
+    current_participant_name.set(observation.name)
+    metric_labels.set({"participant": context.participant_id, "model": context["model"]})
+
+    for attempt in range(MAX_RETRIES):
+        llm_prompt = format_llm_prompt(observation, context)
+        show_heading(llm_prompt, attempt)
+
+        response: Optional[LLMResponse] = None
+        try:
+            if STREAM_COMPLETIONS:
+                streaming_client: AsyncStreamingLLMClient = context["client"]
+                stream = streaming_client.stream_chat_completion(llm_prompt)
+                with metrics.span("llm_early_action"):
+                    early_action = await stream.early_action()
+                if early_action is not None and early_action["code"]:
+                    task = asyncio.create_task(finish_stream_async(stream, llm_prompt, context))
+                    _background_tasks.add(task)
+                    task.add_done_callback(_background_tasks.discard)
+
+                    print_highlighted("Step 3: the LLM finished writing code, forwarding it to Kradle early")
+                    print(f"\n{early_action}")
+
+                    return {
+                        "code": early_action["code"],
+                        "message": early_action["message"],
+                        "delay": context["delay_after_action"],
+                    }
+                with metrics.span("llm_completion"):
+                    response = await stream.response()
+            else:
+                with metrics.span("llm_completion"):
+                    response = await client.get_chat_completion(llm_prompt)
+            with metrics.span("parse_action"):
+                action = parse_action_from_response(response)
+            # Recording logs to Kradle over the network, so keep it off the loop.
+            await asyncio.to_thread(record_result, llm_prompt, response, None, context)
+
+            print_highlighted("Step 3: we got this back from LLM, forwarding to Kradle")
+            print(f"\n{action}")
+
+            wait_for_input()
+
+            return {
+                "code": action["code"],
+                "message": action["message"],
+                "delay": context["delay_after_action"],
+            }
+        except Exception as e:
+            print(f"Error: {message_with_details(e)}")
+
+            wait_for_input()
+
+            await asyncio.to_thread(record_result, llm_prompt, response, e, context)
+
+            # Provider failures have already been retried with backoff by
+            # AsyncResilientClient; don't hammer a provider that is failing.
+            if isinstance(e, ProviderError):
+                break
+            continue
+
+    return {
+        "code": "",
+        "message": "I'm sorry, I'm having trouble generating a response. Please try again later.",
+        "delay": context["delay_after_action"],
+    }
+
+
+_response_cache_backend: Optional[SQLiteCacheBackend] = None
+_response_cache_lock = threading.Lock()
+
+
+def response_cache_backend() -> Optional[SQLiteCacheBackend]:
+    """
+    Returns the on-disk response cache shared by all participants, or None to
+    give each participant its own in-memory cache.
+    """
+    global _response_cache_backend
+    with _response_cache_lock:
+        if RESPONSE_CACHE_PATH and _response_cache_backend is None:
+            _response_cache_backend = SQLiteCacheBackend(RESPONSE_CACHE_PATH)
+        return _response_cache_backend
+
+
+# Truncated copies of the system prompts, for logs and display.
+truncated_prompts = TruncationCache()
+
+# Sends logs in the background when BACKGROUND_LOGGING is set.
+log_shipper: Optional[LogShipper] = None
+
+# LLM clients shared by every participant (see create_client).
+clients = ClientRegistry()
+
+# Records what the agent sees when RECORD_PATH is set.
+recorder: Optional[Recorder] = None
+
+# Runs history summaries when HISTORY_SUMMARY_MODEL is set, so that events
+# don't wait for them.
+summary_executor: Optional[ThreadPoolExecutor] = None
+
+# Rendered system prompts, shared by every participant playing the same
+# challenge with the same name and personality.
+system_prompts = PromptCache()
+
+# The example conversations, serialized and indexed once for every participant.
+coding_examples = ExampleStore(prompts.coding_examples)
+
+_skill_indexes: OrderedDict[str, SkillIndex] = OrderedDict()
+_skill_indexes_lock = threading.Lock()
+
+
+def skill_index(challenge_key: str, challenge: ChallengeInfo) -> SkillIndex:
+    """
+    Returns the index of the challenge's skill docs, building it the first time
+    a participant of the challenge asks for it.
+    """
+    with _skill_indexes_lock:
+        index = _skill_indexes.get(challenge_key)
+        if index is None:
+            index = _skill_indexes[challenge_key] = SkillIndex(challenge.js_functions, PINNED_SKILLS)
+            while len(_skill_indexes) > 16:
+                _skill_indexes.popitem(last=False)
+        else:
+            _skill_indexes.move_to_end(challenge_key)
+        return index
+
+# Keeps background tasks referenced until they finish, since the event loop
+# only holds weak references to them.
+_background_tasks: set[asyncio.Task] = set()
+
+
+def finish_stream(stream: CompletionStream, llm_prompt: "Messages", context: Context) -> None:
+    """
+    Reads the rest of a streamed completion whose action was already sent to
+    Kradle, and records the full result.
+    """
+    response: Optional[LLMResponse] = None
+    try:
+        response = stream.response()
+        record_result(llm_prompt, response, None, context)
+    except Exception as e:
+        print(f"Error: {message_with_details(e)}")
+        record_result(llm_prompt, response, e, context)
+
+
+async def finish_stream_async(stream: AsyncCompletionStream, llm_prompt: "Messages", context: Context) -> None:
+    """
+    The asyncio version of `finish_stream`.
+    """
+    response: Optional[LLMResponse] = None
+    try:
+        response = await stream.response()
+        await asyncio.to_thread(record_result, llm_prompt, response, None, context)
+    except Exception as e:
+        print(f"Error: {message_with_details(e)}")
+        await asyncio.to_thread(record_result, llm_prompt, response, e, context)
+
+
 Message: TypeAlias = dict[str, str]
 Messages: TypeAlias = list[Message]
 
 
+@metrics.timed("format_llm_prompt")
 def format_llm_prompt(observation: Observation, context: Context) -> Messages:
     """
     Combines the challenge, the current observation, history, and other information
@@ -192,11 +784,39 @@ def format_llm_prompt(observation: Observation, context: Context) -> Messages:
     challenge = context.challenge_info
     personality_prompt = context["personality_prompt"]
     history = context["history"]
+
+    # The system prompt only depends on the challenge, the bot's name and the
+    # personality, so render it once and reuse the same messages every turn.
+    system_prompt = system_prompts.get_or_build(
+        (context["challenge_key"], observation.name, personality_prompt),
+        lambda: [
+            *format_system_prompt(challenge, observation),
+            {"role": "system", "content": substitute(prompts.personality_prompt, PERSONALITY_PROMPT=personality_prompt)},
+        ],
+    )
+
+    differ: Optional[ObservationDiffer] = context.get("observations")
+    if differ:
+        observation_prompt = differ.render(
+            observation, format_observation, format_observation_delta, in_context=history.contains
+        )
+    else:
+        observation_prompt = format_observation(observation)
+
+    history_prompt = format_history_prompt(history)
+
+    # The relevant skills and examples change every turn, so they go after the
+    # static system prompt to keep it cacheable.
+    skills: Optional[SkillIndex] = context.get("skills")
+    skills_prompt = format_skills_prompt(skills, challenge, observation, history_prompt) if skills else []
+    examples_prompt = format_examples_prompt(challenge, observation) if EXAMPLE_RETRIEVAL else []
+
     result = [
-        *format_system_prompt(challenge, observation),
-        {"role": "system", "content": substitute(prompts.personality_prompt, PERSONALITY_PROMPT=personality_prompt)},
-        *format_history_prompt(history),
-        {"role": "user", "content": format_observation(observation)},
+        *system_prompt,
+        *history_prompt,
+        *skills_prompt,
+        *examples_prompt,
+        {"role": "user", "content": observation_prompt},
     ]
 
     return result
@@ -204,7 +824,8 @@ def format_llm_prompt(observation: Observation, context: Context) -> Messages:
 
 def format_system_prompt(challenge: ChallengeInfo, observation: Observation) -> Messages:
     """
-    Formats system prompt messages for the LLM.
+    Formats system prompt messages for the LLM. This is expensive, so
+    `format_llm_prompt` caches the result in `system_prompts`.
     """
 
     # Tell the LLM which Minecraft mode it's playing in.
@@ -225,14 +846,19 @@ def format_system_prompt(challenge: ChallengeInfo, observation: Observation) ->
         ),
         # The skills prompt gives the LLM code documentation about the available
         # commands.
-        substitute(prompts.skills_prompt, CODE_DOCS=challenge.js_functions),
+        substitute(
+            prompts.skills_prompt,
+            CODE_DOCS=prompts.skills_reference_note if SKILL_RETRIEVAL else challenge.js_functions,
+        ),
         # Minecraft modes (creative, self_preservation, etc) available in
         # the challenge
         substitute(prompts.agent_prompt, AGENT_MODE=challenge.agent_modes),
-        # The examples prompt gives the LLM examples of code it could generate.
-        substitute(prompts.examples_prompt, EXAMPLES=prompts.coding_examples),
     ]
 
+    # The examples prompt gives the LLM examples of code it could generate.
+    if not EXAMPLE_RETRIEVAL:
+        result.append(substitute(prompts.examples_prompt, EXAMPLES=coding_examples.all()))
+
     return [{"role": "system", "content": message} for message in result]
 
 
@@ -245,12 +871,42 @@ def substitute(prompt: str, **kwargs) -> str:
     return template.safe_substitute(**kwargs)
 
 
-def format_history_prompt(history: list[Message]) -> Messages:
+def format_skills_prompt(
+    skills: SkillIndex,
+    challenge: ChallengeInfo,
+    observation: Observation,
+    history_prompt: Messages,
+) -> Messages:
     """
-    Returns the last 5 messages in the conversation history to feed into the
-    next LLM prompt.
+    Returns a message with the docs for the skills most relevant to the task,
+    the latest command output and the last error, if the previous turn had one.
     """
-    return history[-5:]
+    query = [challenge.task, observation.output or ""]
+    if history_prompt and history_prompt[-1]["role"] == "system":
+        query.append(history_prompt[-1]["content"])
+    selected = skills.select(" ".join(query), SKILL_RETRIEVAL_TOP_K)
+    return [{"role": "user", "content": substitute(prompts.relevant_skills_prompt, CODE_DOCS=selected)}]
+
+
+def format_examples_prompt(challenge: ChallengeInfo, observation: Observation) -> Messages:
+    """
+    Returns a message with the example conversations most similar to the task
+    and the latest command output.
+    """
+    examples = coding_examples.select(
+        f"{challenge.task} {observation.output or ''}",
+        EXAMPLES_TOP_N,
+        EXAMPLES_TOKEN_BUDGET,
+    )
+    return [{"role": "user", "content": substitute(prompts.examples_prompt, EXAMPLES=examples)}]
+
+
+def format_history_prompt(history: History) -> Messages:
+    """
+    Returns the recent conversation history that fits in HISTORY_TOKEN_BUDGET,
+    along with a summary of what came before, to feed into the next LLM prompt.
+    """
+    return history.messages()
 
 
 def format_observation(observation: Observation) -> str:
@@ -288,10 +944,52 @@ def format_observation(observation: Observation) -> str:
     return "\n\n".join(result)
 
 
+def format_observation_delta(observation: Observation, delta: ObservationDelta) -> str:
+    """
+    Converts an observation to a string for the LLM prompt that only lists what
+    changed since the previous observation the LLM saw.
+    """
+
+    def _format_value(value: Any) -> Any:
+        return value if value else "None"
+
+    def _format_changes(changes: CountChanges) -> str:
+        if not changes:
+            return "unchanged"
+        parts = [f"+{count} {name}" if count != 1 else f"+{name}" for name, count in changes.added.items()]
+        parts.extend(f"-{name}" for name in changes.removed)
+        parts.extend(f"{name} {old} -> {new}" for name, (old, new) in changes.changed.items())
+        return ", ".join(parts)
+
+    result = [
+        f"Event received: {_format_value(observation.event)}",
+        f"Command Output:\n{_format_value(observation.output)}",
+        f"Position: {_format_value(observation.position)}",
+    ]
+
+    if observation.chat_messages:
+        result.append(f"Latest Chat: {_format_value(observation.chat_messages)}")
+
+    result.extend(
+        [
+            "Changes since your previous observation:",
+            f"Visible Players: {_format_changes(delta.players)}",
+            f"Visible Blocks: {_format_changes(delta.blocks)}",
+            f"Visible Entities: {_format_changes(delta.entities)}",
+            f"Inventory: {_format_changes(delta.inventory)}",
+            f"Health: {observation.health * 100}/100{'' if delta.health_changed else ' (unchanged)'}",
+        ]
+    )
+
+    return "\n\n".join(result)
+
+
 def show_heading(llm_prompt: Messages, attempt: int) -> None:
     """
     Prints a big blocky heading to the console to indicate the start of an LLM call.
     """
+    if not CONSOLE_OUTPUT:
+        return
 
     if attempt == 0:
         print_highlighted("Step 1: Received Observation:")
@@ -316,6 +1014,7 @@ def print_highlighted(text: str) -> None:
     print(f"{text}")
     print(f"\033[91m########################################################\033[0m")
 
+@metrics.timed("record_result")
 def record_result(
     llm_prompt: Messages,
     response: Optional[LLMResponse],
@@ -326,10 +1025,15 @@ def record_result(
     Records the result of an LLM call both in the conversation history and
     remotely via the Kradle API.
     """
-    history: list[Message] = context["history"]
+    history: History = context["history"]
 
     request = llm_prompt[-1]["content"]
-    history.append({"role": "user", "content": request})
+
+    # The LLM has now seen this observation, so diff the next one against it.
+    differ: Optional[ObservationDiffer] = context.get("observations")
+    if differ:
+        differ.commit(request)
+    turn: Messages = [{"role": "user", "content": request}]
 
     content: Optional[str]
     if response and response.content:
@@ -340,39 +1044,92 @@ def record_result(
         content = None
 
     if content:
-        history.append({"role": "assistant", "content": content})
+        turn.append({"role": "assistant", "content": content})
 
     if error:
-        history.append({"role": "system", "content": f"your last response was not valid because: {str(error)}"})
+        turn.append({"role": "system", "content": f"your last response was not valid because: {str(error)}"})
+
+    history.append(*turn)
 
-    log_result(llm_prompt, content, context)
+    log_result(
+        llm_prompt,
+        content,
+        context,
+        response.usage if response else None,
+        response.repair if response else None,
+    )
 
 
-def log_result(llm_prompt: Messages, response: Optional[str], context: Context) -> None:
+def log_result(
+    llm_prompt: Messages,
+    response: Optional[str],
+    context: Context,
+    usage: Optional[TokenUsage] = None,
+    repair: Optional[str] = None,
+) -> None:
     """
     Logs the result of an LLM call to the Kradle API for display in the UI.
     """
-    message = {
+    message: dict[str, Any] = {
         "prompt": truncate_prompt(llm_prompt),
         "model": context["model"],
         "response": response,
     }
 
-    context.log(message)
+    if usage:
+        context["token_usage"] += usage
+        message["usage"] = usage.as_dict()
+        message["total_usage"] = context["token_usage"].as_dict()
+
+    # Malformed JSON that was fixed locally instead of retrying the request.
+    if repair:
+        count_json_repair(repair)
+        message["json_repair"] = repair
+        message["json_repairs"] = json_repair_stats()
+
+    policies: Optional[PolicyChain] = context.get("policies")
+    if policies:
+        message["fast_path"] = policies.stats()
+
+    # Counters from client wrappers, such as response cache hits and misses.
+    stats = client_stats(context["client"])
+    if stats:
+        message["client_stats"] = stats
+
+    # Connections reused from the pool versus newly opened, per host.
+    message["connection_pools"] = transport_stats()
+
+    if log_shipper:
+        message["log_shipping"] = log_shipper.stats()
+        log_shipper.submit(context.run_id, context.participant_id, message)
+        return
+
+    with metrics.span("context_log"):
+        context.log(message)
 
 
 def truncate_prompt(prompt: Messages, length: int = 2000) -> Messages:
     """
     Truncates prompt messages to a maximum length, useful for creating more
-    readable logs.
+    readable logs. The result shares messages with `prompt` and with earlier
+    results, so don't modify it.
     """
-    truncated_prompt = []
-    for p in prompt:
-        truncated_p = p.copy()  # Create a shallow copy of the dict
-        if len(truncated_p["content"]) > length:
-            truncated_p["content"] = truncated_p["content"][:length] + "..."
-        truncated_prompt.append(truncated_p)
-    return truncated_prompt
+    return truncated_prompts.truncate(prompt, length)
+
+def dump_metrics() -> None:
+    """
+    Writes the stage timings to METRICS_DUMP_DIR, or prints them if it is None.
+    """
+    if not METRICS_DUMP_DIR:
+        print(json.dumps(metrics.to_json(), indent=2))
+        return
+    os.makedirs(METRICS_DUMP_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DUMP_DIR, "metrics.json"), "w") as file:
+        json.dump(metrics.to_json(), file, indent=2)
+    with open(os.path.join(METRICS_DUMP_DIR, "metrics.prom"), "w") as file:
+        file.write(metrics.to_prometheus())
+    print(f"Wrote metrics to {METRICS_DUMP_DIR}")
+
 
 def wait_for_input() -> None:
     if not STEP_BY_STEP:
@@ -386,6 +1143,28 @@ def wait_for_input() -> None:
 if __name__ == "__main__":
     load_dotenv()
 
-    kradle = Kradle(create_public_url=True, debug=True)
-    agent = setup(kradle)
-    app, connection_info = agent.serve()
+    kradle = Kradle(create_public_url=CREATE_PUBLIC_URL, debug=True)
+
+    if WORKER_PROCESSES > 1:
+        # The workers run `setup`; the supervisor only registers the agent.
+        ShardedServer(setup, WORKER_PROCESSES).serve(create_agent(kradle))
+    else:
+        agent = setup(kradle)
+
+        # Dump the stage timings on `kill -USR1 <pid>`.
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: dump_metrics())
+        app, connection_info = agent.serve()
+
+        # `serve` runs the server on another thread and returns. Wait here
+        # rather than letting the main thread finish: once it has, thread pools,
+        # like the ones that send hedged requests and summarize the history,
+        # refuse new work.
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            # The server thread never stops on its own, so exit without waiting
+            # for it, once the queued logs have been sent.
+            if log_shipper:
+                log_shipper.close()
+            os._exit(0)